@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from mautrix.types import (MessageEvent, TextMessageEventContent, MessageType, EventType, RoomID, EventID, UserID,
+                           RelatesTo, InReplyTo, EncryptedEvent, EncryptedMegolmEventContent, EncryptionAlgorithm,
+                           PaginationDirection)
+
+"""
+    模拟的Matrix客户端, 提供插件用到的homeserver接口, 每个接口调用都有模拟延迟并被计数
+    所有接口调用都经过api.request计数
+    encrypted为True时模拟加密聊天室, get_event_context和get_messages返回加密的消息, 需要通过get_event解密
+"""
+
+
+class FakeRoom:
+    room_id: RoomID
+    members: List[UserID]
+    events: List[MessageEvent]
+    by_id: Dict[EventID, MessageEvent]
+
+    def __init__(self, room_id: RoomID, members: List[UserID]) -> None:
+        self.room_id = room_id
+        self.members = members
+        self.events = []
+        self.by_id = {}
+
+    def add(self, evt: MessageEvent) -> None:
+        self.events.append(evt)
+        self.by_id[evt.event_id] = evt
+
+
+class FakeApi:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls = Counter()
+
+    async def request(self, method: str) -> None:
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeMatrixClient:
+    mxid: UserID
+    crypto = None
+    state_store = None
+    disable_replies = False
+
+    def __init__(self, mxid: UserID = "@bot:bench.local", latency: float = 0.02, encrypted: bool = False) -> None:
+        self.mxid = mxid
+        self.latency = latency
+        self.encrypted = encrypted
+        if encrypted:
+            self.crypto = object()
+        self.rooms: Dict[RoomID, FakeRoom] = {}
+        self.api = FakeApi(latency)
+        self.counter = 0
+
+    @property
+    def calls(self) -> Counter:
+        return self.api.calls
+
+    @staticmethod
+    def parse_user_id(user_id: UserID) -> Tuple[str, str]:
+        localpart, server = user_id[1:].split(":", 1)
+        return localpart, server
+
+    def next_event_id(self) -> EventID:
+        self.counter += 1
+        return EventID(f"$bench{self.counter}")
+
+    def make_event(self, room_id: RoomID, sender: UserID, body: str,
+                   reply_to: Optional[EventID] = None) -> MessageEvent:
+        content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+        if reply_to:
+            content.relates_to = RelatesTo(in_reply_to=InReplyTo(event_id=reply_to))
+        return MessageEvent(type=EventType.ROOM_MESSAGE, room_id=room_id, event_id=self.next_event_id(),
+                            sender=sender, timestamp=int(time.time() * 1000), content=content)
+
+    """
+        创建聊天室并生成history条历史消息, 每条消息回复上一条消息
+    """
+
+    def create_room(self, room_id: RoomID, users: List[UserID], history: int, words: int = 30) -> FakeRoom:
+        room = self.rooms[room_id] = FakeRoom(room_id, [self.mxid, *users])
+        prev = None
+        for i in range(history):
+            sender = self.mxid if i % 2 else users[i % len(users)]
+            evt = self.make_event(room_id, sender, " ".join(f"word{j}" for j in range(words)),
+                                  reply_to=prev.event_id if prev else None)
+            room.add(evt)
+            prev = evt
+        return room
+
+    async def _call(self, name: str) -> None:
+        await self.api.request(name)
+
+    async def get_event(self, room_id: RoomID, event_id: EventID) -> MessageEvent:
+        await self._call("get_event")
+        return self.rooms[room_id].by_id[event_id]
+
+    """
+        按过滤器的types筛选消息, 从新到旧返回index之前的最多limit条消息和下一页的分页令牌
+    """
+
+    def events_before(self, room_id: RoomID, index: int, limit: int,
+                      filter_json: Optional[str]) -> Tuple[List[MessageEvent], Optional[str]]:
+        events = self.rooms[room_id].events
+        types = json.loads(filter_json).get("types") if filter_json else None
+        page = []
+        while index > 0 and len(page) < limit:
+            index -= 1
+            if types is None or events[index].type.t in types:
+                page.append(self.encrypt(events[index]) if self.encrypted else events[index])
+        return page, f"t{index}" if index > 0 else None
+
+    async def get_event_context(self, room_id: RoomID, event_id: EventID, limit: int = 10,
+                                filter: Optional[str] = None) -> SimpleNamespace:
+        await self._call("get_event_context")
+        events = self.rooms[room_id].events
+        index = next(i for i, e in enumerate(events) if e.event_id == event_id)
+        # 与synapse一致, limit的一半用于之前的消息
+        events_before, start = self.events_before(room_id, index, limit // 2, filter)
+        return SimpleNamespace(events_before=events_before, events_after=[], event=events[index], start=start)
+
+    async def get_messages(self, room_id: RoomID, direction: PaginationDirection, from_token: Optional[str] = None,
+                           to_token: Optional[str] = None, limit: Optional[int] = None,
+                           filter_json: Optional[str] = None) -> SimpleNamespace:
+        await self._call("get_messages")
+        index = int(from_token[1:]) if from_token else len(self.rooms[room_id].events)
+        events, end = self.events_before(room_id, index, limit or 10, filter_json)
+        return SimpleNamespace(start=from_token, end=end, events=events)
+
+    @staticmethod
+    def encrypt(evt: MessageEvent) -> EncryptedEvent:
+        content = EncryptedMegolmEventContent(algorithm=EncryptionAlgorithm.MEGOLM_V1, ciphertext="bench",
+                                              session_id="bench", sender_key="bench", device_id="bench")
+        return EncryptedEvent(type=EventType.ROOM_ENCRYPTED, room_id=evt.room_id, event_id=evt.event_id,
+                              sender=evt.sender, timestamp=evt.timestamp, content=content)
+
+    async def get_displayname(self, user_id: UserID) -> str:
+        await self._call("get_displayname")
+        return self.parse_user_id(user_id)[0].capitalize()
+
+    async def get_joined_members(self, room_id: RoomID) -> Dict[UserID, SimpleNamespace]:
+        await self._call("get_joined_members")
+        return {u: SimpleNamespace(displayname=None) for u in self.rooms[room_id].members}
+
+    async def set_typing(self, room_id: RoomID, timeout: int = 0) -> None:
+        await self._call("set_typing")
+
+    async def send_receipt(self, room_id: RoomID, event_id: EventID, receipt_type: str = "m.read") -> None:
+        await self._call("send_receipt")
+
+    async def send_message_event(self, room_id: RoomID, event_type: EventType,
+                                 content: TextMessageEventContent, **kwargs) -> EventID:
+        await self._call("send_message_event")
+        event_id = self.next_event_id()
+        # 编辑消息不加入历史
+        if not content.get_edit():
+            self.rooms[room_id].add(MessageEvent(type=EventType.ROOM_MESSAGE, room_id=room_id, event_id=event_id,
+                                                 sender=self.mxid, timestamp=int(time.time() * 1000),
+                                                 content=content))
+        return event_id
+
+    async def redact(self, room_id: RoomID, event_id: EventID, reason: Optional[str] = None, **kwargs) -> EventID:
+        await self._call("redact")
+        room = self.rooms[room_id]
+        room.events = [evt for evt in room.events if evt.event_id != event_id]
+        room.by_id.pop(event_id, None)
+        return self.next_event_id()
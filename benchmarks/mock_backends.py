@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, List
+
+from aiohttp import web
+
+"""
+    本地模拟的AI平台接口, 支持Ollama, OpenAI兼容接口和Anthropic
+    latency为收到请求到第一个token的时间(秒), token_rate为每秒生成的token数, tokens为每次回复的token数
+    load_time为模型第一次被使用时的加载时间(秒), 加载完成之前的请求都需要等待
+"""
+
+
+class MockBackend:
+    latency: float
+    token_rate: float
+    tokens: int
+    load_time: float
+    requests: int
+    loading: Dict[str, asyncio.Task]
+
+    def __init__(self, latency: float = 0.2, token_rate: float = 50, tokens: int = 100,
+                 load_time: float = 0) -> None:
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.load_time = load_time
+        self.requests = 0
+        self.loading = {}
+        self.runner = None
+        self.url = None
+
+    """
+        客户端取消请求时断开连接, 不再输出错误
+    """
+
+    @web.middleware
+    async def ignore_disconnect(self, request: web.Request, handler) -> web.StreamResponse:
+        try:
+            return await handler(request)
+        except ConnectionResetError:
+            return web.Response(status=499)
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.ignore_disconnect])
+        app.router.add_post("/api/chat", self.ollama_chat)
+        app.router.add_get("/api/tags", self.ollama_tags)
+        app.router.add_post("/api/show", self.ollama_show)
+        app.router.add_post("/api/generate", self.ollama_generate)
+        app.router.add_get("/api/ps", self.ollama_ps)
+        app.router.add_post("/api/embeddings", self.ollama_embeddings)
+        app.router.add_post("/v1/chat/completions", self.openai_chat)
+        app.router.add_get("/v1/models", self.openai_models)
+        app.router.add_post("/v1/embeddings", self.openai_embeddings)
+        app.router.add_post("/v1/messages", self.anthropic_messages)
+        return app
+
+    async def start(self) -> str:
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+
+    """
+        按token_rate生成回复, 每10ms输出一次期间生成的token
+    """
+
+    async def load(self, model: str) -> None:
+        task = self.loading.get(model)
+        if task is None:
+            task = self.loading[model] = asyncio.create_task(asyncio.sleep(self.load_time))
+        await asyncio.shield(task)
+
+    async def generate(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        start = time.monotonic()
+        sent = 0
+        while sent < self.tokens:
+            await asyncio.sleep(0.01)
+            due = min(self.tokens, max(sent + 1, int((time.monotonic() - start) * self.token_rate)))
+            yield "tok " * (due - sent)
+            sent = due
+
+    async def full_text(self) -> str:
+        return "".join([t async for t in self.generate()])
+
+    async def ollama_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self.load(body["model"])
+        if not body.get("stream"):
+            text = await self.full_text()
+            return web.json_response({"model": body["model"], "done": True,
+                                      "message": {"role": "assistant", "content": text}})
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        async for text in self.generate():
+            line = {"model": body["model"], "done": False, "message": {"role": "assistant", "content": text}}
+            await response.write(json.dumps(line).encode() + b"\n")
+        done = {"model": body["model"], "done": True, "done_reason": "stop",
+                "message": {"role": "assistant", "content": ""}}
+        await response.write(json.dumps(done).encode() + b"\n")
+        await response.write_eof()
+        return response
+
+    async def ollama_tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"model": "llama3.2", "size": 2019393189,
+                                              "details": {"parameter_size": "3.2B",
+                                                          "quantization_level": "Q4_K_M"}}]})
+
+    async def ollama_show(self, request: web.Request) -> web.Response:
+        return web.json_response({"model_info": {"llama.context_length": 131072}})
+
+    async def ollama_generate(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await self.load(body["model"])
+        return web.json_response({"model": body["model"], "response": "", "done": True})
+
+    async def ollama_ps(self, request: web.Request) -> web.Response:
+        loaded = [model for model, task in self.loading.items() if task.done()]
+        return web.json_response({"models": [{"name": f"{model}:latest", "model": f"{model}:latest"}
+                                             for model in loaded]})
+
+    """
+        模拟的嵌入向量, 每个单词散列到一个维度, 包含相同单词的文本相似度较高
+    """
+
+    @staticmethod
+    def embedding(text: str, dim: int = 64) -> List[float]:
+        vector = [0.0] * dim
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % dim] += 1.0
+        return vector
+
+    async def ollama_embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"embedding": self.embedding(body["prompt"])})
+
+    async def openai_embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({"object": "list", "model": body["model"], "data": [
+            {"object": "embedding", "index": i, "embedding": self.embedding(text)} for i, text in enumerate(inputs)
+        ]})
+
+    async def openai_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if not body.get("stream"):
+            text = await self.full_text()
+            return web.json_response({"model": body["model"], "choices": [
+                {"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}]})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        async for text in self.generate():
+            data = {"model": body["model"], "choices": [{"delta": {"content": text}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+        data = {"model": body["model"], "choices": [{"delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(data)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def openai_models(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": "gpt-4o-mini"}, {"id": "llama3.2"}]})
+
+    async def anthropic_messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if not body.get("stream"):
+            text = await self.full_text()
+            return web.json_response({"model": body["model"], "stop_reason": "end_turn",
+                                      "content": [{"type": "text", "text": text}]})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(event: str, data: dict) -> None:
+            await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+        await send("message_start", {"type": "message_start", "message": {"model": body["model"]}})
+        async for text in self.generate():
+            await send("content_block_delta", {"type": "content_block_delta",
+                                               "delta": {"type": "text_delta", "text": text}})
+        await send("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn"}})
+        await send("message_stop", {"type": "message_stop"})
+        await response.write_eof()
+        return response
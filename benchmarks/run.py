@@ -0,0 +1,201 @@
+"""
+    离线端到端性能测试
+    使用本地模拟的AI平台接口和模拟的Matrix客户端, 端到端调用AiBotPlugin.on_message,
+    输出延迟的p50/p95/p99, 并发下的吞吐量和各阶段耗时
+
+    python -m benchmarks.run --backend ollama --stream --concurrency 8 --requests 200
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import List
+
+from aiohttp import ClientSession
+from mautrix.util.async_db import Database
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+
+from maubot.matrix import MaubotMessageEvent
+
+from maubot_llmplus.aibot import AiBotPlugin
+from maubot_llmplus.plugin import Config
+from maubot_llmplus.db import upgrade_table
+
+from benchmarks.fake_matrix import FakeMatrixClient
+from benchmarks.mock_backends import MockBackend
+
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "base-config.yaml")
+
+BACKEND_PLATFORMS = {
+    "ollama": ("local_ai", "ollama"),
+    "lmstudio": ("local_ai", "lmstudio"),
+    "openai": ("openai", None),
+    "anthropic": ("anthropic", None),
+    # 只通过配置添加的OpenAI兼容服务器
+    "vllm": ("vllm", None),
+}
+
+
+def load_config(args: argparse.Namespace, url: str) -> Config:
+    yaml = YAML()
+    with open(BASE_CONFIG, encoding="utf-8") as f:
+        base = yaml.load(f)
+    platform, local_type = BACKEND_PLATFORMS[args.backend]
+    if platform not in base["platforms"]:
+        base["platforms"][platform] = dict(base["platforms"]["openai"], provider="openai", model="bench")
+    base["use_platform"] = platform
+    if local_type:
+        base["platforms"]["local_ai"]["type"] = local_type
+    # 所有平台都指向模拟接口, 后台任务(例如模型目录)也不会访问网络
+    for platform_config in base["platforms"].values():
+        platform_config["url"] = url
+        platform_config["api_key"] = "bench"
+    base["reply_in_thread"] = args.thread
+    base["stream"]["enable"] = args.stream
+    base["scheduler"]["max_concurrency"] = args.backend_concurrency
+    base["scheduler"]["max_queue"] = args.requests
+    base["scheduler"]["notify_queue_position"] = False
+    base["summary"]["enable"] = args.summary
+    base["conversation_store"]["enable"] = args.database
+    base["debounce"]["window"] = args.debounce
+    base["warm_up"]["enable"] = args.warm_up
+    base["retrieval"]["enable"] = args.retrieval
+    base["routing"]["enable"] = args.routing
+    base["retrieval"]["disk_path"] = ""
+    base["platforms"][platform]["max_concurrency"] = args.backend_concurrency
+    data = CommentedMap(base)
+    return Config(lambda: data, lambda: RecursiveDict(base, CommentedMap), lambda _: None)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(args: argparse.Namespace) -> None:
+    backend = MockBackend(latency=args.latency, token_rate=args.token_rate, tokens=args.tokens,
+                          load_time=args.load_time)
+    url = await backend.start()
+    client = FakeMatrixClient(latency=args.homeserver_latency, encrypted=args.encrypted)
+    http = ClientSession()
+    # 插件的数据目录和数据库都在临时目录中
+    data_dir = tempfile.TemporaryDirectory()
+    database = None
+    if args.database:
+        # 使用临时的sqlite数据库测试持久化的会话存储
+        database = Database.create(f"sqlite:{data_dir.name}/bench.db", upgrade_table=upgrade_table,
+                                   log=logging.getLogger("bench.db"))
+        await database.start()
+    plugin = AiBotPlugin(client=client, loop=asyncio.get_running_loop(), http=http, instance_id="bench",
+                         log=logging.getLogger("bench"), config=load_config(args, url), database=database,
+                         webapp=None, webapp_url=None,
+                         loader=SimpleNamespace(source=os.path.join(data_dir.name, "bench.mbp")))
+    await plugin.start()
+    # 用户在模型预热完成之后才开始发送消息
+    await asyncio.gather(*plugin.model_warmer.warming.values())
+
+    # 每个并发用户一个聊天室, 聊天室中还有另外两个成员, 避免触发两人聊天室的规则
+    rooms = []
+    for i in range(args.concurrency):
+        users = [f"@user{i}:bench.local", f"@friend{i}:bench.local", f"@other{i}:bench.local"]
+        rooms.append(client.create_room(f"!room{i}:bench.local", users, args.history))
+
+    latencies: List[float] = []
+
+    async def send_message(room, index: int) -> None:
+        last = room.events[-1]
+        evt = client.make_event(room.room_id, room.members[1], f"ai bot, question {index}",
+                                reply_to=last.event_id)
+        room.add(evt)
+        start = time.monotonic()
+        await plugin.on_message(MaubotMessageEvent(evt, client))
+        latencies.append(time.monotonic() - start)
+
+    async def user(room, count: int) -> None:
+        for index in range(0, count, args.burst):
+            # 每个消息在独立的任务中处理, 与maubot的事件分发一致, 一组消息间隔burst_interval秒连续发送
+            tasks = []
+            for burst_index in range(index, min(count, index + args.burst)):
+                if tasks:
+                    await asyncio.sleep(args.burst_interval)
+                tasks.append(asyncio.create_task(send_message(room, burst_index)))
+            await asyncio.gather(*tasks)
+
+    # 不能整除时前面的用户多发送一条消息, 总数与--requests一致
+    per_user = [args.requests // args.concurrency + (1 if i < args.requests % args.concurrency else 0)
+                for i in range(args.concurrency)]
+    start = time.monotonic()
+    await asyncio.gather(*(user(room, count) for room, count in zip(rooms, per_user) if count > 0))
+    elapsed = time.monotonic() - start
+
+    await plugin.stop()
+    if database is not None:
+        await database.stop()
+    data_dir.cleanup()
+    await http.close()
+    await backend.stop()
+
+    total = len(latencies)
+    print(f"backend={args.backend} stream={args.stream} thread={args.thread} summary={args.summary} "
+          f"database={args.database} encrypted={args.encrypted} concurrency={args.concurrency} "
+          f"history={args.history} burst={args.burst} debounce={args.debounce} warm_up={args.warm_up} "
+          f"routing={args.routing} retrieval={args.retrieval}")
+    print(f"requests: {total}, elapsed: {elapsed:.2f}s, throughput: {total / elapsed:.2f} req/s, "
+          f"backend calls: {backend.requests}")
+    print(f"results: {dict(plugin.metrics.requests)}")
+    if plugin.metrics.routes:
+        print(f"routes: {dict(plugin.metrics.routes)}, fallbacks: {plugin.metrics.fallbacks}")
+    print(f"latency p50: {percentile(latencies, 50) * 1000:.1f}ms, p95: {percentile(latencies, 95) * 1000:.1f}ms, "
+          f"p99: {percentile(latencies, 99) * 1000:.1f}ms")
+    # 各阶段耗时和token吞吐量使用插件自身的指标
+    print("stages (mean / p95 per request):")
+    for stage, summary in plugin.metrics.stages.items():
+        if summary.count:
+            p95 = dict(summary.quantiles())[0.95]
+            print(f"  {stage:15s} {summary.sum / summary.count * 1000:8.1f}ms / {p95 * 1000:8.1f}ms")
+    for (platform, model), tokens in plugin.metrics.tokens.items():
+        tokens_per_second = dict(tokens.tokens_per_second.quantiles()).get(0.5, 0.0)
+        print(f"tokens ({platform} {model}): prompt {tokens.prompt_tokens}, completion {tokens.completion_tokens}, "
+              f"p50 {tokens_per_second:.1f} tokens/s")
+    print("homeserver calls per request:")
+    for name, count in sorted(client.calls.items()):
+        print(f"  {name:20s} {count / total:.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="offline end-to-end benchmark of maubot-llmplus")
+    parser.add_argument("--backend", choices=BACKEND_PLATFORMS.keys(), default="ollama")
+    parser.add_argument("--stream", action="store_true", help="enable streaming responses")
+    parser.add_argument("--thread", action="store_true", help="use reply_in_thread mode")
+    parser.add_argument("--summary", action="store_true", help="enable rolling conversation summaries")
+    parser.add_argument("--database", action="store_true", help="use the conversation store in a sqlite database")
+    parser.add_argument("--encrypted", action="store_true", help="history events have to be decrypted")
+    parser.add_argument("--burst", type=int, default=1, help="messages each user sends in quick succession")
+    parser.add_argument("--burst-interval", type=float, default=0.3, help="seconds between messages of a burst")
+    parser.add_argument("--debounce", type=float, default=0, help="debounce window in seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of users sending at the same time")
+    parser.add_argument("--backend-concurrency", type=int, default=4, help="scheduler max_concurrency")
+    parser.add_argument("--requests", type=int, default=40, help="total number of messages")
+    parser.add_argument("--history", type=int, default=20, help="messages already in each room")
+    parser.add_argument("--latency", type=float, default=0.2, help="backend time to first token in seconds")
+    parser.add_argument("--token-rate", type=float, default=200, help="backend tokens per second")
+    parser.add_argument("--tokens", type=int, default=100, help="tokens per response")
+    parser.add_argument("--load-time", type=float, default=0, help="backend model load time in seconds")
+    parser.add_argument("--no-warm-up", dest="warm_up", action="store_false", help="do not preload the model")
+    parser.add_argument("--routing", action="store_true", help="route messages to a fast or a large model")
+    parser.add_argument("--retrieval", action="store_true", help="retrieve relevant older messages by embeddings")
+    parser.add_argument("--homeserver-latency", type=float, default=0.02, help="seconds per homeserver call")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,192 @@
-import re
+import asyncio
+import hmac
+import os
+import time
 
-from typing import Type
-from maubot.handlers import command, event
+from typing import Type, Optional, List
+
+from aiohttp import ClientSession
+from aiohttp.web import Request, Response
+from maubot.handlers import command, event, web
 from maubot import Plugin, MessageEvent
-from mautrix.types import Format, TextMessageEventContent, EventType, MessageType, RelationType
-from mautrix.util import markdown
+from maubot.matrix import MaubotMessageEvent
+from mautrix.types import Format, TextMessageEventContent, EventType, MessageType, RelationType, RedactionEvent, \
+    EventID, StateEvent, RoomID, Membership, MessageEvent as BaseMessageEvent
+from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
-from maubot_llmplus.local_paltform import Ollama, LmStudio
+from maubot_llmplus.catalog import ModelCatalog, ModelCatalogError
+from maubot_llmplus.conversation import ConversationCache, make_status_notice, is_status_notice
+from maubot_llmplus.db import upgrade_table
+from maubot_llmplus.displayname import DisplaynameCache
+from maubot_llmplus.delivery import MarkdownRenderer, SendLimiter, split_markdown, cut_stream, json_size
+from maubot_llmplus.inflight import InFlightTracker, InFlightRequest
+from maubot_llmplus.metrics import Metrics, RequestMetrics, CountingClient, stage, add_stage
 from maubot_llmplus.platforms import Platform
+from maubot_llmplus.registry import PlatformRegistry
+from maubot_llmplus.response_cache import ResponseCache
+from maubot_llmplus.scheduler import InferenceScheduler, QueueFullError
+from maubot_llmplus.store import ConversationStore, ConversationTurn
+from maubot_llmplus.summary import ConversationSummarizer
 from maubot_llmplus.plugin import AbsExtraConfigPlugin, Config
-from maubot_llmplus.thrid_platform import OpenAi, Anthropic, XAi
+from maubot_llmplus.prompt import SystemPrompt
+from maubot_llmplus.providers import resolve_platform, list_platforms, PROVIDERS
+from maubot_llmplus.quota import RateLimiter, RateLimitError, format_duration
+from maubot_llmplus.retrieval import MessageRetriever
+from maubot_llmplus.router import ModelRouter, Route
+from maubot_llmplus.trigger import TriggerEngine
+from maubot_llmplus.warmup import ModelWarmer
 
 class AiBotPlugin(AbsExtraConfigPlugin):
+    trigger: TriggerEngine
+    platform_registry: PlatformRegistry
+    scheduler: InferenceScheduler
+    response_cache: ResponseCache
+    model_catalog: ModelCatalog
+    model_warmer: ModelWarmer
+    rate_limiter: RateLimiter
+    router: ModelRouter
+    in_flight: InFlightTracker
+    markdown_renderer: MarkdownRenderer
+    send_limiter: SendLimiter
 
     async def start(self) -> None:
         await super().start()
         # 加载并更新配置
         self.config.load_and_update()
+        # 热路径指标, 通过counted_client发出的homeserver请求计入当前请求, self.client保持不变
+        self.metrics = Metrics(self.config['metrics']['window'])
+        self.counted_client = CountingClient(self.client)
+        # 会话缓存
+        self.conversation_cache = ConversationCache(self.config['conversation_cache']['max_rooms'],
+                                                    self.config['conversation_cache']['max_messages'])
+        # 用户显示名称缓存
+        self.displayname_cache = DisplaynameCache(self.counted_client, self.config['displayname_cache']['ttl'],
+                                                  self.config['displayname_cache']['max_entries'])
+        # 平台实例注册表
+        self.platform_registry = PlatformRegistry(self.config, self.create_ai_platform, self.log)
+        # 推理请求调度器
+        self.scheduler = InferenceScheduler()
+        # 进行中的请求, 用于取消被编辑, 撤回或者被取代的请求
+        self.in_flight = InFlightTracker()
+        # 回复的markdown渲染, 较长的回复在工作线程中渲染
+        self.markdown_renderer = MarkdownRenderer(self.config['delivery']['render_offload_size'])
+        # 持久化的会话存储, 在apply_config中根据配置创建
+        self.conversation_store = None
+        # 速率限制, 计数保存在插件数据库中
+        self.rate_limiter = RateLimiter(self.database, self.log)
+        # 快速模型和大模型之间的路由
+        self.router = ModelRouter(self.classify_message, lambda: self.config.cur_platform, self.log)
+        # 相关历史消息的检索, 向量索引在apply_config中根据配置启用
+        self.retriever = MessageRetriever(self.embed_texts, self.log)
+        # 会话摘要
+        self.summarizer = ConversationSummarizer(self.complete_summary, self.log,
+                                                 self.config['summary']['max_words'],
+                                                 self.config['summary']['max_entries'])
+        self.apply_config()
+        try:
+            await self.rate_limiter.load()
+        except Exception as e:
+            self.log.warning(f"failed to load rate limits: {e}")
+        # 模型目录, 在后台加载和定时刷新
+        self.model_catalog = ModelCatalog(self.platform_registry, self.log,
+                                          self.config['model_catalog']['refresh_interval'])
+        self.model_catalog.start()
+        # 本地模型预热
+        self.model_warmer = self.create_model_warmer()
+        self.model_warmer.start()
+
+    """
+        根据配置(重新)构建派生对象, 在启动和配置重新加载时调用
+    """
+
+    def apply_config(self) -> None:
+        self.trigger = TriggerEngine(self.get_bot_name(), self.config['allowed_users'])
+        prompt_config = self.config['prompt_cache']
+        self.system_prompt = SystemPrompt(self.config['system_prompt'], self.get_bot_name(),
+                                          self.config['enable_multi_user'], self.config['additional_prompt'],
+                                          prompt_config['timestamp_format'], prompt_config['timestamp_position'])
+        delivery_config = self.config['delivery']
+        self.markdown_renderer.offload_size = delivery_config['render_offload_size']
+        self.send_limiter = SendLimiter(delivery_config['send_rate'], delivery_config['send_burst'])
+        self.summarizer.max_words = self.config['summary']['max_words']
+        self.summarizer.max_entries = self.config['summary']['max_entries']
+        pending_sync = None
+        if self.conversation_store is not None:
+            self.conversation_store.stop()
+            pending_sync = self.conversation_store.pending_sync
+            self.conversation_store = None
+        store_config = self.config['conversation_store']
+        if self.database is not None and store_config['enable']:
+            self.conversation_store = ConversationStore(self.database, self.log, store_config['retention_days'],
+                                                        store_config['max_turns_per_room'],
+                                                        store_config['prune_interval'],
+                                                        store_config['sync_interval'])
+            self.conversation_store.start(pending_sync)
+        self.rate_limiter.configure(self.config['rate_limit'])
+        self.rate_limiter.start()
+        self.router.configure(self.config['routing'])
+        self.retriever.configure(self.config['retrieval'], self.get_data_dir())
+        self.retriever.start()
+        cache_config = self.config['response_cache']
+        disk_path = cache_config['disk_path'] and os.path.join(self.get_data_dir(), cache_config['disk_path'])
+        self.response_cache = ResponseCache(cache_config['enable'], cache_config['max_entries'], cache_config['ttl'],
+                                            disk_path, cache_config['normalize_timestamps'])
+
+    """
+        插件实例的数据目录, 配置中的相对路径都保存在这个目录中, 不依赖maubot的工作目录
+        使用sqlite数据库时为数据库文件所在目录下以实例id命名的目录, 否则为插件文件所在目录下以实例id命名的目录
+    """
+
+    def get_data_dir(self) -> str:
+        url = getattr(self.database, 'url', None)
+        if url is not None and url.scheme == 'sqlite' and url.path:
+            base = os.path.dirname(os.path.abspath(url.path))
+        else:
+            base = os.path.dirname(os.path.abspath(self.loader.source))
+        return os.path.join(base, self.id)
+
+    async def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        self.apply_config()
+        # 配置变化后重建所有平台实例和连接池, 并重新加载模型目录
+        # 进行中的回复继续使用旧的连接池, 完成后再关闭
+        self.model_catalog.stop()
+        self.platform_registry.retire(self.config['connection_pool']['close_grace_period'],
+                                      [request.task for request in self.in_flight.by_key.values()])
+        self.model_catalog.refresh_interval = self.config['model_catalog']['refresh_interval']
+        self.model_catalog.start()
+        self.model_warmer.stop()
+        self.model_warmer = self.create_model_warmer()
+        self.model_warmer.start()
+
+    def create_model_warmer(self) -> ModelWarmer:
+        warm_up_config = self.config['warm_up']
+        return ModelWarmer(self.platform_registry, self.log, lambda: self.config.cur_platform,
+                           warm_up_config['enable'], warm_up_config['ping_interval'],
+                           warm_up_config['busy_hours'] or [])
+
+    async def stop(self) -> None:
+        self.summarizer.stop()
+        self.markdown_renderer.stop()
+        self.rate_limiter.stop()
+        try:
+            await self.rate_limiter.save()
+        except Exception as e:
+            self.log.warning(f"failed to save rate limits: {e}")
+        try:
+            await self.retriever.close()
+        except Exception as e:
+            self.log.warning(f"failed to save retrieval indexes: {e}")
+        if self.conversation_store is not None:
+            try:
+                await self.conversation_store.close()
+            except Exception as e:
+                self.log.warning(f"failed to save conversation sync positions: {e}")
+        self.model_catalog.stop()
+        self.model_warmer.stop()
+        await self.platform_registry.close()
+        await super().stop()
 
     """
     判断sender是否是allowed_users中的成员
@@ -25,17 +194,21 @@ class AiBotPlugin(AbsExtraConfigPlugin):
     """
 
     def is_allow(self, sender: str) -> bool:
-        # 如果列表中没有元素, 直接返回True
-        if len(self.config['allowed_users']) <= 0:
+        if self.trigger.is_allow(sender):
             return True
-
-        for u in self.config['allowed_users']:
-            self.log.debug(f"bot: {sender} -> {u}")
-            # 如果sender是allowed_user中的一员, 那么就允许发送消息给AI
-            if re.match(u, sender):
-                return True
         self.log.debug(f"{sender} doesn't match allowed_users")
-        pass
+        return False
+
+    """
+        获取消息, 优先从会话缓存中获取
+    """
+
+    async def get_cached_event(self, room_id: RoomID, event_id: EventID) -> MessageEvent:
+        cached_event = self.conversation_cache.get_event(room_id, event_id)
+        if cached_event is None:
+            cached_event = await self.counted_client.get_event(room_id=room_id, event_id=event_id)
+            self.conversation_cache.add_fetched_event(cached_event)
+        return cached_event
 
     """
     判断是否应该让AI进行回应
@@ -69,67 +242,505 @@ class AiBotPlugin(AbsExtraConfigPlugin):
             return False
 
         # 检查是否发送消息中有带上机器人的别名
-        if re.search("(^|\\s)(@)?" + self.get_bot_name() + "([ :,.!?]|$)", event.content.body, re.IGNORECASE):
+        if self.trigger.mentions_bot(event.content.body):
             return True
 
-        # 当聊天室只有两个人并且其中一个是机器人时
-        if len(await self.client.get_joined_members(event.room_id)) == 2:
+        # 当聊天室只有两个人并且其中一个是机器人时, 成员数量只在第一次时请求, 之后由成员事件更新
+        member_count = self.trigger.get_member_count(event.room_id)
+        if member_count is None:
+            member_count = len(await self.counted_client.get_joined_members(event.room_id))
+            self.trigger.set_member_count(event.room_id, member_count)
+        if member_count == 2:
             return True
 
-        # 在thread中时
+        # 在thread中时, 已经满足回应条件的thread不再检查根消息
         if self.config['reply_in_thread'] and event.content.relates_to.rel_type == RelationType.THREAD:
-            parent_event = await self.client.get_event(room_id=event.room_id,
-                                                       event_id=event.content.get_thread_parent())
-            return await self.should_respond(parent_event)
+            thread_root = event.content.get_thread_parent()
+            if self.trigger.is_qualified_thread(event.room_id, thread_root):
+                return True
+            parent_event = await self.get_cached_event(event.room_id, thread_root)
+            if await self.should_respond(parent_event):
+                self.trigger.add_qualified_thread(event.room_id, thread_root)
+                return True
+            return False
 
         # 如果是回复消息
         if event.content.relates_to.in_reply_to:
-            parent_event = await self.client.get_event(room_id=event.room_id, event_id=event.content.get_reply_to())
+            parent_event = await self.get_cached_event(event.room_id, event.content.get_reply_to())
             if parent_event.sender == self.client.mxid:
                 return True
-
+        return False
 
     @event.on(EventType.ROOM_MESSAGE)
     async def on_message(self, event: MessageEvent) -> None:
-        if not await self.should_respond(event):
+        # 事件对象由同一个client上的所有插件共享, 复制一份通过插件的client回复, 回复的请求也被统计
+        event = MaubotMessageEvent(event, self.counted_client)
+        # 机器人自己的状态提示不是回答, 不加入会话, 也不需要回应
+        if is_status_notice(event):
+            return
+        # 所有消息(包括编辑消息)都加入会话缓存和会话存储
+        self.conversation_cache.add_event(event)
+        await self.store_event(event)
+        self.index_event(event)
+        if isinstance(event.content, TextMessageEventContent) and \
+                event.content.relates_to.rel_type == RelationType.REPLACE:
+            await self.on_edit(event)
+        request_metrics = self.metrics.start_request()
+        with stage("should_respond"):
+            respond = await self.should_respond(event)
+        if not respond:
+            self.metrics.finish_request(request_metrics, "ignored")
             return
+        await self.handle_message(event, request_metrics)
 
+    """
+        回应一条消息, 同一个用户在同一个会话中只保留最新的一个请求
+        开启debounce时先等待window秒, 期间同一个用户的新消息会合并到一次回复中,
+        较早的消息登记在请求中, 构建上下文时放在最新的消息之前(回复链中没有这些消息)
+    """
+
+    async def handle_message(self, event: MessageEvent, request_metrics: RequestMetrics) -> None:
+        key = (event.room_id, event.sender, event.content.get_thread_parent())
+        previous = self.in_flight.get(key)
+        burst_start = None
+        coalesced = []
+        if previous is not None and previous.debouncing:
+            burst_start = previous.burst_start
+            coalesced = previous.coalesced + [previous.event]
+            self.in_flight.cancel(previous, "coalesced")
+        elif previous is not None and self.config['cancel']['on_new_message']:
+            self.in_flight.cancel(previous, "superseded")
+        in_flight = self.in_flight.register(key, event)
+        if burst_start is not None:
+            in_flight.burst_start = burst_start
+        in_flight.coalesced = coalesced
+        status = "ok"
         try:
             await event.mark_read()
-            await self.client.set_typing(event.room_id, timeout=99999)
+            await self.counted_client.set_typing(event.room_id, timeout=99999)
+            await self.debounce(in_flight)
+            # 超出速率限制时直接回复, 不调用后端
+            throttle = self.rate_limiter.check(event.sender, event.room_id)
+            if throttle is not None:
+                raise RateLimitError(throttle.describe())
             platform = self.get_ai_platform()
-            chat_completion = await platform.create_chat_completion(self, event)
-            self.log.debug(
-                f"发送结果 {chat_completion.message}, {chat_completion.model}, {chat_completion.finish_reason}")
-            # ai gpt调用
-            # 关闭typing提示
-            await self.client.set_typing(event.room_id, timeout=0)
-            # 打开typing提示
-            resp_content = chat_completion.message['content']
-            response = TextMessageEventContent(msgtype=MessageType.TEXT, body=resp_content, format=Format.HTML,
-                                               formatted_body=markdown.render(resp_content))
-            await event.respond(response, in_thread=self.config['reply_in_thread'])
+            name = self.config.cur_platform
+            route = None
+            if self.router.enable:
+                with stage("route"):
+                    route = await self.router.route(event.room_id, self.trigger.strip_mention(event.content.body))
+                self.metrics.record_route(route.tier, route.reason)
+                platform = self.platform_registry.get(route.platform, route.model)
+                name = route.platform
+            if await self.respond_in_slot(name, platform, event, route):
+                # 快速模型的回答需要重新生成, 释放快速模型的调度器位置后在大模型的平台重新排队
+                large = self.get_fallback_route(route)
+                await self.respond_in_slot(large.platform, self.platform_registry.get(large.platform, large.model),
+                                           event)
+        except asyncio.CancelledError:
+            # 其他原因(例如插件停止)的取消继续传递
+            if in_flight.reason is None:
+                raise
+            status = "coalesced" if in_flight.reason == "coalesced" else "cancelled"
+            self.log.debug(f"request for {event.event_id} cancelled: {in_flight.reason}")
+            # 被新消息取代或合并时由新的请求继续显示typing提示
+            if in_flight.reason not in ("superseded", "coalesced"):
+                await self.counted_client.set_typing(event.room_id, timeout=0)
+        except QueueFullError as e:
+            status = "rejected"
+            await self.counted_client.set_typing(event.room_id, timeout=0)
+            await self.send_status(event, f"Sorry, I'm busy right now: {e}")
+        except RateLimitError as e:
+            status = "throttled"
+            await self.counted_client.set_typing(event.room_id, timeout=0)
+            await self.send_status(event, f"Sorry, {e}")
         except Exception as e:
+            status = "error"
             self.log.exception(f"Something went wrong: {e}")
-            await event.respond(f"Something went wrong: {e}")
-            pass
+            await self.send_status(event, f"Something went wrong: {e}", reply=False)
+        finally:
+            self.in_flight.unregister(in_flight)
+            self.rate_limiter.charge(event.sender, event.room_id, request_metrics.tokens)
+            self.metrics.finish_request(request_metrics, status)
 
         return None
 
-    def get_ai_platform(self) -> Platform:
-        use_platform = self.config.cur_platform
-        if use_platform == 'openai':
-            return OpenAi(self.config, self.http)
-        if use_platform == 'anthropic':
-            return Anthropic(self.config, self.http)
-        if use_platform == 'xai':
-            return XAi(self.config, self.http)
-        if use_platform == 'local_ai#ollama':
-            return Ollama(self.config, self.http)
-        if use_platform == 'local_ai#lmstudio':
-            return LmStudio(self.config, self.http)
+    """
+        等待同一个用户的后续消息, 一组连续消息最多推迟max_delay秒
+    """
+
+    async def debounce(self, in_flight: InFlightRequest) -> None:
+        window = self.config['debounce']['window']
+        if window <= 0:
+            return
+        delay = min(window, self.config['debounce']['max_delay'] - (time.monotonic() - in_flight.burst_start))
+        if delay <= 0:
+            return
+        in_flight.debouncing = True
+        try:
+            with stage("debounce"):
+                await asyncio.sleep(delay)
+        finally:
+            in_flight.debouncing = False
+
+    """
+        提示消息被编辑时取消进行中的请求, 开启rerun_edits时使用编辑后的内容重新回应
+    """
+
+    async def on_edit(self, event: MessageEvent) -> None:
+        request = self.in_flight.get_by_event(event.room_id, event.content.get_edit())
+        if request is None or request.event.sender != event.sender or not self.config['cancel']['on_edit']:
+            return
+        self.in_flight.cancel(request, "edited")
+        if not self.config['cancel']['rerun_edits']:
+            return
+        await asyncio.wait([request.task])
+        rerun = self.make_edited_event(request.event, event)
+        request_metrics = self.metrics.start_request()
+        with stage("should_respond"):
+            respond = await self.should_respond(rerun)
+        if not respond:
+            self.metrics.finish_request(request_metrics, "ignored")
+            return
+        await self.handle_message(rerun, request_metrics)
+
+    """
+        用编辑后的内容创建原消息的副本, 保留原消息的event_id, 时间和关联关系(回复, thread)
+        不修改会话缓存和进行中的请求中的原消息, 会话缓存和会话存储由编辑消息本身更新
+    """
+
+    def make_edited_event(self, original: MessageEvent, edit: MessageEvent) -> MessageEvent:
+        content = type(original.content).deserialize(original.content.serialize())
+        content.msgtype = edit.content.msgtype
+        content.body = edit.content.body
+        content.format = edit.content.format
+        content.formatted_body = edit.content.formatted_body
+        edited = BaseMessageEvent(type=EventType.ROOM_MESSAGE, room_id=original.room_id, event_id=original.event_id,
+                                  sender=original.sender, timestamp=original.timestamp, content=content)
+        return MaubotMessageEvent(edited, self.counted_client)
+
+    """
+        通过调度器限制每个平台的并发请求数, 同一聊天室同一用户的请求轮询排队, 取得平台name的位置后回复
+        返回快速模型的回答是否需要由大模型重新生成
+    """
+
+    async def respond_in_slot(self, name: str, platform: Platform, event: MessageEvent,
+                              route: Optional[Route] = None) -> bool:
+        queued_at = time.monotonic()
+        async with self.scheduler.slot(name, (event.room_id, event.sender),
+                                       self.get_max_concurrency(name.split('#')[0]),
+                                       self.config['scheduler']['max_queue'],
+                                       on_queued=lambda position: self.notify_queued(event, position)):
+            add_stage("queue", time.monotonic() - queued_at)
+            # 开启流式响应时, 先发送首段内容, 再通过编辑消息逐步补全
+            if self.config['stream']['enable']:
+                return await self.respond_stream(platform, event, route)
+            return await self.respond_completion(platform, event, route)
+
+    """
+        一次性获取完整结果后发送, 快速模型的回答需要重新生成时不发送, 返回True
+    """
+
+    async def respond_completion(self, platform: Platform, event: MessageEvent, route: Optional[Route] = None) -> bool:
+        chat_completion = await platform.create_chat_completion(self, event)
+        if route is not None and self.router.needs_fallback(route, chat_completion.message.get('content'),
+                                                            chat_completion.finish_reason):
+            return True
+        self.log.debug(
+            f"发送结果 {chat_completion.message}, {chat_completion.model}, {chat_completion.finish_reason}")
+        # ai gpt调用
+        # 关闭typing提示
+        await self.counted_client.set_typing(event.room_id, timeout=0)
+        # 打开typing提示
+        resp_content = chat_completion.message['content']
+        # 超过大小上限的回复拆分为多条消息按顺序发送
+        for part in split_markdown(resp_content, self.config['delivery']['max_message_size']):
+            await self.send_markdown(event, part)
+        return False
+
+    """
+        获取当前平台的最大并发请求数, 平台配置中的max_concurrency覆盖全局配置
+    """
+
+    def get_max_concurrency(self, platform_type: Optional[str] = None) -> int:
+        platform_config = self.config['platforms'][platform_type or self.get_cur_platform()]
+        return platform_config.get('max_concurrency') or self.config['scheduler']['max_concurrency']
+
+    """
+        调用摘要模型生成会话摘要, 没有配置摘要平台和模型时使用当前平台和模型
+        摘要请求和普通请求一样经过调度器, 共享平台的并发限制
+    """
+
+    async def complete_summary(self, messages: List[dict]) -> str:
+        summary_config = self.config['summary']
+        name = summary_config['platform'] or self.config.cur_platform
+        platform = self.platform_registry.get(name)
+        async with self.scheduler.slot(name, ("summary",), self.get_max_concurrency(name.split('#')[0]),
+                                       self.config['scheduler']['max_queue']):
+            chat_completion = await platform.complete(messages, summary_config['model'])
+        if not chat_completion.message:
+            raise ValueError(chat_completion.finish_reason)
+        return chat_completion.message.get('content') or ''
+
+    """
+        调用路由的分类模型, 没有配置分类平台时使用当前平台
+        分类请求很短并且在等待路由结果, 不经过调度器排队
+    """
+
+    async def classify_message(self, prompt: str) -> str:
+        classifier_config = self.config['routing']['classifier']
+        platform = self.platform_registry.get(classifier_config['platform'] or self.config.cur_platform)
+        chat_completion = await platform.complete([{"role": "user", "content": prompt}], classifier_config['model'])
+        if not chat_completion.message:
+            raise ValueError(chat_completion.finish_reason)
+        return chat_completion.message.get('content') or ''
+
+    """
+        调用嵌入模型把文本转换为向量, 没有配置检索平台时使用当前平台
+    """
+
+    async def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        retrieval_config = self.config['retrieval']
+        platform = self.platform_registry.get(retrieval_config['platform'] or self.config.cur_platform)
+        return await platform.embed(texts, retrieval_config['model'])
+
+    """
+        请求需要排队时通知用户排队位置
+    """
+
+    async def notify_queued(self, event: MessageEvent, position: int) -> None:
+        scheduler_config = self.config['scheduler']
+        if scheduler_config['notify_queue_position'] and position >= scheduler_config['notify_min_position']:
+            await self.send_status(event, f"The AI platform is busy, your request is number {position} in the queue.")
+
+    """
+        发送带有状态提示标记的通知, 这些消息不会作为助手的回答进入之后的上下文
+    """
+
+    async def send_status(self, event: MessageEvent, text: str, reply: bool = True) -> None:
+        content = make_status_notice(text)
+        if reply:
+            await event.reply(content)
         else:
-            raise ValueError(f"not found platform type: {type}")
+            await event.respond(content)
+
+    """
+    流式响应:
+    收到第一段内容后立即发送消息, 之后按edit_interval节流, 使用m.replace编辑同一条消息
+    当前消息超过大小上限时, 在段落或代码块的边界结束当前消息, 剩余内容发送为新的消息
+    全部内容接收完成后, 再进行一次markdown渲染的最终编辑
+    快速模型的回答需要重新生成时撤回已经发送的部分, 返回True
+    """
+
+    async def respond_stream(self, platform: Platform, event: MessageEvent, route: Optional[Route] = None) -> bool:
+        edit_interval = self.config['stream']['edit_interval']
+        max_message_size = self.config['delivery']['max_message_size']
+        resp_content = ""
+        # 当前消息的内容
+        pending = ""
+        resp_event_id = None
+        sent_event_ids = []
+        last_edit_time = 0.0
+        finish_reason = None
+        try:
+            async for chunk in platform.create_chat_completion_stream(self, event):
+                resp_content += chunk.content
+                pending += chunk.content
+                finish_reason = chunk.finish_reason or finish_reason
+                while max_message_size > 0 and json_size(pending) > max_message_size:
+                    part, pending = cut_stream(pending, max_message_size)
+                    resp_event_id = await self.send_markdown(event, part, edits=resp_event_id)
+                    if resp_event_id not in sent_event_ids:
+                        sent_event_ids.append(resp_event_id)
+                    resp_event_id = None
+                if not pending.strip():
+                    continue
+                if resp_event_id is None:
+                    # 第一段内容到达, 关闭typing提示并立即发送
+                    if not sent_event_ids:
+                        await self.counted_client.set_typing(event.room_id, timeout=0)
+                    first_content = TextMessageEventContent(msgtype=MessageType.TEXT, body=pending)
+                    await self.send_limiter.acquire()
+                    with stage("send"):
+                        resp_event_id = await event.respond(first_content,
+                                                            in_thread=self.config['reply_in_thread'])
+                    sent_event_ids.append(resp_event_id)
+                    await self.cache_response(event, resp_event_id, first_content)
+                    last_edit_time = time.monotonic()
+                elif time.monotonic() - last_edit_time >= edit_interval:
+                    # 中间的编辑只发送纯文本, 避免每次都渲染markdown
+                    await self.send_limiter.acquire()
+                    with stage("send"):
+                        await event.respond(TextMessageEventContent(msgtype=MessageType.TEXT, body=pending),
+                                            edits=resp_event_id)
+                    last_edit_time = time.monotonic()
+        except asyncio.CancelledError:
+            # 请求被取消时撤回已经发送的部分回复, 避免留下过时的回答
+            await self.redact_responses(event, sent_event_ids, "request cancelled")
+            raise
+        self.log.debug(f"流式发送结果 {resp_content}, {finish_reason}")
+        if route is not None and self.router.needs_fallback(route, resp_content, finish_reason):
+            # 快速模型的回答被截断或者为空, 撤回后由大模型重新回答
+            await self.redact_responses(event, sent_event_ids, "answered by a larger model")
+            await self.counted_client.set_typing(event.room_id, timeout=99999)
+            return True
+        await self.counted_client.set_typing(event.room_id, timeout=0)
+
+        if not sent_event_ids:
+            # 没有收到任何内容, 通常是接口调用失败
+            await self.send_status(event, f"Something went wrong: {finish_reason}", reply=False)
+            return False
+        # 最终编辑, 渲染完整的markdown内容
+        if resp_event_id is not None:
+            await self.send_markdown(event, pending, edits=resp_event_id)
+        return False
+
+    """
+        撤回已经发送的回复, 撤回失败只记录日志
+    """
+
+    async def redact_responses(self, event: MessageEvent, event_ids: List[EventID], reason: str) -> None:
+        for event_id in event_ids:
+            try:
+                await self.counted_client.redact(event.room_id, event_id, reason=reason)
+            except Exception as e:
+                self.log.warning(f"failed to redact response {event_id}: {e}")
+
+    """
+        快速模型的回答需要重新生成时使用的大模型
+        请求在大模型平台的调度器位置中进行, 快速模型的位置已经释放, 两者是同一个平台时不会等待自己
+    """
+
+    def get_fallback_route(self, route: Route) -> Route:
+        large = self.router.get_route("large", "fallback")
+        self.metrics.record_fallback()
+        self.log.debug(f"falling back from {route.platform} {route.model} to {large.platform} {large.model}")
+        return large
+
+    """
+        渲染markdown并发送一条消息, edits不为空时编辑这条消息, 返回消息的event_id
+        发送前等待发送速率限制, 发送的内容同步到会话缓存和会话存储
+    """
+
+    async def send_markdown(self, event: MessageEvent, text: str, edits: Optional[EventID] = None) -> EventID:
+        with stage("render"):
+            formatted_body = await self.markdown_renderer.render(text)
+        response = TextMessageEventContent(msgtype=MessageType.TEXT, body=text, format=Format.HTML,
+                                           formatted_body=formatted_body)
+        await self.send_limiter.acquire()
+        with stage("send"):
+            if edits is None:
+                resp_event_id = await event.respond(response, in_thread=self.config['reply_in_thread'])
+            else:
+                await event.respond(response, edits=edits)
+                resp_event_id = edits
+        if edits is None:
+            await self.cache_response(event, resp_event_id, response)
+            return resp_event_id
+        cached_response = self.conversation_cache.get_event(event.room_id, resp_event_id)
+        if cached_response:
+            cached_response.content.body = text
+        self.retriever.add(event.room_id, resp_event_id, self.client.mxid, text, int(time.time() * 1000))
+        if self.conversation_store is not None:
+            try:
+                await self.conversation_store.update_text(event.room_id, resp_event_id, text,
+                                                          self.get_ai_platform().token_counter.count(text))
+            except Exception as e:
+                self.log.warning(f"failed to store event {resp_event_id}: {e}")
+        return resp_event_id
+
+    """
+        将机器人自己发送的回复加入会话缓存
+    """
+
+    async def cache_response(self, event: MessageEvent, resp_event_id: EventID,
+                             content: TextMessageEventContent) -> None:
+        resp_event = BaseMessageEvent(type=EventType.ROOM_MESSAGE, room_id=event.room_id, event_id=resp_event_id,
+                                      sender=self.client.mxid, timestamp=int(time.time() * 1000), content=content)
+        self.conversation_cache.add_event(resp_event)
+        await self.store_event(resp_event)
+        self.index_event(resp_event)
+
+    """
+        把文本消息保存到会话存储中, 编辑消息更新原消息的内容
+        保存失败只记录日志, 不影响消息的处理
+    """
+
+    async def store_event(self, event: MessageEvent) -> None:
+        if self.conversation_store is None or not isinstance(event.content, TextMessageEventContent):
+            return
+        try:
+            token_counter = self.get_ai_platform().token_counter
+            if event.content.relates_to.rel_type == RelationType.REPLACE:
+                await self.conversation_store.update_text(event.room_id, event.content.get_edit(),
+                                                          event.content.body, token_counter.count(event.content.body))
+            else:
+                await self.conversation_store.add_turn(
+                    ConversationTurn.from_event(event, self.client.mxid, token_counter.count_event(event)))
+        except Exception as e:
+            self.log.warning(f"failed to store event {event.event_id}: {e}")
+
+    """
+        把文本消息加入检索索引, 编辑消息更新原消息的向量
+    """
+
+    def index_event(self, event: MessageEvent) -> None:
+        if not self.retriever.enable or not isinstance(event.content, TextMessageEventContent) or \
+                not event.content.msgtype.is_text:
+            return
+        event_id = event.content.get_edit() or event.event_id
+        self.retriever.add(event.room_id, event_id, event.sender, event.content.body, event.timestamp)
+
+    """
+        消息被撤回时从会话缓存中移除
+    """
+
+    @event.on(EventType.ROOM_REDACTION)
+    async def on_redaction(self, event: RedactionEvent) -> None:
+        self.conversation_cache.redact(event.room_id, event.redacts)
+        request = self.in_flight.get_by_event(event.room_id, event.redacts)
+        if request is not None and self.config['cancel']['on_redaction']:
+            self.in_flight.cancel(request, "redacted")
+        if self.conversation_store is not None:
+            try:
+                await self.conversation_store.delete_turn(event.room_id, event.redacts)
+            except Exception as e:
+                self.log.warning(f"failed to delete event {event.redacts} from the store: {e}")
+        await self.retriever.remove(event.room_id, event.redacts)
+
+    """
+        聊天室成员变化(改名, 加入, 离开)时更新显示名称缓存
+    """
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def on_member(self, event: StateEvent) -> None:
+        displayname = event.content.displayname if event.content.membership == Membership.JOIN else None
+        self.displayname_cache.update(event.room_id, event.state_key, displayname)
+        self.trigger.on_member_event(event)
+
+    """
+        Prometheus格式的指标, 地址为 <maubot地址>/_matrix/maubot/plugin/<实例id>/metrics
+        配置了metrics.token时需要 Authorization: Bearer <token>
+    """
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, request: Request) -> Response:
+        token = self.config['metrics']['token']
+        if token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return Response(status=401, text="401: Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+        return Response(text=self.metrics.render_prometheus(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    def get_ai_platform(self) -> Platform:
+        return self.platform_registry.get(self.config.cur_platform)
+
+    """
+        创建平台实例, 由平台注册表在需要时调用, 提供者的模块在第一次使用时导入
+    """
+
+    def create_ai_platform(self, use_platform: str, http: ClientSession) -> Platform:
+        key, provider = resolve_platform(self.config['platforms'], use_platform)
+        return provider.load()(self.config, http, key)
 
     """
         父命令
@@ -147,6 +758,12 @@ class AiBotPlugin(AbsExtraConfigPlugin):
         show_infos.append(f"bot name: {self.get_bot_name()}\n\n")
         # 查询当前使用的ai平台
         show_infos.append(f"platform: {self.get_cur_platform()}\n\n")
+        try:
+            _, provider = resolve_platform(self.config['platforms'], self.config.cur_platform)
+        except ValueError as e:
+            await event.reply(f"invalid platform {self.config.cur_platform}: {e}")
+            return
+        show_infos.append(f"provider: {provider.name}\n\n")
         show_infos.append("platform detail: \n\n")
         # 查询当前ai平台的配置信息
         p_m_dict = dict(self.config['platforms'][self.get_cur_platform()])
@@ -154,10 +771,81 @@ class AiBotPlugin(AbsExtraConfigPlugin):
             show_infos.append(f"- {k}: {v}\n")
         # 当前使用的model
         show_infos.append(f"\nmodel: {self.config.cur_model}\n")
+        # 本地平台显示模型是否已经加载
+        try:
+            loaded = await self.get_ai_platform().is_model_loaded()
+        except Exception as e:
+            self.log.debug(f"failed to query model state: {e}")
+            loaded = None
+        if loaded is not None:
+            show_infos.append(f"\nmodel loaded: {'yes' if loaded else 'no'}\n")
+        # 开启路由时显示快速模型和大模型
+        if self.router.enable:
+            show_infos.append("\nrouting:\n\n")
+            for tier in ("fast", "large"):
+                route = self.router.get_route(tier, "info")
+                show_infos.append(f"- {tier}: {route.platform} {route.model or self.platform_registry.get(route.platform).model}\n")
         # TODO 列出model信息
         await event.reply("".join(show_infos), markdown=True)
         pass
 
+    @ai_command.subcommand(help="View the request queue of each platform")
+    async def queue(self, event: MessageEvent) -> None:
+        stats = self.scheduler.stats()
+        if not stats:
+            await event.reply("no request has been scheduled yet")
+            return
+        show_infos = []
+        for backend, s in stats.items():
+            show_infos.append(f"- {backend}: active {s['active']}/{s['max_concurrency']}, "
+                              f"queue depth {s['queue_depth']}, "
+                              f"avg wait {s['avg_wait']:.2f}s, max wait {s['max_wait']:.2f}s\n")
+        await event.reply("".join(show_infos), markdown=True)
+
+    @ai_command.subcommand(help="View your remaining request and token budget")
+    async def quota(self, event: MessageEvent) -> None:
+        if not self.rate_limiter.is_limited(event.sender):
+            await event.reply("your requests are not limited")
+            return
+        remaining = self.rate_limiter.remaining(event.sender, event.room_id)
+        if not remaining:
+            await event.reply("no limit is configured")
+            return
+        period = format_duration(self.rate_limiter.period)
+        show_infos = [f"budget per {period}, refilled continuously:\n\n"]
+        for scope, kind, left, capacity in remaining:
+            show_infos.append(f"- {scope} {kind}: {int(left)} / {int(capacity)}\n")
+        await event.reply("".join(show_infos), markdown=True)
+
+    @ai_command.subcommand(help="View recent latency percentiles and token throughput")
+    async def stats(self, event: MessageEvent) -> None:
+        requests = self.metrics.requests
+        if not requests:
+            await event.reply("no message has been handled yet")
+            return
+        show_infos = [f"requests: {', '.join(f'{status} {count}' for status, count in requests.items())}\n\n"]
+        if self.metrics.latency.count:
+            latency = dict(self.metrics.latency.quantiles())
+            show_infos.append(f"latency: p50 {latency[0.5]:.2f}s, p95 {latency[0.95]:.2f}s, "
+                              f"p99 {latency[0.99]:.2f}s\n\n")
+            show_infos.append("stages (p50 / p95):\n\n")
+            for name, summary in self.metrics.stages.items():
+                quantiles = dict(summary.quantiles())
+                show_infos.append(f"- {name}: {quantiles[0.5]:.3f}s / {quantiles[0.95]:.3f}s\n")
+            calls = dict(self.metrics.homeserver_calls.quantiles())
+            show_infos.append(f"\nhomeserver calls per request: p50 {calls[0.5]:.0f}, p95 {calls[0.95]:.0f}\n\n")
+        if self.metrics.tokens:
+            show_infos.append("tokens:\n\n")
+            for (platform, model), tokens in self.metrics.tokens.items():
+                tokens_per_second = dict(tokens.tokens_per_second.quantiles()).get(0.5, 0.0)
+                show_infos.append(f"- {platform} {model}: {tokens.requests} requests, "
+                                  f"prompt {tokens.prompt_tokens}, completion {tokens.completion_tokens}, "
+                                  f"p50 {tokens_per_second:.1f} tokens/s\n")
+        if self.metrics.routes:
+            routes = ', '.join(f'{tier} ({reason}) {count}' for (tier, reason), count in self.metrics.routes.items())
+            show_infos.append(f"\nroutes: {routes}, fallbacks {self.metrics.fallbacks}\n")
+        await event.reply("".join(show_infos), markdown=True)
+
     """
         获取实际平台名称
     """
@@ -169,8 +857,7 @@ class AiBotPlugin(AbsExtraConfigPlugin):
     @command.argument("argus")
     async def platform(self, event: MessageEvent, argus: str):
         if argus == 'list':
-            p_dict = dict(self.config['platforms'])
-            platforms = [f"- {platform}" for platform in set(p_dict.keys())]
+            platforms = [f"- {platform}" for platform in list_platforms(self.config['platforms'])]
             await event.reply("\n".join(platforms))
             pass
         if argus == 'current':
@@ -182,9 +869,13 @@ class AiBotPlugin(AbsExtraConfigPlugin):
     async def model(self, event: MessageEvent, argus: str):
         # 如果是list表示查看当前可以使用的模型列表
         if argus == 'list':
-            platform = self.get_ai_platform()
-            models = await platform.list_models()
-            await event.reply("\n".join(models), markdown=True)
+            # 从模型目录中读取, 目录还没有加载时直接获取
+            try:
+                models = await self.model_catalog.load(self.config.cur_platform)
+            except ModelCatalogError as e:
+                await event.reply(str(e))
+                return
+            await event.reply("\n".join(m.describe() for m in models), markdown=True)
             pass
         # 如果是current，显示出当前的使用模型
         if argus == 'current':
@@ -194,12 +885,17 @@ class AiBotPlugin(AbsExtraConfigPlugin):
     @ai_command.subcommand(help="switch model in platform")
     @command.argument("argus")
     async def use(self, event: MessageEvent, argus: str):
-        platform = self.get_ai_platform()
-        # 获取模型列表，判断使用的模型是否存在于列表中
-        models = await platform.list_models()
-        if f"- {argus}" in models:
+        # 判断使用的模型是否存在于模型目录中
+        try:
+            has_model = await self.model_catalog.has_model(self.config.cur_platform, argus)
+        except ModelCatalogError as e:
+            await event.reply(str(e))
+            return
+        if has_model:
             self.log.debug(f"switch model: {argus}")
             self.config.cur_model = argus
+            self.platform_registry.invalidate(self.config.cur_platform)
+            self.model_warmer.warm_up_in_background(self.config.cur_platform)
             await event.react("✅")
         else:
             await event.reply("not found valid model")
@@ -207,36 +903,38 @@ class AiBotPlugin(AbsExtraConfigPlugin):
     @ai_command.subcommand(help="switch platform")
     @command.argument("argus")
     async def switch(self, event: MessageEvent, argus: str):
-        # 判断是否是本地ai模型，如果是还需要解析#后的type
-        if argus == 'local_ai':
-            await event.reply("local ai platform has ollama and lmstudio. "
-                              "you can type `!ai use local_ai#{type}`. "
-                              "Example: local_ai#ollama")
-            pass
-        if argus == 'local_ai#ollama' or argus == 'local_ai#lmstudio':
-            if argus == self.config.cur_platform:
-                await event.reply(f"current ai platform has be {argus}")
-                pass
-            else:
-                self.config.cur_platform = argus
-                self.config.cur_model = self.config['platforms'][argus.split("#")[0]]['model']
-                await event.react("✅")
-        # 如果是openai或者是claude
-        elif argus == 'openai' or argus == 'anthropic':
-            if argus == self.config.cur_platform:
-                await event.reply(f"current ai platform has be {argus}")
-                pass
-            else:
-                self.config.cur_platform = argus
-                # 使用配置的默认模型
-                self.config.cur_model = self.config['platforms'][argus]['model']
-                await event.react("✅")
-        else:
+        platforms = self.config['platforms']
+        # 本地平台还需要指定#后的type
+        if argus in platforms and platforms[argus].get('type'):
+            local_types = [name for name, provider in PROVIDERS.items() if provider.local]
+            await event.reply(f"{argus} platform has {' and '.join(local_types)}. "
+                              f"you can type `!ai switch {argus}#{{type}}`. "
+                              f"Example: {argus}#{platforms[argus]['type']}")
+            return
+        try:
+            resolve_platform(platforms, argus)
+        except ValueError as e:
+            self.log.debug(f"invalid platform {argus}: {e}")
             await event.reply(f"nof found ai platform: {argus}")
-            pass
+            return
+        if argus == self.config.cur_platform:
+            await event.reply(f"current ai platform has be {argus}")
+            return
+        self.platform_registry.invalidate(self.config.cur_platform)
+        self.config.cur_platform = argus
+        # 使用配置的默认模型
+        self.config.cur_model = platforms[argus.split("#")[0]]['model']
+        self.model_warmer.warm_up_in_background(self.config.cur_platform)
+        await event.react("✅")
+        if self.model_catalog.get_models(self.config.cur_platform) is None:
+            self.model_catalog.refresh_in_background(self.config.cur_platform)
         self.log.debug(f"switch platform: {self.config.cur_platform}")
         self.log.debug(f"use default config model: {self.config.cur_model}")
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
+
+    @classmethod
+    def get_db_upgrade_table(cls) -> UpgradeTable:
+        return upgrade_table
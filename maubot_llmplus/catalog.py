@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+from maubot_llmplus.platforms import ModelInfo
+from maubot_llmplus.providers import is_valid_platform
+from maubot_llmplus.registry import PlatformRegistry
+
+"""
+    模型列表获取失败, 并且没有之前获取的目录时抛出
+"""
+
+
+class ModelCatalogError(Exception):
+    pass
+
+
+"""
+    模型目录
+    启动时获取当前平台的模型列表, 之后在后台定时刷新, 命令直接从目录中读取, 不再同步请求平台接口
+    目录还没有加载(例如后端启动时不可用)时, 命令直接获取一次, 失败时报告最后一次的错误
+"""
+
+
+class ModelCatalog:
+    registry: PlatformRegistry
+    log: logging.Logger
+    refresh_interval: float
+    models: Dict[str, List[ModelInfo]]
+    names: Dict[str, Set[str]]
+    updated_at: Dict[str, float]
+    errors: Dict[str, str]
+    refreshing: Dict[str, asyncio.Task]
+    task: Optional[asyncio.Task]
+
+    def __init__(self, registry: PlatformRegistry, log: logging.Logger, refresh_interval: float) -> None:
+        self.registry = registry
+        self.log = log
+        self.refresh_interval = refresh_interval
+        self.models = {}
+        self.names = {}
+        self.updated_at = {}
+        self.errors = {}
+        self.refreshing = {}
+        self.task = None
+
+    """
+        定时刷新的平台名称(cur_platform格式): 当前使用的平台和已经加载过目录的平台
+        其他平台在切换时才加载, 插件启动时不需要导入没有使用的后端
+    """
+
+    def get_platform_names(self) -> List[str]:
+        names = [self.registry.config.cur_platform]
+        names.extend(name for name in self.models if name not in names)
+        return [name for name in names if is_valid_platform(self.registry.config['platforms'], name)]
+
+    async def refresh(self, name: str) -> None:
+        try:
+            models = await self.registry.get(name).fetch_models()
+        except Exception as e:
+            # 获取失败时保留上一次的目录
+            self.log.warning(f"failed to refresh model catalog of {name}: {e}")
+            self.errors[name] = str(e) or type(e).__name__
+            return
+        self.errors.pop(name, None)
+        self.models[name] = models
+        self.names[name] = {m.name for m in models}
+        self.updated_at[name] = time.time()
+
+    """
+        在后台刷新某个平台的目录, 同一个平台同时只有一个刷新任务
+    """
+
+    def refresh_in_background(self, name: str) -> asyncio.Task:
+        task = self.refreshing.get(name)
+        if task is None or task.done():
+            task = self.refreshing[name] = asyncio.create_task(self.refresh(name))
+        return task
+
+    async def refresh_all(self) -> None:
+        await asyncio.gather(*(self.refresh_in_background(name) for name in self.get_platform_names()))
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        self.stop()
+        self.task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for task in self.refreshing.values():
+            task.cancel()
+        self.refreshing.clear()
+
+    """
+        获取平台的模型列表, 目录还没有加载时返回None
+    """
+
+    def get_models(self, name: str) -> Optional[List[ModelInfo]]:
+        return self.models.get(name)
+
+    """
+        获取平台的模型列表, 目录还没有加载时直接获取(与后台刷新共用同一个任务), 获取失败时抛出ModelCatalogError
+    """
+
+    async def load(self, name: str) -> List[ModelInfo]:
+        if name not in self.models:
+            # 调用方被取消时不取消刷新任务
+            await asyncio.shield(self.refresh_in_background(name))
+        models = self.models.get(name)
+        if models is None:
+            raise ModelCatalogError(f"failed to load the model list of {name}: "
+                                    f"{self.errors.get(name, 'the refresh was cancelled')}")
+        return models
+
+    """
+        判断模型是否存在于平台的目录中, 目录还没有加载时先获取
+    """
+
+    async def has_model(self, name: str, model: str) -> bool:
+        await self.load(name)
+        return model in self.names[name]
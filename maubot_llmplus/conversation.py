@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+
+from mautrix.types import MessageEvent, RoomID, EventID, RelationType, TextMessageEventContent, MessageType
+
+# 机器人发送的状态提示(排队, 繁忙, 错误)内容中的标记字段, 这些消息不是回答, 不加入上下文, 会话存储和检索索引
+STATUS_NOTICE = "cn.tayxie.llmplus.status"
+
+"""
+    创建一条带有状态提示标记的通知消息
+"""
+
+
+def make_status_notice(text: str) -> TextMessageEventContent:
+    content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=text)
+    content[STATUS_NOTICE] = True
+    return content
+
+
+def is_status_notice(evt: MessageEvent) -> bool:
+    return isinstance(evt.content, TextMessageEventContent) and evt.content.get(STATUS_NOTICE) is True
+
+"""
+    单个聊天室的会话缓存
+    timeline: 按时间顺序保存的房间消息, 仅在backfilled之后或者有history_token时才是连续的
+    fetched: 通过get_event单独获取的历史消息(回复链), 不参与时间线排序
+    backfilled: 历史消息已经获取完成(到达房间的开始或者获取的上限)
+    history_token: 历史消息获取到一半时, 继续向前获取最早的已缓存消息之前的消息的分页token
+"""
+
+
+class RoomConversation:
+    timeline: OrderedDict
+    fetched: OrderedDict
+    backfilled: bool
+    history_token: Optional[str]
+
+    def __init__(self) -> None:
+        self.timeline = OrderedDict()
+        self.fetched = OrderedDict()
+        self.backfilled = False
+        self.history_token = None
+
+    def get_event(self, event_id: EventID) -> Optional[MessageEvent]:
+        return self.timeline.get(event_id) or self.fetched.get(event_id)
+
+
+"""
+    按聊天室缓存会话消息, 用于构建聊天上下文时减少对homeserver的请求
+    超过max_rooms时淘汰最久未使用的聊天室, 每个聊天室最多保留max_messages条消息
+"""
+
+
+class ConversationCache:
+    max_rooms: int
+    max_messages: int
+    rooms: OrderedDict
+
+    def __init__(self, max_rooms: int, max_messages: int) -> None:
+        self.max_rooms = max_rooms
+        self.max_messages = max_messages
+        self.rooms = OrderedDict()
+
+    def _get_room(self, room_id: RoomID, create: bool = True) -> Optional[RoomConversation]:
+        room = self.rooms.get(room_id)
+        if room is None:
+            if not create:
+                return None
+            room = self.rooms[room_id] = RoomConversation()
+            # 淘汰最久未使用的聊天室
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room_id)
+        return room
+
+    def _trim(self, events: OrderedDict) -> None:
+        while len(events) > self.max_messages:
+            events.popitem(last=False)
+
+    """
+        时间线超过上限时淘汰最早的消息, 之后分页token不再紧接在最早的已缓存消息之前
+    """
+
+    def _trim_timeline(self, room: RoomConversation) -> None:
+        if len(room.timeline) > self.max_messages:
+            self._trim(room.timeline)
+            room.history_token = None
+
+    """
+        加入一条实时收到的消息, 编辑消息会更新被编辑的原消息
+    """
+
+    def add_event(self, evt: MessageEvent) -> None:
+        relates_to = evt.content.relates_to
+        if relates_to and relates_to.rel_type == RelationType.REPLACE:
+            self.apply_edit(evt)
+            return
+        room = self._get_room(evt.room_id)
+        if evt.event_id in room.timeline:
+            return
+        room.fetched.pop(evt.event_id, None)
+        room.timeline[evt.event_id] = evt
+        self._trim_timeline(room)
+
+    """
+        加入一条通过get_event获取的历史消息
+    """
+
+    def add_fetched_event(self, evt: MessageEvent) -> None:
+        room = self._get_room(evt.room_id)
+        if evt.event_id in room.timeline:
+            return
+        room.fetched[evt.event_id] = evt
+        self._trim(room.fetched)
+
+    """
+        加入从homeserver获取的, 紧接在已缓存消息之前的历史消息(按时间顺序)
+        只有在获取完成(set_backfilled)或者记录了分页token(set_history_token)之后, 时间线才视为连续的
+    """
+
+    def add_history(self, room_id: RoomID, events: List[MessageEvent]) -> None:
+        room = self._get_room(room_id)
+        timeline = OrderedDict((e.event_id, e) for e in events if e.event_id not in room.timeline)
+        timeline.update(room.timeline)
+        room.timeline = timeline
+        self._trim_timeline(room)
+
+    """
+        记录继续获取更早的历史消息的分页token, token之后的消息都已经加入时间线
+    """
+
+    def set_history_token(self, room_id: RoomID, token: Optional[str]) -> None:
+        room = self._get_room(room_id)
+        room.history_token = token
+
+    def set_backfilled(self, room_id: RoomID) -> None:
+        room = self._get_room(room_id)
+        room.backfilled = True
+        room.history_token = None
+
+    def get_event(self, room_id: RoomID, event_id: EventID) -> Optional[MessageEvent]:
+        room = self._get_room(room_id, create=False)
+        if room is None:
+            return None
+        return room.get_event(event_id)
+
+    """
+        获取某条消息之前的所有消息, 从新到旧排列
+        如果时间线还不连续或者没有这条消息, 返回None, 需要从homeserver获取
+    """
+
+    def get_events_before(self, room_id: RoomID, event_id: EventID) -> Optional[List[MessageEvent]]:
+        room = self._get_room(room_id, create=False)
+        if room is None or not room.backfilled or event_id not in room.timeline:
+            return None
+        return self._events_before(room, event_id)
+
+    def _events_before(self, room: RoomConversation, event_id: EventID) -> List[MessageEvent]:
+        events = []
+        found = False
+        for cached_id in reversed(room.timeline):
+            if found:
+                events.append(room.timeline[cached_id])
+            elif cached_id == event_id:
+                found = True
+        return events
+
+    """
+        历史消息获取到一半时, 返回某条消息之前已缓存的消息(从新到旧排列)和继续获取的分页token
+        没有分页token或者没有这条消息时返回None
+    """
+
+    def get_partial_history(self, room_id: RoomID,
+                            event_id: EventID) -> Optional[Tuple[List[MessageEvent], str]]:
+        room = self._get_room(room_id, create=False)
+        if room is None or room.history_token is None or event_id not in room.timeline:
+            return None
+        return self._events_before(room, event_id), room.history_token
+
+    """
+        用编辑后的内容替换原消息的内容, 保留原消息的关联关系
+    """
+
+    def apply_edit(self, evt: MessageEvent) -> None:
+        room = self._get_room(evt.room_id, create=False)
+        if room is None:
+            return
+        original = room.get_event(evt.content.get_edit())
+        if original is None:
+            return
+        original.content.body = evt.content.body
+        original.content.msgtype = evt.content.msgtype
+        if getattr(evt.content, 'format', None):
+            original.content.format = evt.content.format
+            original.content.formatted_body = evt.content.formatted_body
+
+    def redact(self, room_id: RoomID, event_id: EventID) -> None:
+        room = self._get_room(room_id, create=False)
+        if room is None:
+            return
+        room.timeline.pop(event_id, None)
+        room.fetched.pop(event_id, None)
+
+    def clear(self) -> None:
+        self.rooms.clear()
@@ -0,0 +1,26 @@
+from mautrix.util.async_db import UpgradeTable, Connection
+
+from maubot_llmplus.quota import create_rate_limit_table
+from maubot_llmplus.store import create_conversation_tables, create_conversation_sync_table
+
+"""
+    插件数据库的表结构升级, 每次修改表结构时在末尾注册一个新的版本, 已经发布的版本不能调整顺序
+    表结构定义在使用这些表的模块中, 这里只决定升级的顺序
+"""
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Conversation turns")
+async def upgrade_v1(conn: Connection) -> None:
+    await create_conversation_tables(conn)
+
+
+@upgrade_table.register(description="Rate limit buckets")
+async def upgrade_v2(conn: Connection) -> None:
+    await create_rate_limit_table(conn)
+
+
+@upgrade_table.register(description="Conversation sync positions")
+async def upgrade_v3(conn: Connection) -> None:
+    await create_conversation_sync_table(conn)
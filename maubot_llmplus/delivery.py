@@ -0,0 +1,296 @@
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import commonmark
+from mautrix.util import markdown
+from mautrix.util.markdown import HtmlEscapingRenderer
+
+"""
+    长回复的发送
+    超过大小上限的回复在段落和代码块的边界拆分为多条消息, 较大的回复在工作线程中渲染markdown,
+    发送速度由令牌桶限制, 避免触发homeserver的速率限制
+"""
+
+FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+
+"""
+    文本在事件JSON中的大小(字节), 与mautrix发送时的json.dumps一致, 非ASCII字符会被转义
+    按字符累加, 拼接后的大小等于各部分之和
+"""
+
+
+def json_size(text: str) -> int:
+    return len(json.dumps(text)) - 2
+
+
+"""
+    根据一行内容更新围栏代码块的状态, fence为当前代码块的开始围栏, 不在代码块中时为None
+"""
+
+
+def update_fence(fence: Optional[str], line: str) -> Optional[str]:
+    match = FENCE.match(line)
+    if match is None:
+        return fence
+    if fence is None:
+        return match.group(1)
+    # 结束围栏与开始围栏使用相同的字符, 长度不小于开始围栏, 后面没有其他内容
+    marker = match.group(1)
+    if marker[0] == fence[0] and len(marker) >= len(fence) and not line.strip()[len(marker):].strip():
+        return None
+    return fence
+
+
+"""
+    把markdown按块拆分, 块为段落或者完整的围栏代码块, 块之间为空行
+"""
+
+
+def markdown_blocks(text: str) -> List[str]:
+    blocks = []
+    lines = []
+    fence = None
+    for line in text.split("\n"):
+        if fence is None and not line.strip():
+            if lines:
+                blocks.append("\n".join(lines))
+                lines = []
+            continue
+        fence = update_fence(fence, line)
+        lines.append(line)
+    if lines:
+        blocks.append("\n".join(lines))
+    return blocks
+
+
+"""
+    把超过limit的一行拆分, 优先在空格处断开, 没有空格时(例如中文)按字符断开
+"""
+
+
+def split_line(line: str, limit: int) -> List[str]:
+    pieces = []
+    while json_size(line) > limit:
+        size = 0
+        end = 0
+        for end, char in enumerate(line):
+            size += json_size(char)
+            if size > limit:
+                break
+        space = line.rfind(" ", 0, end)
+        if space > 0:
+            end = space
+        pieces.append(line[:max(end, 1)])
+        line = line[max(end, 1):].lstrip(" ")
+    pieces.append(line)
+    return pieces
+
+
+"""
+    把超过limit的块按行拆分, 代码块的每一部分都重新加上开始和结束的围栏
+"""
+
+
+def split_block(block: str, limit: int) -> List[str]:
+    if json_size(block) <= limit:
+        return [block]
+    lines = block.split("\n")
+    opening = closing = ""
+    match = FENCE.match(lines[0])
+    if match:
+        opening = lines[0] + "\n"
+        lines = lines[1:]
+        if lines and FENCE.match(lines[-1]):
+            lines = lines[:-1]
+        closing = "\n" + match.group(1)
+    overhead = json_size(opening) + json_size(closing)
+    limit = max(limit - overhead, 1)
+    pieces = []
+    current = []
+    current_size = 0
+    for line in lines:
+        for part in split_line(line, limit):
+            part_size = json_size(part) + (json_size("\n") if current else 0)
+            if current and current_size + part_size > limit:
+                pieces.append(opening + "\n".join(current) + closing)
+                current = []
+                current_size = 0
+                part_size = json_size(part)
+            current.append(part)
+            current_size += part_size
+    if current:
+        pieces.append(opening + "\n".join(current) + closing)
+    return pieces
+
+
+"""
+    把markdown拆分为多个不超过max_size字节的部分, 只在段落和代码块的边界拆分,
+    单个段落或代码块超过上限时才在块内按行拆分
+"""
+
+
+def split_markdown(text: str, max_size: int) -> List[str]:
+    if max_size <= 0 or json_size(text) <= max_size:
+        return [text]
+    separator = json_size("\n\n")
+    chunks = []
+    current = []
+    current_size = 0
+    for block in markdown_blocks(text):
+        for piece in split_block(block, max_size):
+            piece_size = json_size(piece) + (separator if current else 0)
+            if current and current_size + piece_size > max_size:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_size = 0
+                piece_size = json_size(piece)
+            current.append(piece)
+            current_size += piece_size
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+"""
+    流式响应中当前消息超过max_size时, 找到结束当前消息的位置, text[:位置]不超过max_size
+    优先在代码块之外的空行处结束, 其次在完整的一行结束, 单行超过上限时在行内结束
+"""
+
+
+def find_cut(text: str, max_size: int) -> int:
+    fence = None
+    size = 0
+    position = 0
+    paragraph_end = 0
+    line_end = 0
+    # 最后一行可能还没有接收完整, 只在完整的行之后结束
+    for line in text.split("\n")[:-1]:
+        size += json_size(line)
+        if size > max_size:
+            break
+        if fence is None and not line.strip() and position > 0:
+            paragraph_end = position - 1
+        fence = update_fence(fence, line)
+        position += len(line) + 1
+        line_end = position - 1
+        size += json_size("\n")
+    if paragraph_end > 0:
+        return paragraph_end
+    if line_end > 0:
+        return line_end
+    return len(split_line(text, max_size)[0])
+
+
+"""
+    文本结束时仍未关闭的围栏代码块的开始行, 不在代码块中时为None
+"""
+
+
+def open_fence(text: str) -> Optional[str]:
+    fence = None
+    opening = None
+    for line in text.split("\n"):
+        updated = update_fence(fence, line)
+        if fence is None and updated is not None:
+            opening = line
+        fence = updated
+    return opening if fence is not None else None
+
+
+"""
+    流式响应中结束当前消息, 返回(当前消息的内容, 剩余的内容)
+    在围栏代码块内结束时, 与split_markdown一样给当前消息加上结束围栏, 剩余的内容重新加上开始围栏
+"""
+
+
+def cut_stream(text: str, max_size: int) -> Tuple[str, str]:
+    cut = find_cut(text, max_size)
+    opening = open_fence(text[:cut])
+    if opening is not None:
+        # 为结束围栏预留空间后重新查找结束位置
+        closing = "\n" + FENCE.match(opening).group(1)
+        cut = find_cut(text, max(max_size - json_size(closing), 1))
+        opening = open_fence(text[:cut])
+    if opening is None:
+        return text[:cut], text[cut:].lstrip("\n")
+    head = text[:cut]
+    if head.split("\n")[-1] == opening:
+        # 代码块从最后一行开始, 整个代码块留给下一条消息
+        start = head.rfind("\n")
+        if start > 0:
+            return text[:start], text[start:].lstrip("\n")
+        return head, text[cut:].lstrip("\n")
+    rest = text[cut:]
+    if rest.startswith("\n"):
+        rest = rest[1:]
+    return head + "\n" + FENCE.match(opening).group(1), opening + "\n" + rest
+
+
+"""
+    markdown渲染
+    长度达到offload_size的文本在单独的工作线程中渲染, 避免阻塞事件循环
+    mautrix的渲染器是模块级共享的, 工作线程使用自己的解析器和渲染器, 只有一个工作线程, 不会并发使用
+"""
+
+
+class MarkdownRenderer:
+    offload_size: int
+    executor: ThreadPoolExecutor
+
+    def __init__(self, offload_size: int) -> None:
+        self.offload_size = offload_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llmplus-markdown")
+        self.parser = commonmark.Parser()
+        self.renderer = HtmlEscapingRenderer()
+
+    def _render(self, text: str) -> str:
+        return self.renderer.render(self.parser.parse(text))
+
+    async def render(self, text: str) -> str:
+        if self.offload_size <= 0 or len(text) < self.offload_size:
+            return markdown.render(text)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._render, text)
+
+    def stop(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+"""
+    发送消息的令牌桶, 每秒最多rate条消息, 最多连续发送burst条
+    rate为0时不限制
+"""
+
+
+class SendLimiter:
+    rate: float
+    burst: int
+    tokens: float
+    updated: float
+    lock: Optional[asyncio.Lock]
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # 按到达顺序等待, 同一时间只有一个等待者计算令牌
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.updated = time.monotonic()
+            self.tokens -= 1
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from typing import Dict, Tuple, Iterable, Optional
+
+from mautrix.client import Client
+from mautrix.types import RoomID, UserID
+
+"""
+    用户显示名称缓存, 按(聊天室, 用户)缓存, 超过ttl秒后重新获取
+    优先使用聊天室中的成员状态(每个聊天室可以有不同的显示名称), 没有时使用用户的全局显示名称
+    同一个(聊天室, 用户)同时只有一个请求, 并发的调用等待同一个结果
+    收到m.room.member事件时使对应的缓存失效
+"""
+
+
+class DisplaynameCache:
+    client: Client
+    ttl: float
+    max_entries: int
+    entries: Dict[Tuple[RoomID, UserID], Tuple[str, float]]
+    pending: Dict[Tuple[RoomID, UserID], asyncio.Task]
+
+    def __init__(self, client: Client, ttl: float, max_entries: int) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.pending = {}
+
+    async def get_displayname(self, room_id: RoomID, user_id: UserID) -> str:
+        key = (room_id, user_id)
+        cached = self.entries.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.create_task(self.fetch(room_id, user_id))
+            task.add_done_callback(lambda t: self.on_fetched(key, t))
+        # 一个调用方被取消时不取消其他调用方等待的请求
+        return await asyncio.shield(task)
+
+    async def fetch(self, room_id: RoomID, user_id: UserID) -> str:
+        state_store = getattr(self.client, 'state_store', None)
+        if state_store is not None:
+            member = await state_store.get_member(room_id, user_id)
+            if member is not None and member.displayname:
+                return member.displayname
+        return (await self.client.get_displayname(user_id) or
+                self.client.parse_user_id(user_id)[0])
+
+    """
+        请求完成后写入缓存, 请求期间缓存被invalidate时丢弃结果
+    """
+
+    def on_fetched(self, key: Tuple[RoomID, UserID], task: asyncio.Task) -> None:
+        if self.pending.get(key) is not task:
+            return
+        del self.pending[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        now = time.monotonic()
+        if len(self.entries) >= self.max_entries:
+            self._prune(now)
+        self.entries[key] = (task.result(), now + self.ttl)
+
+    """
+        并发获取多个用户的显示名称
+    """
+
+    async def resolve(self, room_id: RoomID, user_ids: Iterable[UserID]) -> Dict[UserID, str]:
+        user_ids = list(set(user_ids))
+        displaynames = await asyncio.gather(*(self.get_displayname(room_id, u) for u in user_ids))
+        return dict(zip(user_ids, displaynames))
+
+    """
+        收到成员事件时直接使用事件中的显示名称, 没有显示名称(例如离开聊天室)时使缓存失效
+    """
+
+    def update(self, room_id: RoomID, user_id: UserID, displayname: Optional[str]) -> None:
+        self.invalidate(room_id, user_id)
+        if displayname:
+            self.entries[(room_id, user_id)] = (displayname, time.monotonic() + self.ttl)
+
+    def invalidate(self, room_id: RoomID, user_id: UserID) -> None:
+        self.entries.pop((room_id, user_id), None)
+        self.pending.pop((room_id, user_id), None)
+
+    def _prune(self, now: float) -> None:
+        self.entries = {k: v for k, v in self.entries.items() if v[1] > now}
+        # 仍然超过上限时清空, 避免无限增长
+        if len(self.entries) >= self.max_entries:
+            self.entries.clear()
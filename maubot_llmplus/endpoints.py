@@ -0,0 +1,260 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import List, Optional, Callable, Awaitable, TypeVar, AsyncGenerator, Iterable
+
+from aiohttp import ClientSession
+
+T = TypeVar("T")
+
+"""
+    后端返回了表示失败的结果(例如非200的状态码), 在后端池内部用于记录失败, 不会抛出到调用方
+"""
+
+
+class FailedResponse(Exception):
+    def __init__(self, result) -> None:
+        super().__init__("failed response")
+        self.result = result
+
+"""
+    平台的一个请求地址, 记录延迟, 进行中的请求数和熔断状态
+"""
+
+
+class Endpoint:
+    url: str
+    in_flight: int
+    latency: Optional[float]
+    latencies: deque
+    failures: int
+    open_until: float
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        # 延迟的指数移动平均, 没有样本时为None
+        self.latency = None
+        self.latencies = deque(maxlen=200)
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        # 熔断期间不可用, 熔断时间结束后允许再次尝试(半开)
+        return self.open_until <= time.monotonic()
+
+    @property
+    def score(self) -> float:
+        return (self.latency or 0.0) * (self.in_flight + 1)
+
+    def p95(self, min_samples: int) -> Optional[float]:
+        if len(self.latencies) < min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+
+"""
+    多地址后端池
+    按观测到的延迟和进行中的请求数选择地址, 连续失败的地址会被熔断并在recovery_time秒后自动恢复,
+    请求失败(连接错误或者表示失败的结果)时依次换到其他地址重试, 流式请求只在返回第一段内容之前重试,
+    开启hedge时, 超过p95延迟仍未完成的请求会同时发送到另一个地址, 使用先完成的结果
+"""
+
+
+class EndpointPool:
+    endpoints: List[Endpoint]
+    failure_threshold: int
+    recovery_time: float
+    hedge: bool
+    hedge_min_samples: int
+    health_task: Optional[asyncio.Task]
+
+    def __init__(self, urls: Iterable[str], failure_threshold: int = 3, recovery_time: float = 30,
+                 hedge: bool = False, hedge_min_samples: int = 20) -> None:
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.health_task = None
+
+    def select(self, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e not in exclude]
+        if not candidates:
+            return None
+        available = [e for e in candidates if e.available]
+        if not available:
+            # 全部被熔断时选择最先恢复的地址
+            return min(candidates, key=lambda e: e.open_until)
+        return min(available, key=lambda e: e.score)
+
+    def record_success(self, endpoint: Endpoint, latency: Optional[float]) -> None:
+        endpoint.failures = 0
+        endpoint.open_until = 0.0
+        if latency is not None:
+            endpoint.latencies.append(latency)
+            endpoint.latency = latency if endpoint.latency is None else endpoint.latency * 0.8 + latency * 0.2
+
+    def record_failure(self, endpoint: Endpoint) -> None:
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            endpoint.open_until = time.monotonic() + self.recovery_time
+
+    async def _run(self, endpoint: Endpoint, request: Callable[[Endpoint], Awaitable[T]],
+                   failed: Optional[Callable[[T], bool]]) -> T:
+        endpoint.in_flight += 1
+        start = time.monotonic()
+        try:
+            result = await request(endpoint)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.record_failure(endpoint)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        if failed is not None and failed(result):
+            self.record_failure(endpoint)
+            raise FailedResponse(result)
+        self.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    """
+        通过选择的地址发送请求, request参数为选择的地址
+        failed判断返回的结果是否表示失败, 失败的结果和异常一样计入熔断并换到其他地址重试, 不作为对冲请求的结果,
+        所有地址都失败时返回最后一个失败的结果或者抛出最后一个异常
+    """
+
+    async def request(self, request: Callable[[Endpoint], Awaitable[T]],
+                      failed: Optional[Callable[[T], bool]] = None) -> T:
+        try:
+            return await self._request(request, failed)
+        except FailedResponse as e:
+            return e.result
+
+    async def _request(self, request: Callable[[Endpoint], Awaitable[T]],
+                       failed: Optional[Callable[[T], bool]]) -> T:
+        endpoint = self.select()
+        hedge_delay = endpoint.p95(self.hedge_min_samples) if self.hedge and len(self.endpoints) > 1 else None
+        if hedge_delay is None:
+            return await self._run_with_failover(endpoint, request, failed)
+
+        first = asyncio.create_task(self._run(endpoint, request, failed))
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+        second_endpoint = self.select(exclude=(endpoint,))
+        second = asyncio.create_task(self._run(second_endpoint, request, failed))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # 两个请求都失败时返回第一个请求的失败结果或者抛出它的异常
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    """
+        依次尝试每个地址, 直到一个地址成功或者所有地址都失败
+    """
+
+    async def _run_with_failover(self, endpoint: Endpoint, request: Callable[[Endpoint], Awaitable[T]],
+                                 failed: Optional[Callable[[T], bool]]) -> T:
+        tried = [endpoint]
+        while True:
+            try:
+                return await self._run(endpoint, request, failed)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if len(tried) >= len(self.endpoints):
+                    raise
+            endpoint = self.select(exclude=tried)
+            tried.append(endpoint)
+
+    """
+        通过选择的地址发送流式请求, 以收到第一段内容的时间作为延迟
+        failed判断片段是否表示失败(例如非200的状态码), 有失败的片段时整个请求计为失败
+        返回第一段内容之前失败时换到其他地址重试, 之后失败不再重试, 避免调用方收到重复的内容
+    """
+
+    async def stream(self, request: Callable[[Endpoint], AsyncGenerator[T, None]],
+                     failed: Optional[Callable[[T], bool]] = None) -> AsyncGenerator[T, None]:
+        tried = []
+        while True:
+            endpoint = self.select(exclude=tried)
+            tried.append(endpoint)
+            can_retry = len(tried) < len(self.endpoints)
+            endpoint.in_flight += 1
+            start = time.monotonic()
+            latency = None
+            failure = False
+            yielded = False
+            try:
+                async with aclosing(request(endpoint)) as chunks:
+                    async for chunk in chunks:
+                        if failed is not None and failed(chunk):
+                            if not yielded and can_retry:
+                                raise FailedResponse(chunk)
+                            failure = True
+                        elif latency is None:
+                            latency = time.monotonic() - start
+                        yielded = True
+                        yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                self.record_failure(endpoint)
+                if yielded or not can_retry:
+                    raise
+                continue
+            finally:
+                endpoint.in_flight -= 1
+            if failure:
+                self.record_failure(endpoint)
+            else:
+                self.record_success(endpoint, latency)
+            return
+
+    """
+        后台定时检查所有地址, 用于熔断地址的自动恢复
+    """
+
+    def start_health_checks(self, http: ClientSession, path: str, headers: dict, interval: float,
+                            log: logging.Logger) -> None:
+        self.stop_health_checks()
+        if interval > 0 and len(self.endpoints) > 1:
+            self.health_task = asyncio.create_task(self._health_loop(http, path, headers, interval, log))
+
+    def stop_health_checks(self) -> None:
+        if self.health_task:
+            self.health_task.cancel()
+            self.health_task = None
+
+    async def _health_loop(self, http: ClientSession, path: str, headers: dict, interval: float,
+                           log: logging.Logger) -> None:
+        while True:
+            await asyncio.gather(*(self._check(http, e, path, headers, log) for e in self.endpoints))
+            await asyncio.sleep(interval)
+
+    async def _check(self, http: ClientSession, endpoint: Endpoint, path: str, headers: dict,
+                     log: logging.Logger) -> None:
+        try:
+            async with http.get(f"{endpoint.url}{path}", headers=headers) as response:
+                healthy = response.status < 500
+        except Exception as e:
+            log.debug(f"health check of {endpoint.url} failed: {e}")
+            healthy = False
+        if healthy:
+            # 健康检查的延迟不代表推理延迟, 只用于恢复熔断
+            self.record_success(endpoint, None)
+        else:
+            self.record_failure(endpoint)
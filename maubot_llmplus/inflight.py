@@ -0,0 +1,71 @@
+import asyncio
+import time
+from typing import Dict, Hashable, Optional, Tuple, List
+
+from mautrix.types import RoomID, EventID, MessageEvent
+
+"""
+    一个进行中的请求, event为提示消息, reason为取消的原因, 没有被取消时为None
+    burst_start为这一组连续消息中第一条消息的开始时间, debouncing表示正在等待更多的消息
+    coalesced为合并到这个请求中的较早的消息, 按时间顺序排列
+"""
+
+
+class InFlightRequest:
+    key: Hashable
+    event: MessageEvent
+    task: asyncio.Task
+    reason: Optional[str]
+    burst_start: float
+    debouncing: bool
+    coalesced: List[MessageEvent]
+
+    def __init__(self, key: Hashable, event: MessageEvent, task: asyncio.Task) -> None:
+        self.key = key
+        self.event = event
+        self.task = task
+        self.reason = None
+        self.burst_start = time.monotonic()
+        self.debouncing = False
+        self.coalesced = []
+
+
+"""
+    进行中的请求, 按会话(聊天室, 发送者, thread)和提示消息登记
+    提示消息被编辑或撤回, 或者同一个用户发送了新的消息时取消请求,
+    取消处理消息的任务会同时取消正在进行的后端请求和调度器中的位置
+"""
+
+
+class InFlightTracker:
+    by_key: Dict[Hashable, InFlightRequest]
+    by_event: Dict[Tuple[RoomID, EventID], InFlightRequest]
+
+    def __init__(self) -> None:
+        self.by_key = {}
+        self.by_event = {}
+
+    def register(self, key: Hashable, event: MessageEvent) -> InFlightRequest:
+        request = InFlightRequest(key, event, asyncio.current_task())
+        self.by_key[key] = request
+        self.by_event[(event.room_id, event.event_id)] = request
+        return request
+
+    def unregister(self, request: InFlightRequest) -> None:
+        if self.by_key.get(request.key) is request:
+            del self.by_key[request.key]
+        event_key = (request.event.room_id, request.event.event_id)
+        if self.by_event.get(event_key) is request:
+            del self.by_event[event_key]
+
+    def get(self, key: Hashable) -> Optional[InFlightRequest]:
+        return self.by_key.get(key)
+
+    def get_by_event(self, room_id: RoomID, event_id: EventID) -> Optional[InFlightRequest]:
+        return self.by_event.get((room_id, event_id))
+
+    def cancel(self, request: InFlightRequest, reason: str) -> None:
+        if request.reason is None:
+            request.reason = reason
+            request.task.cancel()
+        self.unregister(request)
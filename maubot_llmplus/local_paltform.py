@@ -1,31 +1,53 @@
+import asyncio
 import json
+import re
 
-from typing import List
+from typing import List, AsyncGenerator, Tuple, Optional, Union
 
 from aiohttp import ClientSession
 
-from mautrix.types import MessageEvent
 from mautrix.util.config import BaseProxyConfig
 
 import maubot_llmplus
 import maubot_llmplus.platforms
-from maubot_llmplus.platforms import Platform, ChatCompletion
-from maubot_llmplus.plugin import AbsExtraConfigPlugin
+from maubot_llmplus.platforms import Platform, ChatCompletion, ChatCompletionChunk, ModelInfo
 
 
-class Ollama(Platform):
+"""
+    把keep_alive配置转换为秒数, 支持数字(秒)和30s, 10m, 1h形式的字符串, 负数表示一直保留
+    没有配置或者无法解析时返回None
+"""
+
 
-    def __init__(self, config: BaseProxyConfig, http: ClientSession) -> None:
-        super().__init__(config, http)
+def parse_duration(value: Union[str, int, float, None]) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*([smh]?)\s*", str(value))
+    if match is None:
+        return None
+    return int(float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)])
 
-    async def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
-        full_context = []
-        context = await maubot_llmplus.platforms.get_context(plugin, self, evt)
-        full_context.extend(list(context))
 
-        endpoint = f"{self.url}/api/chat"
-        req_body = {'model': self.model, 'messages': full_context, 'stream': False}
+class Ollama(Platform):
+    health_path = "/api/tags"
+    keep_alive: Union[str, int, None]
+
+    def __init__(self, config: BaseProxyConfig, http: ClientSession, key: Optional[str] = None) -> None:
+        super().__init__(config, http, key)
+        # 模型在最后一次请求之后保留在内存中的时间, 为空时使用ollama的默认值
+        self.keep_alive = self.config.get('keep_alive')
+
+    def get_chat_request(self, full_context: list, stream: bool) -> Tuple[str, dict, dict]:
+        path = "/api/chat"
+        req_body = {'model': self.model, 'messages': full_context, 'stream': stream}
+        if self.keep_alive not in (None, ''):
+            req_body['keep_alive'] = self.keep_alive
         headers = {'Content-Type': 'application/json'}
+        return path, headers, req_body
+
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
         async with self.http.post(endpoint, headers=headers, json=req_body) as response:
             # plugin.log.debug(f"响应内容：{response.status}, {await response.json()}")
             if response.status != 200:
@@ -37,17 +59,95 @@ class Ollama(Platform):
             response_json = await response.json()
             return ChatCompletion(
                 message=response_json['message'],
-                finish_reason='success',
-                model=response_json['model']
+                finish_reason=response_json.get('done_reason', 'success'),
+                model=response_json['model'],
+                usage=maubot_llmplus.platforms.get_usage(response_json.get('prompt_eval_count'),
+                                                         response_json.get('eval_count'))
             )
 
-    async def list_models(self) -> List[str]:
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        async with self.http.post(endpoint, headers=headers, json=req_body) as response:
+            if response.status != 200:
+                yield ChatCompletionChunk(content='', finish_reason=f"http status {response.status}", error=True)
+                return
+            # ollama的流式响应为NDJSON, 每行一个json对象, 最后一行done为true并带有token用量
+            async for data in maubot_llmplus.platforms.iter_ndjson(response):
+                yield ChatCompletionChunk(
+                    content=data.get('message', {}).get('content', ''),
+                    finish_reason=data.get('done_reason', 'success') if data.get('done') else None,
+                    model=data.get('model'),
+                    usage=maubot_llmplus.platforms.get_usage(data.get('prompt_eval_count'), data.get('eval_count'))
+                )
+
+    async def fetch_models(self) -> List[ModelInfo]:
         full_url = f"{self.url}/api/tags"
         async with self.http.get(full_url) as response:
             if response.status != 200:
                 return []
             response_data = await response.json()
-            return [f"- {model['model']}" for model in response_data['models']]
+            models = [ModelInfo(name=model['model'], size=model.get('size'),
+                                details={k: v for k, v in (model.get('details') or {}).items()
+                                         if k in ('parameter_size', 'quantization_level')})
+                      for model in response_data['models']]
+        # 上下文长度需要通过/api/show逐个查询
+        context_lengths = await asyncio.gather(*(self.fetch_context_length(m.name) for m in models),
+                                               return_exceptions=True)
+        for model, context_length in zip(models, context_lengths):
+            if isinstance(context_length, int):
+                model.context_length = context_length
+        return models
+
+    async def fetch_context_length(self, model: str) -> Optional[int]:
+        full_url = f"{self.url}/api/show"
+        async with self.http.post(full_url, json={'model': model}) as response:
+            if response.status != 200:
+                return None
+            response_data = await response.json()
+            for k, v in (response_data.get('model_info') or {}).items():
+                if k.endswith('.context_length'):
+                    return v
+            return None
+
+    """
+        不带提示词调用/api/generate时ollama只加载模型, 同时按keep_alive设置保留时间
+    """
+
+    async def warm_up(self) -> bool:
+        req_body = {'model': self.model}
+        if self.keep_alive not in (None, ''):
+            req_body['keep_alive'] = self.keep_alive
+
+        async def load(url: str) -> bool:
+            async with self.http.post(f"{url}/api/generate", json=req_body) as response:
+                return response.status == 200
+
+        results = await asyncio.gather(*(load(e.url) for e in self.endpoints.endpoints), return_exceptions=True)
+        return any(result is True for result in results)
+
+    async def is_model_loaded(self) -> Optional[bool]:
+        async with self.http.get(f"{self.url}/api/ps") as response:
+            if response.status != 200:
+                return None
+            response_data = await response.json()
+        # 没有指定tag的模型名称对应latest
+        names = {self.model, self.model if ':' in self.model else f"{self.model}:latest"}
+        return any(names & {m.get('name'), m.get('model')} for m in response_data.get('models') or [])
+
+    """
+        /api/embeddings每次只转换一段文本, 多段文本同时请求
+    """
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        url = self.url
+
+        async def embed_one(text: str) -> List[float]:
+            async with self.http.post(f"{url}/api/embeddings", json={'model': model, 'prompt': text}) as response:
+                if response.status != 200:
+                    raise ValueError(f"http status {response.status}")
+                return (await response.json())['embedding']
+
+        return list(await asyncio.gather(*(embed_one(text) for text in texts)))
 
     def get_type(self) -> str:
         return "local_ai"
@@ -55,20 +155,25 @@ class Ollama(Platform):
 
 class LmStudio(Platform) :
     temperature: int
+    ttl: Optional[int]
 
-    def __init__(self, config: BaseProxyConfig, http: ClientSession) -> None:
-        super().__init__(config, http)
+    def __init__(self, config: BaseProxyConfig, http: ClientSession, key: Optional[str] = None) -> None:
+        super().__init__(config, http, key)
         self.temperature = self.config['temperature']
+        # lmstudio按需加载的模型在空闲ttl秒后卸载, 由keep_alive配置转换, 负数表示不设置ttl
+        ttl = parse_duration(self.config.get('keep_alive'))
+        self.ttl = ttl if ttl is not None and ttl > 0 else None
         pass
 
-    async def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
-        full_context = []
-        context = await maubot_llmplus.platforms.get_context(plugin, self, evt)
-        full_context.extend(list(context))
-
-        endpoint = f"{self.url}/v1/chat/completions"
+    def get_chat_request(self, full_context: list, stream: bool) -> Tuple[str, dict, dict]:
+        path = "/v1/chat/completions"
         headers = {"content-type": "application/json"}
-        req_body = {"model": self.model, "messages": full_context, "temperature": self.temperature, "stream": False}
+        req_body = {"model": self.model, "messages": full_context, "temperature": self.temperature, "stream": stream}
+        if self.ttl is not None:
+            req_body["ttl"] = self.ttl
+        return path, headers, req_body
+
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
         async with self.http.post(
                 endpoint, headers=headers, data=json.dumps(req_body)
         ) as response:
@@ -81,19 +186,66 @@ class LmStudio(Platform) :
                 )
             response_json = await response.json()
             choice = response_json["choices"][0]
+            usage = response_json.get("usage") or {}
             return ChatCompletion(
                 message=choice["message"],
                 finish_reason=choice["finish_reason"],
-                model=choice.get("model", None)
+                model=choice.get("model", None),
+                usage=maubot_llmplus.platforms.get_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
             )
 
-    async def list_models(self) -> List[str]:
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        async with self.http.post(
+                endpoint, headers=headers, data=json.dumps(req_body)
+        ) as response:
+            if response.status != 200:
+                yield ChatCompletionChunk(content='', finish_reason=f"Error: {await response.text()}",
+                                          error=True)
+                return
+            async for chunk in maubot_llmplus.platforms.iter_openai_stream(response):
+                yield chunk
+
+    async def fetch_models(self) -> List[ModelInfo]:
         full_url = f"{self.url}/v1/models"
         async with self.http.get(full_url) as response:
             if response.status != 200:
                 return []
             response_data = await response.json()
-            return [f"- {m['id']}" for m in response_data["data"]]
+            return [ModelInfo(name=m['id']) for m in response_data["data"]]
+
+    """
+        lmstudio没有单独的加载接口, 生成一个token使模型按需加载
+    """
+
+    async def warm_up(self) -> bool:
+        path, headers, req_body = self.get_chat_request([{"role": "user", "content": "hi"}], False)
+        req_body["max_tokens"] = 1
+
+        async def load(url: str) -> bool:
+            async with self.http.post(f"{url}{path}", headers=headers, data=json.dumps(req_body)) as response:
+                return response.status == 200
+
+        results = await asyncio.gather(*(load(e.url) for e in self.endpoints.endpoints), return_exceptions=True)
+        return any(result is True for result in results)
+
+    """
+        通过lmstudio的REST接口查询模型状态, 旧版本没有这个接口时返回None
+    """
+
+    async def is_model_loaded(self) -> Optional[bool]:
+        async with self.http.get(f"{self.url}/api/v0/models/{self.model}") as response:
+            if response.status != 200:
+                return None
+            response_data = await response.json()
+        return response_data.get('state') == 'loaded'
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        async with self.http.post(f"{self.url}/v1/embeddings", json={'model': model, 'input': texts}) as response:
+            if response.status != 200:
+                raise ValueError(f"Error: {await response.text()}")
+            response_data = await response.json()
+        return [item['embedding'] for item in sorted(response_data['data'], key=lambda item: item['index'])]
 
     def get_type(self) -> str:
         return "local_ai"
@@ -0,0 +1,267 @@
+import contextvars
+import functools
+import inspect
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple, List, Iterator
+
+"""
+    热路径指标
+    每个消息在处理期间持有一个RequestMetrics, 通过contextvar记录各阶段耗时和homeserver调用次数,
+    处理完成后汇总到Metrics中, 以Prometheus文本格式输出
+    这里不使用prometheus_client, 插件重新加载时全局注册表中的同名指标会冲突
+"""
+
+# 请求的各个阶段, 按处理顺序排列
+STAGES = ["should_respond", "debounce", "route", "queue", "context", "backend", "render", "send"]
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class RequestMetrics:
+    start: float
+    stages: Dict[str, float]
+    homeserver_calls: int
+    tokens: int
+
+    def __init__(self) -> None:
+        self.start = time.monotonic()
+        self.stages = defaultdict(float)
+        self.homeserver_calls = 0
+        # 这个请求的后端调用使用的token数(提示词和回复), 用于速率限制
+        self.tokens = 0
+
+
+current_request: contextvars.ContextVar = contextvars.ContextVar("llmplus_current_request", default=None)
+
+
+def add_stage(name: str, duration: float) -> None:
+    request = current_request.get()
+    if request is not None:
+        request.stages[name] += duration
+
+
+"""
+    记录with块的耗时到当前请求的阶段中, 没有当前请求时不记录
+"""
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        add_stage(name, time.monotonic() - start)
+
+
+def count_homeserver_call() -> None:
+    request = current_request.get()
+    if request is not None:
+        request.homeserver_calls += 1
+
+
+"""
+    统计插件自己发出的homeserver请求数
+    转发到实际的client, 每次调用client的协程方法计为一次请求
+    不修改共享的client和插件的self.client, 只有热路径中通过这个对象发出的请求被统计
+"""
+
+
+class CountingClient:
+    wrapped: Any
+
+    def __init__(self, wrapped) -> None:
+        self.wrapped = wrapped
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.wrapped, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def counted(*args, **kwargs):
+            count_homeserver_call()
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+"""
+    摘要指标, 累计次数和总和, 分位数按最近window个样本计算
+"""
+
+
+class Summary:
+    count: int
+    sum: float
+    samples: deque
+
+    def __init__(self, window: int) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantiles(self) -> List[Tuple[float, float]]:
+        if not self.samples:
+            return []
+        samples = sorted(self.samples)
+        return [(q, samples[min(len(samples) - 1, int(len(samples) * q))]) for q in QUANTILES]
+
+
+"""
+    每个平台和模型的token统计
+"""
+
+
+class TokenStats:
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    tokens_per_second: Summary
+
+    def __init__(self, window: int) -> None:
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tokens_per_second = Summary(window)
+
+
+class Metrics:
+    window: int
+    requests: Dict[str, int]
+    latency: Summary
+    stages: Dict[str, Summary]
+    homeserver_calls: Summary
+    tokens: Dict[Tuple[str, str], TokenStats]
+    routes: Dict[Tuple[str, str], int]
+    fallbacks: int
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self.requests = defaultdict(int)
+        self.latency = Summary(window)
+        self.stages = {name: Summary(window) for name in STAGES}
+        self.homeserver_calls = Summary(window)
+        self.tokens = {}
+        self.routes = defaultdict(int)
+        self.fallbacks = 0
+
+    """
+        开始记录当前消息的处理
+    """
+
+    def start_request(self) -> RequestMetrics:
+        request = RequestMetrics()
+        current_request.set(request)
+        return request
+
+    """
+        汇总一个消息的处理结果
+        status为ignored(不需要回应), coalesced(合并到之后的消息中)或throttled(超出速率限制)时
+        只记录should_respond阶段, 其他状态记录完整的延迟和各阶段耗时
+    """
+
+    def finish_request(self, request: RequestMetrics, status: str) -> None:
+        self.requests[status] += 1
+        if status in ("ignored", "coalesced", "throttled"):
+            self.stages["should_respond"].observe(request.stages["should_respond"])
+            return
+        self.latency.observe(time.monotonic() - request.start)
+        for name, summary in self.stages.items():
+            summary.observe(request.stages[name])
+        self.homeserver_calls.observe(request.homeserver_calls)
+
+    """
+        记录一次后端调用的token数, duration为后端调用耗时, 同时计入当前请求
+    """
+
+    def record_tokens(self, platform: str, model: str, prompt_tokens: int, completion_tokens: int,
+                      duration: float) -> None:
+        request = current_request.get()
+        if request is not None:
+            request.tokens += prompt_tokens + completion_tokens
+        stats = self.tokens.get((platform, model))
+        if stats is None:
+            stats = self.tokens[(platform, model)] = TokenStats(self.window)
+        stats.requests += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        if duration > 0 and completion_tokens:
+            stats.tokens_per_second.observe(completion_tokens / duration)
+
+    """
+        记录模型路由的结果, tier为fast或large, reason为选择的依据
+    """
+
+    def record_route(self, tier: str, reason: str) -> None:
+        self.routes[(tier, reason)] += 1
+
+    def record_fallback(self) -> None:
+        self.fallbacks += 1
+
+    """
+        以Prometheus文本格式输出所有指标
+    """
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def header(name: str, metric_type: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        def summary(name: str, s: Summary, labels: Dict[str, str]) -> None:
+            for q, value in s.quantiles():
+                lines.append(f"{name}{format_labels({**labels, 'quantile': str(q)})} {value}")
+            lines.append(f"{name}_sum{format_labels(labels)} {s.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {s.count}")
+
+        header("llmplus_requests_total", "counter", "Messages handled by the bot, by result")
+        for status, count in self.requests.items():
+            lines.append(f"llmplus_requests_total{format_labels({'status': status})} {count}")
+        header("llmplus_request_duration_seconds", "summary", "Time from receiving a message to the final reply")
+        summary("llmplus_request_duration_seconds", self.latency, {})
+        header("llmplus_stage_duration_seconds", "summary", "Time spent in each stage of a request")
+        for name, s in self.stages.items():
+            summary("llmplus_stage_duration_seconds", s, {"stage": name})
+        header("llmplus_homeserver_calls", "summary", "Homeserver API calls per request")
+        summary("llmplus_homeserver_calls", self.homeserver_calls, {})
+        header("llmplus_backend_requests_total", "counter", "Backend completion requests")
+        for (platform, model), stats in self.tokens.items():
+            lines.append(f"llmplus_backend_requests_total{format_labels({'platform': platform, 'model': model})} "
+                         f"{stats.requests}")
+        header("llmplus_prompt_tokens_total", "counter", "Prompt tokens sent to the backend")
+        for (platform, model), stats in self.tokens.items():
+            lines.append(f"llmplus_prompt_tokens_total{format_labels({'platform': platform, 'model': model})} "
+                         f"{stats.prompt_tokens}")
+        header("llmplus_completion_tokens_total", "counter", "Completion tokens generated by the backend")
+        for (platform, model), stats in self.tokens.items():
+            lines.append(f"llmplus_completion_tokens_total{format_labels({'platform': platform, 'model': model})} "
+                         f"{stats.completion_tokens}")
+        header("llmplus_completion_tokens_per_second", "summary", "Completion tokens per second of backend time")
+        for (platform, model), stats in self.tokens.items():
+            summary("llmplus_completion_tokens_per_second", stats.tokens_per_second,
+                    {"platform": platform, "model": model})
+        header("llmplus_routes_total", "counter", "Messages routed to the fast or the large model, by rule")
+        for (tier, reason), count in self.routes.items():
+            lines.append(f"llmplus_routes_total{format_labels({'tier': tier, 'reason': reason})} {count}")
+        header("llmplus_route_fallbacks_total", "counter", "Fast model answers retried with the large model")
+        lines.append(f"llmplus_route_fallbacks_total {self.fallbacks}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    values = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+    return "{" + values + "}"
+
+
+def escape_label(value: Optional[str]) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
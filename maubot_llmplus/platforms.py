@@ -1,97 +1,374 @@
+import asyncio
 import json
+import time
 from collections import deque
+from contextlib import aclosing
 from datetime import datetime
-from typing import Optional, List, Generator
+from typing import Optional, List, Generator, AsyncGenerator, Tuple
 
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientResponse
 from maubot import Plugin
-from mautrix.types import MessageEvent, EncryptedEvent
+from mautrix.types import MessageEvent, EncryptedEvent, TextMessageEventContent, EventType, PaginationDirection
 
+from maubot_llmplus.endpoints import EndpointPool
+from maubot_llmplus.metrics import stage, add_stage
 from maubot_llmplus.plugin import AbsExtraConfigPlugin, Config
+from maubot_llmplus.conversation import is_status_notice
+from maubot_llmplus.store import ConversationTurn
+from maubot_llmplus.tokenizer import TokenCounter, get_token_counter
 
 """
-    AI响应对象
+    AI响应对象, usage为接口返回的token用量(prompt_tokens, completion_tokens), 接口没有返回时为None
+    接口调用失败时message为空, finish_reason为错误信息
 """
 
 
 class ChatCompletion:
-    def __init__(self, message: dict, finish_reason: str, model: Optional[str]) -> None:
+    def __init__(self, message: dict, finish_reason: str, model: Optional[str],
+                 usage: Optional[dict] = None) -> None:
         self.message = message
         self.finish_reason = finish_reason
         self.model = model
+        self.usage = usage
 
     def __eq__(self, other) -> bool:
         return self.message == other.message and self.model == other.model
 
+    @property
+    def error(self) -> bool:
+        return not self.message
+
+
+"""
+    AI流式响应片段, content为本次新增的文本, usage为本次片段携带的token用量
+    接口调用失败时error为True, finish_reason为错误信息
+"""
+
+
+class ChatCompletionChunk:
+    def __init__(self, content: str, finish_reason: Optional[str] = None, model: Optional[str] = None,
+                 usage: Optional[dict] = None, error: bool = False) -> None:
+        self.content = content
+        self.finish_reason = finish_reason
+        self.model = model
+        self.usage = usage
+        self.error = error
+
+
+"""
+    模型信息, size为字节数, context_length为模型支持的最大上下文长度, 未知时为None
+"""
+
+
+class ModelInfo:
+    def __init__(self, name: str, size: Optional[int] = None, context_length: Optional[int] = None,
+                 details: Optional[dict] = None) -> None:
+        self.name = name
+        self.size = size
+        self.context_length = context_length
+        self.details = details or {}
+
+    def describe(self) -> str:
+        infos = []
+        if self.size:
+            infos.append(f"size: {self.size / 1024 ** 3:.1f}GB")
+        if self.context_length:
+            infos.append(f"context: {self.context_length}")
+        for k, v in self.details.items():
+            infos.append(f"{k}: {v}")
+        return f"- {self.name}" + (f" ({', '.join(infos)})" if infos else "")
+
 
 class Platform:
     http: ClientSession
+    key: str
     config: dict
-    url: str
+    endpoints: EndpointPool
+    health_path: str = "/v1/models"
     api_key: str
     model: str
     max_words: int
     additional_prompt: List[dict]
     system_prompt: str
     max_context_messages: int
+    max_context_tokens: Optional[int]
+    token_counter: TokenCounter
 
-    def __init__(self, config: Config, http: ClientSession) -> None:
+    def __init__(self, config: Config, http: ClientSession, key: Optional[str] = None) -> None:
         self.http = http
-        self.config = config['platforms'][self.get_type()]
-        self.url = self.config['url']
+        # 平台配置的名称, 同一个提供者可以有多个不同名称的配置, 例如多个OpenAI兼容的服务器
+        self.key = key or self.get_type()
+        self.config = config['platforms'][self.key]
+        # url可以配置为一个地址或者地址列表, 由平台注册表替换为共享并带有健康检查的后端池
+        urls = self.config['url']
+        self.endpoints = EndpointPool([urls] if isinstance(urls, str) else urls)
         # 设置当前的使用模型，这里不直接使用config对象下的配置值，而是加入了与命令决定后的使用模型名称
-        self.model = config.cur_model
+        # 不是当前使用的平台时(例如获取模型列表), 使用平台配置的默认模型
+        if config.cur_platform.split('#')[0] == self.key:
+            self.model = config.cur_model
+        else:
+            self.model = self.config['model']
         self.max_words = self.config['max_words']
         self.api_key = self.config['api_key']
         self.max_context_messages = self.config['max_context_messages']
+        # 配置了max_context_tokens时按token数量限制上下文, 否则按单词数量(max_words)限制
+        self.max_context_tokens = self.config.get('max_context_tokens')
+        self.token_counter = get_token_counter(self.config.get('tokenizer'))
         self.additional_prompt = config['additional_prompt']
         self.system_prompt = config['system_prompt']
 
+    """
+        当前延迟最低的可用地址
+    """
+
+    @property
+    def url(self) -> str:
+        return self.endpoints.select().url
+
+    """
+        健康检查请求使用的请求头
+    """
+
+    def get_health_headers(self) -> dict:
+        return {}
+
+    """
+        获取发送给AI的消息上下文
+    """
+
+    async def get_chat_messages(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> List[dict]:
+        full_context = []
+        context = await get_context(plugin, self, evt)
+        full_context.extend(list(context))
+        return full_context
+
+    """
+        生成对话接口的请求路径, 请求头和请求体, 请求地址在发送时从后端池中选择
+    """
+
+    def get_chat_request(self, full_context: list, stream: bool) -> Tuple[str, dict, dict]:
+        raise NotImplementedError()
+
+    """
+        发送对话请求, 响应结果
+    """
+
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
+        raise NotImplementedError()
+
+    """
+        发送流式对话请求, 逐段响应结果
+        默认实现为不支持流式的平台一次性返回完整结果
+    """
+
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        chat_completion = await self.request_chat_completion(endpoint, headers, req_body)
+        yield ChatCompletionChunk(content=chat_completion.message.get('content', ''),
+                                  finish_reason=chat_completion.finish_reason,
+                                  model=chat_completion.model,
+                                  usage=chat_completion.usage,
+                                  error=chat_completion.error)
+
     """a
         调用AI对话接口, 响应结果
+        开启响应缓存时, 相同的请求直接返回缓存结果, 同时进行中的相同请求只调用一次接口
     """
 
     async def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
+        with stage("context"):
+            full_context = await self.get_chat_messages(plugin, evt)
+        path, headers, req_body = self.get_chat_request(full_context, False)
+        cache_key = plugin.response_cache.make_key(path, req_body)
+
+        async def request() -> ChatCompletion:
+            start = time.monotonic()
+            chat_completion = await self.endpoints.request(
+                lambda e: self.request_chat_completion(f"{e.url}{path}", headers, req_body),
+                failed=lambda c: c.error)
+            if chat_completion.message:
+                self.record_usage(plugin, full_context, chat_completion.message.get('content') or '',
+                                  chat_completion.usage, time.monotonic() - start)
+            return chat_completion
+
+        with stage("backend"):
+            return await plugin.response_cache.get_or_create(cache_key, request)
+
+    """
+        流式调用AI对话接口, 逐段响应结果
+        缓存命中或者相同的请求正在进行中时, 一次性返回完整结果, 否则在接收完成后写入缓存并交给等待的相同请求
+    """
+
+    async def create_chat_completion_stream(self, plugin: AbsExtraConfigPlugin,
+                                            evt: MessageEvent) -> AsyncGenerator[ChatCompletionChunk, None]:
+        with stage("context"):
+            full_context = await self.get_chat_messages(plugin, evt)
+        path, headers, req_body = self.get_chat_request(full_context, True)
+        cache_key = plugin.response_cache.make_key(path, req_body)
+        with stage("backend"):
+            cached, leader = await plugin.response_cache.claim(cache_key)
+        if cached is not None:
+            yield ChatCompletionChunk(content=cached.message.get('content') or '', finish_reason=cached.finish_reason,
+                                      model=cached.model)
+            return
+        content = ''
+        finish_reason = None
+        model = None
+        usage = {}
+        try:
+            # backend阶段只计算等待后端的时间, 不包括调用方处理片段(发送编辑消息)的时间
+            start = waiting_since = time.monotonic()
+            async for chunk in self.endpoints.stream(
+                    lambda e: self.request_chat_completion_stream(f"{e.url}{path}", headers, req_body),
+                    failed=lambda c: c.error):
+                add_stage("backend", time.monotonic() - waiting_since)
+                content += chunk.content
+                finish_reason = chunk.finish_reason or finish_reason
+                model = chunk.model or model
+                usage.update(chunk.usage or {})
+                yield chunk
+                waiting_since = time.monotonic()
+            add_stage("backend", time.monotonic() - waiting_since)
+            if content:
+                self.record_usage(plugin, full_context, content, usage, time.monotonic() - start)
+            chat_completion = ChatCompletion(message=dict(role="assistant", content=content),
+                                             finish_reason=finish_reason, model=model)
+            await plugin.response_cache.set(cache_key, chat_completion)
+        except BaseException as e:
+            # 被取消或者调用方停止读取时, 由一个等待的相同请求接替
+            plugin.response_cache.release(cache_key, leader, e)
+            raise
+        plugin.response_cache.release(cache_key, leader, chat_completion)
+
+    """
+        使用给定的消息列表调用对话接口, 不经过响应缓存, 用于生成会话摘要等内部请求
+        model为空时使用平台当前的模型
+    """
+
+    async def complete(self, messages: List[dict], model: Optional[str] = None) -> ChatCompletion:
+        path, headers, req_body = self.get_chat_request(messages, False)
+        if model:
+            req_body['model'] = model
+        return await self.endpoints.request(
+            lambda e: self.request_chat_completion(f"{e.url}{path}", headers, req_body),
+            failed=lambda c: c.error)
+
+    """
+        记录一次后端调用的token用量, 接口没有返回用量时使用平台的token计数器估算
+    """
+
+    def record_usage(self, plugin: AbsExtraConfigPlugin, full_context: list, content: str,
+                     usage: Optional[dict], duration: float) -> None:
+        usage = usage or {}
+        prompt_tokens = usage.get('prompt_tokens')
+        if prompt_tokens is None:
+            prompt_tokens = sum([self.token_counter.count(m['content']) for m in full_context])
+        completion_tokens = usage.get('completion_tokens')
+        if completion_tokens is None:
+            completion_tokens = self.token_counter.count(content)
+        plugin.metrics.record_tokens(self.key, self.model, prompt_tokens, completion_tokens, duration)
+
+    """
+        获取平台支持的模型列表及模型信息
+    """
+
+    async def fetch_models(self) -> List[ModelInfo]:
         raise NotImplementedError()
 
     async def list_models(self) -> List[str]:
-        raise NotImplementedError()
+        return [f"- {m.name}" for m in await self.fetch_models()]
+
+    """
+        在所有后端地址上预加载当前模型, 使第一个请求不需要等待模型加载
+        不支持预加载的平台(云端平台)返回False
+    """
+
+    async def warm_up(self) -> bool:
+        return False
+
+    """
+        查询当前模型是否已经加载到内存中, 无法查询时返回None
+    """
+
+    async def is_model_loaded(self) -> Optional[bool]:
+        return None
+
+    """
+        使用嵌入模型把文本转换为向量, 用于检索相关的历史消息, 不支持的平台抛出NotImplementedError
+    """
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        raise NotImplementedError(f"{self.key} does not support embeddings")
 
     def get_type(self) -> str:
         raise NotImplementedError()
 
+
+"""
+    生成token用量, 只包含接口返回的字段
+"""
+def get_usage(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> Optional[dict]:
+    usage = {}
+    if prompt_tokens is not None:
+        usage['prompt_tokens'] = prompt_tokens
+    if completion_tokens is not None:
+        usage['completion_tokens'] = completion_tokens
+    return usage or None
+
+"""
+    逐行读取Ollama的NDJSON流式响应
+"""
+async def iter_ndjson(response: ClientResponse) -> AsyncGenerator[dict, None]:
+    async for line in response.content:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+"""
+    逐个读取OpenAI/Anthropic的SSE流式响应, 只解析data字段
+"""
+async def iter_sse(response: ClientResponse) -> AsyncGenerator[dict, None]:
+    async for line in response.content:
+        line = line.decode('utf-8').strip()
+        if not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        yield json.loads(data)
+
+"""
+    将OpenAI兼容接口的SSE流式响应转换为响应片段
+"""
+async def iter_openai_stream(response: ClientResponse) -> AsyncGenerator[ChatCompletionChunk, None]:
+    async for data in iter_sse(response):
+        usage = data.get('usage') or {}
+        usage = get_usage(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+        if not data.get('choices'):
+            # 开启include_usage时, 用量在最后一个没有choices的片段中返回
+            if usage:
+                yield ChatCompletionChunk(content='', model=data.get('model'), usage=usage)
+            continue
+        choice = data['choices'][0]
+        yield ChatCompletionChunk(
+            content=(choice.get('delta') or {}).get('content') or '',
+            finish_reason=choice.get('finish_reason'),
+            model=data.get('model'),
+            usage=usage
+        )
+
 """
     获取系统提示上下文
 """
 async def get_system_context(plugin: AbsExtraConfigPlugin, platform: Platform, evt: MessageEvent) -> deque:
-    # 创建系统提示词上下文
-    system_context = deque()
-    # 生成当前时间
-    timestamp = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-    # 加入系统提示词
-    system_prompt = {"role": "system",
-                     "content": plugin.config['system_prompt'].format(name=plugin.get_bot_name(), timestamp=timestamp)}
-    if plugin.config['enable_multi_user']:
-        system_prompt["content"] += """
-            User messages are in the context of multiperson chatrooms.
-            Each message indicates its sender by prefixing the message with the sender's name followed by a colon, for example:
-            "username: hello world."
-            In this case, the user called "username" sent the message "hello world.". You should not follow this convention in your responses.
-            your response instead could be "hello username!" without including any colons, because you are the only one sending your responses there is no need to prefix them.
-            """
-    if len(system_prompt["content"]) > 0:
-        system_context.append(system_prompt)
-
-    # 添加额外的系统提示词和用户提示词
-    additional_context = json.loads(json.dumps(plugin.config['additional_prompt']))
-    if additional_context:
-        for item in additional_context:
-            system_context.append(item)
-        # 如果 消息长度已经超过了配置的消息条数，那么就抛出错误
-        if len(additional_context) > platform.max_context_messages - 1:
-            raise ValueError(f"sorry, my configuration has too many additional prompts "
-                             f"({platform.max_context_messages}) and i'll never see your message. "
-                             f"Update my config to have fewer messages and i'll be able to answer your questions!")
+    # 系统提示词和额外提示词在加载配置时已经计算好, 每个请求只复制一次
+    system_context = plugin.system_prompt.get_context()
+    additional_count = len(plugin.config['additional_prompt'] or [])
+    # 如果 消息长度已经超过了配置的消息条数，那么就抛出错误
+    if additional_count > platform.max_context_messages - 1:
+        raise ValueError(f"sorry, my configuration has too many additional prompts "
+                         f"({platform.max_context_messages}) and i'll never see your message. "
+                         f"Update my config to have fewer messages and i'll be able to answer your questions!")
     return system_context
 
 """
@@ -100,63 +377,313 @@ async def get_system_context(plugin: AbsExtraConfigPlugin, platform: Platform, e
 async def get_chat_context(system_context: deque, plugin: AbsExtraConfigPlugin, platform: Platform, evt: MessageEvent) -> deque:
     # 用户历史聊天上下文
     chat_context = deque()
-    # 计算系统提示词单词数
-    word_count = sum([len(m["content"].split()) for m in system_context])
+    # 开启会话摘要时, 已经被摘要的消息由摘要代替, 摘要作为系统提示词的一部分
+    summary_key = None
+    summary_until = 0
+    if plugin.config['summary']['enable']:
+        summary_key = get_conversation_key(plugin, evt)
+        summary = plugin.summarizer.get(summary_key)
+        if summary is not None:
+            summary_until = summary.until
+            system_context.append({"role": "system",
+                                   "content": f"Summary of the earlier conversation:\n{summary.text}"})
+    # 计算系统提示词的token数(或单词数)
+    if platform.max_context_tokens:
+        budget = platform.max_context_tokens
+        used = sum([platform.token_counter.count(m["content"]) for m in system_context])
+    else:
+        budget = platform.max_words
+        used = sum([len(m["content"].split()) for m in system_context])
     message_count = len(system_context) - 1
-    async for next_event in generate_context_messages(plugin, platform, evt):
-        # 如果不是文本类型，就跳过
-        try:
-            if not next_event.content.msgtype.is_text:
+    history = []
+    # 超出上下文限制的消息, 只在开启会话摘要时收集, 用于生成摘要
+    overflow = []
+    # 上下文填满后立即关闭生成器, 取消还没有用到的历史消息的获取和解密
+    async with aclosing(generate_context_messages(plugin, platform, evt)) as context_messages:
+        async for next_event in context_messages:
+            # 如果不是文本类型，就跳过
+            try:
+                if not next_event.content.msgtype.is_text:
+                    continue
+            except (KeyError, AttributeError):
                 continue
-        except (KeyError, AttributeError):
-            continue
+            # 机器人的状态提示(排队, 繁忙, 错误)不是对话内容
+            if is_status_notice(next_event):
+                continue
+            if summary_key is not None and next_event.timestamp <= summary_until:
+                break
+            if overflow:
+                overflow.append(next_event)
+                continue
+
+            # 计算token数(或单词数)和消息数, 每条消息的token数按event_id缓存
+            if platform.max_context_tokens:
+                used += platform.token_counter.count_event(next_event)
+            else:
+                used += len(next_event['content']['body'].split())
+            message_count += 1
+            if used >= budget or message_count >= platform.max_context_messages:
+                if summary_key is None:
+                    break
+                overflow.append(next_event)
+                continue
+            history.append(next_event)
+
+    # 检索与当前消息相关的更早的消息, 按剩余的上下文额度添加
+    retrieved = []
+    if plugin.retriever.enable:
+        candidates = await plugin.retriever.search(evt.room_id, evt.event_id, evt.sender, evt.content.body,
+                                                   evt.timestamp, history[-1].timestamp if history else evt.timestamp,
+                                                   {e.event_id for e in history})
+        for message in sorted(candidates, key=lambda m: m.score, reverse=True):
+            cost = platform.token_counter.count(message.text) if platform.max_context_tokens \
+                else len(message.text.split())
+            if used + cost >= budget:
+                continue
+            used += cost
+            retrieved.append(message)
+        retrieved.sort(key=lambda m: m.timestamp)
+
+    # 如果是允许多用户使用，那么就需要在每个历史消息前加上用户名, 所有发送者的用户名并发获取
+    displaynames = {}
+    if plugin.config['enable_multi_user']:
+        displaynames = await plugin.displayname_cache.resolve(evt.room_id, [e.sender for e in history + overflow] +
+                                                              [m.sender for m in retrieved])
+
+    # 未摘要的消息超过阈值或者超出上下文限制时, 在后台把最近keep_recent条以外的消息合并到摘要中
+    if summary_key is not None and (overflow or len(history) > plugin.config['summary']['threshold']):
+        keep_recent = max(1, min(plugin.config['summary']['keep_recent'], len(history)))
+        plugin.summarizer.schedule(summary_key, [
+            (displaynames.get(e.sender) or ('assistant' if e.sender == plugin.client.mxid else 'user'),
+             e['content']['body'], e.timestamp)
+            for e in reversed(history[keep_recent:] + overflow)
+        ])
 
+    for next_event in history:
         # 如果当前的这条历史消息是机器人自己的，那么角色就要设置为assistant
         role = 'assistant' if plugin.client.mxid == next_event.sender else 'user'
-        message = next_event['content']['body']
-        user = ''
-        # 如果是允许多用户使用，那么就需要在每个历史消息前加上用户名
-        if plugin.config['enable_multi_user']:
-            user = (await plugin.client.get_displayname(next_event.sender) or
-                    plugin.client.parse_user_id(next_event.sender)[0]) + ": "
-
-        # 计算单词量和消息数
-        word_count += len(message.split())
-        message_count += 1
-        if word_count >= platform.max_words or message_count >= platform.max_context_messages:
-            break
-        chat_context.appendleft({"role": role, "content": user + message})
+        user = displaynames[next_event.sender] + ": " if next_event.sender in displaynames else ''
+        chat_context.appendleft({"role": role, "content": user + next_event['content']['body']})
+
+    # 检索到的消息放在最新的消息之前, 最近的消息组成的前缀在请求之间保持不变
+    if retrieved:
+        lines = [f"[{datetime.fromtimestamp(m.timestamp / 1000).strftime(plugin.system_prompt.timestamp_format)}] "
+                 f"{displaynames.get(m.sender) or ('assistant' if m.sender == plugin.client.mxid else 'user')}: "
+                 f"{m.text}" for m in retrieved]
+        chat_context.insert(len(chat_context) - 1, {
+            "role": "system",
+            "content": "Earlier messages from this room that may be relevant:\n" + "\n".join(lines)
+        })
 
     return chat_context
 
+"""
+    会话的标识, 在thread中回复时每个thread是一个独立的会话
+"""
+def get_conversation_key(plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> Tuple[str, Optional[str]]:
+    thread_root = evt.content.get_thread_parent() if plugin.config['reply_in_thread'] else None
+    return evt.room_id, thread_root
+
 """
     获取总消息上下文
 """
 async def get_context(plugin: AbsExtraConfigPlugin, platform: Platform, evt: MessageEvent) -> deque:
     system_context = await get_system_context(plugin, platform, evt)
     chat_context = await get_chat_context(system_context, plugin, platform, evt)
+    # 当前时间放在最新的消息之前, 之前的内容在请求之间保持不变
+    time_message = plugin.system_prompt.get_time_message()
+    if time_message is not None and chat_context:
+        chat_context.insert(len(chat_context) - 1, time_message)
     return system_context + chat_context
 
 async def generate_context_messages(plugin: Plugin, platform: Platform, evt: MessageEvent) -> Generator[MessageEvent, None, None]:
     yield evt
-    if plugin.config['reply_in_thread']:
+    store = plugin.conversation_store
+    thread_root = evt.content.get_thread_parent()
+    # thread中的消息使用thread会话, 不在thread中时只有房间模式使用房间会话, thread模式仍然沿着回复链获取
+    if store is None or (thread_root is None and plugin.config['reply_in_thread']):
+        yielded = set()
+        if plugin.config['reply_in_thread']:
+            # debounce合并到这个请求中的较早的消息不在回复链中, 紧接在当前消息之前
+            request = plugin.in_flight.get_by_event(evt.room_id, evt.event_id)
+            for prev_evt in reversed(request.coalesced if request is not None else []):
+                yielded.add(prev_evt.event_id)
+                yield prev_evt
+        async with aclosing(generate_homeserver_messages(plugin, platform, evt,
+                                                         plugin.config['reply_in_thread'])) as prev_events:
+            async for prev_evt in prev_events:
+                if prev_evt.event_id not in yielded:
+                    yield prev_evt
+        return
+
+    limit = platform.max_context_messages * 2
+    if await store.is_backfilled(evt.room_id, thread_root):
+        # 会话已经在数据库中, 只需要一次本地的索引查询, 插件启动后第一次使用时先补全停止期间的消息
+        await store.catch_up(evt.room_id, lambda event_id, timestamp: fetch_missed_turns(plugin, evt, event_id,
+                                                                                         timestamp, limit))
+        for turn in await store.get_turns_before(evt.room_id, thread_root, evt.timestamp, limit):
+            if turn.token_count is not None and platform.max_context_tokens:
+                platform.token_counter.remember(turn.event_id, turn.text, turn.token_count)
+            yield turn.to_event()
+        return
+
+    # 第一次使用这个会话时从homeserver补全历史消息并保存
+    previous_messages = []
+    async with aclosing(generate_homeserver_messages(plugin, platform, evt, thread_root is not None)) as prev_events:
+        async for prev_evt in prev_events:
+            previous_messages.append(prev_evt)
+            if len(previous_messages) >= limit:
+                break
+    await store.backfill(evt.room_id, thread_root, [
+        ConversationTurn.from_event(e, plugin.client.mxid, None) for e in previous_messages
+        if isinstance(e, MessageEvent) and isinstance(e.content, TextMessageEventContent) and not is_status_notice(e)
+    ])
+    for prev_evt in previous_messages:
+        yield prev_evt
+
+"""
+    从homeserver获取evt之前, 最后保存的消息(event_id, timestamp)之后的文本消息, 包括thread中的消息, 最多limit条
+"""
+async def fetch_missed_turns(plugin: Plugin, evt: MessageEvent, event_id: str, timestamp: int,
+                             limit: int) -> List[ConversationTurn]:
+    turns = []
+    async with aclosing(paginate_history(plugin, evt, limit)) as pages:
+        async for page, _ in pages:
+            async with aclosing(iter_decrypted(plugin, page,
+                                               plugin.config['conversation_cache']['fetch_concurrency'])) as events:
+                async for prev_evt in events:
+                    if prev_evt.event_id == event_id or prev_evt.timestamp < timestamp:
+                        return turns
+                    if isinstance(prev_evt, MessageEvent) and isinstance(prev_evt.content, TextMessageEventContent) \
+                            and not is_status_notice(prev_evt):
+                        turns.append(ConversationTurn.from_event(prev_evt, plugin.client.mxid, None))
+    return turns
+
+"""
+    从会话缓存或homeserver获取evt之前的消息, thread为True时沿着回复链获取, 否则获取房间时间线
+"""
+async def generate_homeserver_messages(plugin: Plugin, platform: Platform, evt: MessageEvent,
+                                       thread: bool) -> Generator[MessageEvent, None, None]:
+    cache = plugin.conversation_cache
+    if thread:
         while evt.content.relates_to.in_reply_to:
-            evt = await plugin.client.get_event(room_id=evt.room_id, event_id=evt.content.get_reply_to())
+            reply_to = evt.content.get_reply_to()
+            # 优先从会话缓存中获取, 未命中时再请求homeserver
+            cached_evt = cache.get_event(evt.room_id, reply_to)
+            if cached_evt is None:
+                cached_evt = await plugin.counted_client.get_event(room_id=evt.room_id, event_id=reply_to)
+                cache.add_fetched_event(cached_evt)
+            evt = cached_evt
             yield evt
     else:
-        event_context = await plugin.client.get_event_context(room_id=evt.room_id, event_id=evt.event_id,
-                                                            limit=platform.max_context_messages * 2)
-        plugin.log.debug(f"event_context: {event_context}")
-        previous_messages = iter(event_context.events_before)
-        for evt in previous_messages:
-
-            # We already have the event, but currently, get_event_context doesn't automatically decrypt events
-            if isinstance(evt, EncryptedEvent) and plugin.client.crypto:
-                evt = await plugin.client.get_event(event_id=evt.event_id, room_id=evt.room_id)
-                if not evt:
-                    raise ValueError("Decryption error!")
+        previous_messages = cache.get_events_before(evt.room_id, evt.event_id)
+        if previous_messages is not None:
+            for prev_evt in previous_messages:
+                yield prev_evt
+            return
+        max_events = platform.max_context_messages * 2
+        from_token = None
+        cached_ids = set()
+        # 上次获取到一半时, 先使用已缓存的消息, 再从最早的已缓存消息之前继续获取
+        partial = cache.get_partial_history(evt.room_id, evt.event_id)
+        if partial is not None:
+            previous_messages, from_token = partial
+            cached_ids = {e.event_id for e in previous_messages}
+            for prev_evt in previous_messages:
+                yield prev_evt
+            max_events -= len(previous_messages)
+            if max_events <= 0:
+                cache.set_backfilled(evt.room_id)
+                return
+        # events_before是从新到旧排列的, 每条消息都紧接在已缓存的消息之前, 逐条加入缓存
+        # 每一页读取完后记录分页token, 全部获取完成后时间线才视为完整的
+        async with aclosing(paginate_history(plugin, evt, max_events, from_token)) as pages:
+            async for page, token in pages:
+                async with aclosing(iter_decrypted(plugin, page,
+                                                   plugin.config['conversation_cache']['fetch_concurrency'])) as prev_events:
+                    async for prev_evt in prev_events:
+                        # 上次在一页的中间停止时, 这一页中已缓存的消息不再重复返回
+                        if prev_evt.event_id in cached_ids:
+                            continue
+                        if isinstance(prev_evt, MessageEvent):
+                            cache.add_history(evt.room_id, [prev_evt])
+                        yield prev_evt
+                cache.set_history_token(evt.room_id, token)
+        cache.set_backfilled(evt.room_id)
 
-            yield evt
+# 历史消息的过滤器, 由homeserver过滤掉状态事件, 反应和带附件(图片, 文件)的消息, 不返回所有成员的状态
+HISTORY_FILTER = json.dumps({
+    "types": [EventType.ROOM_MESSAGE.t, EventType.ROOM_ENCRYPTED.t],
+    "contains_url": False,
+    "lazy_load_members": True,
+})
+
+"""
+    从evt开始向前分页获取房间的历史消息, 每次返回一页(从新到旧排列)和继续向前获取的分页token
+    第一页使用get_event_context, 之后通过/messages继续向前获取, 每页的大小翻倍, 最多获取max_events条消息
+    指定from_token时从from_token继续向前获取
+    调用方在上下文填满后停止读取, 不会再请求下一页
+"""
+async def paginate_history(plugin: Plugin, evt: MessageEvent, max_events: int,
+                           from_token: Optional[str] = None) -> AsyncGenerator[Tuple[List, Optional[str]], None]:
+    page_size = min(max(plugin.config['conversation_cache']['history_page_size'], 1), max_events)
+    if from_token is None:
+        # limit是前后两侧消息数的总和, 新的消息之后通常没有其他消息
+        event_context = await plugin.counted_client.get_event_context(room_id=evt.room_id, event_id=evt.event_id,
+                                                              limit=page_size * 2, filter=HISTORY_FILTER)
+        page = event_context.events_before
+        token = event_context.start
+    else:
+        messages = await plugin.counted_client.get_messages(room_id=evt.room_id, direction=PaginationDirection.BACKWARD,
+                                                    from_token=from_token, limit=page_size,
+                                                    filter_json=HISTORY_FILTER)
+        page = messages.events
+        token = messages.end
+    fetched = 0
+    while page:
+        fetched += len(page)
+        yield page, token
+        if not token or fetched >= max_events:
+            return
+        page_size = min(page_size * 2, max_events - fetched)
+        messages = await plugin.counted_client.get_messages(room_id=evt.room_id, direction=PaginationDirection.BACKWARD,
+                                                    from_token=token, limit=page_size, filter_json=HISTORY_FILTER)
+        page = messages.events
+        token = messages.end
+
+"""
+    按顺序逐条返回历史消息, 加密的消息最多concurrency条同时解密(预取)
+    调用方停止读取时取消还没有用到的解密请求, 超出上下文的消息不会被解密
+"""
+async def iter_decrypted(plugin: Plugin, events: List, concurrency: int) -> AsyncGenerator:
+    pending = iter(events)
+    # 按顺序排列的消息或者正在解密的任务
+    window = deque()
 
+    async def decrypt(encrypted_evt: EncryptedEvent) -> MessageEvent:
+        # We already have the event, but currently, get_event_context doesn't automatically decrypt events
+        decrypted_evt = await plugin.counted_client.get_event(event_id=encrypted_evt.event_id, room_id=encrypted_evt.room_id)
+        if not decrypted_evt:
+            raise ValueError("Decryption error!")
+        return decrypted_evt
 
+    def fill() -> None:
+        while len(window) < max(1, concurrency):
+            next_evt = next(pending, None)
+            if next_evt is None:
+                return
+            if isinstance(next_evt, EncryptedEvent) and plugin.client.crypto:
+                window.append(asyncio.create_task(decrypt(next_evt)))
+            else:
+                window.append(next_evt)
 
+    try:
+        fill()
+        while window:
+            item = window.popleft()
+            fill()
+            yield await item if isinstance(item, asyncio.Task) else item
+    finally:
+        for item in window:
+            if isinstance(item, asyncio.Task):
+                item.cancel()
@@ -1,10 +1,29 @@
+from typing import Optional
+
 from maubot import Plugin
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
+from maubot_llmplus.conversation import ConversationCache
+from maubot_llmplus.displayname import DisplaynameCache
+from maubot_llmplus.metrics import Metrics, CountingClient
+from maubot_llmplus.prompt import SystemPrompt
+from maubot_llmplus.retrieval import MessageRetriever
+from maubot_llmplus.store import ConversationStore
+from maubot_llmplus.summary import ConversationSummarizer
+
 
 class AbsExtraConfigPlugin(Plugin):
     default_username: str
     user_id: str
+    conversation_cache: ConversationCache
+    displayname_cache: DisplaynameCache
+    conversation_store: Optional[ConversationStore]
+    metrics: Metrics
+    # 统计homeserver请求数的client, 热路径中的homeserver请求通过它发出
+    counted_client: CountingClient
+    summarizer: ConversationSummarizer
+    system_prompt: SystemPrompt
+    retriever: MessageRetriever
 
     async def start(self) -> None:
         await super().start()
@@ -35,7 +54,28 @@ class Config(BaseProxyConfig):
         helper.copy("system_prompt")
         helper.copy("platforms")
         helper.copy("additional_prompt")
+        helper.copy("stream")
+        helper.copy("conversation_cache")
+        helper.copy("displayname_cache")
+        helper.copy("connection_pool")
+        helper.copy("scheduler")
+        helper.copy("response_cache")
+        helper.copy("model_catalog")
+        helper.copy("endpoints")
+        helper.copy("metrics")
+        helper.copy("summary")
+        helper.copy("conversation_store")
+        helper.copy("cancel")
+        helper.copy("debounce")
+        helper.copy("delivery")
+        helper.copy("warm_up")
+        helper.copy("prompt_cache")
+        helper.copy("rate_limit")
+        helper.copy("routing")
+        helper.copy("retrieval")
 
-        self.cur_platform = helper.base['use_platform'] if helper.base['use_platform'] != 'local_ai' else \
-            f"{helper.base['use_platform']}#{helper.base['platforms']['local_ai']['type']}"
+        # 配置了type的平台(例如local_ai)使用 平台#type 作为平台名称
+        use_platform = helper.base['use_platform']
+        platform_type = helper.base['platforms'][use_platform].get('type')
+        self.cur_platform = f"{use_platform}#{platform_type}" if platform_type else use_platform
         self.cur_model = helper.base['platforms'][helper.base['use_platform']]['model']
@@ -0,0 +1,81 @@
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+
+# 多用户聊天室中附加到系统提示词的说明
+MULTI_USER_PROMPT = """
+            User messages are in the context of multiperson chatrooms.
+            Each message indicates its sender by prefixing the message with the sender's name followed by a colon, for example:
+            "username: hello world."
+            In this case, the user called "username" sent the message "hello world.". You should not follow this convention in your responses.
+            your response instead could be "hello username!" without including any colons, because you are the only one sending your responses there is no need to prefix them.
+            """
+
+# timestamp_position为end时代替system_prompt中的{timestamp}
+TIMESTAMP_REFERENCE = "(see the current time given before the latest message)"
+
+"""
+    系统提示词
+    静态部分(格式化后的system_prompt, 多用户说明和额外提示词)在每次加载配置时只计算一次,
+    每个请求的上下文都以相同的内容开始, 后端可以复用前缀的KV缓存和提示词缓存
+    system_prompt中的{timestamp}按timestamp_format格式化, timestamp_position为end时当前时间作为单独的系统消息
+    放在最新的消息之前, 为inline时保留在系统提示词中
+"""
+
+
+class SystemPrompt:
+    template: str
+    bot_name: str
+    multi_user: bool
+    timestamp_format: str
+    timestamp_position: str
+    has_timestamp: bool
+    messages: List[dict]
+
+    def __init__(self, template: str, bot_name: str, multi_user: bool, additional_prompt: Optional[list],
+                 timestamp_format: str, timestamp_position: str) -> None:
+        self.template = template or ''
+        self.bot_name = bot_name
+        self.multi_user = multi_user
+        self.timestamp_format = timestamp_format
+        self.timestamp_position = timestamp_position
+        self.has_timestamp = "{timestamp}" in self.template
+        # 额外提示词转换为普通的dict, 每个请求只复制最外层
+        self.messages = [dict(item) for item in additional_prompt or []]
+        if not self.is_inline():
+            content = self.format(TIMESTAMP_REFERENCE)
+            if content:
+                self.messages.insert(0, {"role": "system", "content": content})
+
+    def is_inline(self) -> bool:
+        return self.has_timestamp and self.timestamp_position == 'inline'
+
+    def format(self, timestamp: str) -> str:
+        content = self.template.format(name=self.bot_name, timestamp=timestamp)
+        if self.multi_user:
+            content += MULTI_USER_PROMPT
+        return content
+
+    def get_timestamp(self) -> str:
+        return datetime.today().strftime(self.timestamp_format)
+
+    """
+        系统提示词和额外提示词, 返回的消息可以直接修改
+    """
+
+    def get_context(self) -> deque:
+        context = deque(dict(m) for m in self.messages)
+        if self.is_inline():
+            content = self.format(self.get_timestamp())
+            if content:
+                context.appendleft({"role": "system", "content": content})
+        return context
+
+    """
+        放在最新的消息之前的当前时间, 系统提示词中没有{timestamp}或者时间保留在系统提示词中时返回None
+    """
+
+    def get_time_message(self) -> Optional[dict]:
+        if not self.has_timestamp or self.is_inline():
+            return None
+        return {"role": "system", "content": f"Current time: {self.get_timestamp()}"}
@@ -0,0 +1,111 @@
+import importlib
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
+
+if TYPE_CHECKING:
+    from maubot_llmplus.platforms import Platform
+
+"""
+    平台提供者的声明, 提供者为实现某种接口的Platform子类
+    module中的class_name在第一次创建这个提供者的平台时才导入, 插件启动和重新加载时不加载没有使用的后端代码
+    local为True的提供者通过平台配置中的type选择, 平台名称为<平台>#<提供者>, 例如 local_ai#ollama
+"""
+
+
+class Provider:
+    name: str
+    module: str
+    class_name: str
+    local: bool
+    cls: Optional[Type['Platform']]
+
+    def __init__(self, name: str, module: str, class_name: str, local: bool = False) -> None:
+        self.name = name
+        self.module = module
+        self.class_name = class_name
+        self.local = local
+        self.cls = None
+
+    def load(self) -> Type['Platform']:
+        if self.cls is None:
+            self.cls = getattr(importlib.import_module(self.module), self.class_name)
+        return self.cls
+
+
+PROVIDERS: Dict[str, Provider] = {}
+
+"""
+    注册提供者, 其他模块可以用这个函数添加新的后端
+"""
+
+
+def register_provider(name: str, module: str, class_name: str, local: bool = False) -> Provider:
+    provider = PROVIDERS[name] = Provider(name, module, class_name, local)
+    return provider
+
+
+register_provider("openai", "maubot_llmplus.thrid_platform", "OpenAi")
+register_provider("anthropic", "maubot_llmplus.thrid_platform", "Anthropic")
+register_provider("xai", "maubot_llmplus.thrid_platform", "XAi")
+register_provider("ollama", "maubot_llmplus.local_paltform", "Ollama", local=True)
+register_provider("lmstudio", "maubot_llmplus.local_paltform", "LmStudio", local=True)
+
+"""
+    获取已注册的提供者, 配置中不能直接指定模块和类名, 新的后端需要先用register_provider注册
+"""
+
+
+def get_provider(name: str) -> Optional[Provider]:
+    return PROVIDERS.get(name)
+
+
+"""
+    解析cur_platform格式的平台名称, 返回平台配置的名称和提供者, 没有这个平台时抛出ValueError
+    <平台>#<提供者>使用平台的配置和本地提供者, 其他平台使用配置中的provider, 没有配置provider时使用与平台同名的提供者,
+    例如 vllm: {provider: openai, url: http://localhost:8000, ...} 是一个OpenAI兼容的服务器
+"""
+
+
+def resolve_platform(platforms: dict, name: str) -> Tuple[str, Provider]:
+    key, _, local_type = name.partition('#')
+    platform_config = platforms.get(key)
+    if platform_config is None:
+        raise ValueError(f"not found platform: {name}")
+    if local_type:
+        provider = PROVIDERS.get(local_type)
+        if provider is None or not provider.local:
+            raise ValueError(f"not found local platform type: {local_type}")
+        return key, provider
+    if platform_config.get('type'):
+        raise ValueError(f"platform {key} needs a type, for example {key}#{platform_config['type']}")
+    provider = get_provider(platform_config.get('provider') or key)
+    if provider is None or provider.local:
+        raise ValueError(f"not found provider of platform: {name}")
+    return key, provider
+
+
+"""
+    已配置的平台名称(cur_platform格式), 本地平台使用配置的type
+"""
+
+
+def list_platforms(platforms: dict) -> List[str]:
+    names = []
+    for key, platform_config in platforms.items():
+        if platform_config.get('type'):
+            names.append(f"{key}#{platform_config['type']}")
+        else:
+            names.append(key)
+    return names
+
+
+"""
+    平台名称是否有效, 本地平台的所有本地提供者都是有效的
+"""
+
+
+def is_valid_platform(platforms: dict, name: str) -> bool:
+    try:
+        resolve_platform(platforms, name)
+    except ValueError:
+        return False
+    return True
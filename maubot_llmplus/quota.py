@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from mautrix.util.async_db import Database, Connection
+
+# 限制的范围, 按检查顺序排列
+SCOPES = ["user", "room", "global"]
+# requests为请求数, tokens为提示词和回复的token数之和
+KINDS = ["requests", "tokens"]
+
+"""
+    令牌桶, 容量为capacity, 每秒补充rate个令牌
+    token数在请求完成之后才知道, 扣除后可能为负数, 补充到正数之前不再接受新的请求
+"""
+
+
+class TokenBucket:
+    capacity: float
+    rate: float
+    tokens: float
+    updated: float
+
+    def __init__(self, capacity: float, rate: float, tokens: Optional[float] = None,
+                 updated: Optional[float] = None) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    """
+        令牌数达到amount还需要的秒数
+    """
+
+    def wait_time(self, amount: float) -> float:
+        if self.tokens >= amount or self.rate <= 0:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+"""
+    令牌桶的表结构, 由插件数据库的升级表(db.py)按版本调用
+    scope为user, room或global, kind为requests或tokens, updated为毫秒时间戳
+"""
+
+
+async def create_rate_limit_table(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE rate_limit_bucket (
+            scope   TEXT             NOT NULL,
+            key     TEXT             NOT NULL,
+            kind    TEXT             NOT NULL,
+            tokens  DOUBLE PRECISION NOT NULL,
+            updated BIGINT           NOT NULL,
+            PRIMARY KEY (scope, key, kind)
+        )"""
+    )
+
+
+"""
+    请求超出速率限制时抛出
+"""
+
+
+class RateLimitError(Exception):
+    pass
+
+
+"""
+    超出限制的原因, retry_after为可以再次请求的秒数
+"""
+
+
+class Throttle:
+    scope: str
+    kind: str
+    retry_after: float
+
+    def __init__(self, scope: str, kind: str, retry_after: float) -> None:
+        self.scope = scope
+        self.kind = kind
+        self.retry_after = retry_after
+
+    def describe(self) -> str:
+        return f"the {self.scope} {self.kind} limit has been reached, please try again in " \
+               f"{format_duration(self.retry_after)}"
+
+
+"""
+    按用户, 聊天室和全局限制请求数和token数
+    每个限制是一个令牌桶, 在period秒内补充满, 允许一次用完全部额度
+    计数保存在内存中, 配置了数据库时每隔persist_interval秒保存一次, 插件重启后继续使用
+"""
+
+
+class RateLimiter:
+    db: Optional[Database]
+    log: logging.Logger
+    enable: bool
+    limits: Dict[str, Dict[str, float]]
+    period: float
+    exempt_users: Set[str]
+    persist_interval: float
+    buckets: Dict[Tuple[str, str, str], TokenBucket]
+    dirty: Set[Tuple[str, str, str]]
+    task: Optional[asyncio.Task]
+
+    def __init__(self, db: Optional[Database], log: logging.Logger) -> None:
+        self.db = db
+        self.log = log
+        self.enable = False
+        self.limits = {}
+        self.period = 3600
+        self.exempt_users = set()
+        self.persist_interval = 0
+        self.buckets = {}
+        self.dirty = set()
+        self.task = None
+
+    """
+        应用配置, 修改限制时保留已有的计数
+    """
+
+    def configure(self, config: dict) -> None:
+        self.enable = config['enable']
+        self.limits = {scope: {kind: (config[scope] or {}).get(kind) or 0 for kind in KINDS} for scope in SCOPES}
+        self.period = config['period']
+        self.exempt_users = set(config['exempt_users'] or [])
+        self.persist_interval = config['persist_interval']
+
+    """
+        获取令牌桶并补充令牌, 没有配置限制时返回None
+    """
+
+    def get_bucket(self, scope: str, key: str, kind: str, now: float) -> Optional[TokenBucket]:
+        capacity = self.limits[scope][kind]
+        if capacity <= 0:
+            return None
+        bucket = self.buckets.get((scope, key, kind))
+        if bucket is None:
+            bucket = self.buckets[(scope, key, kind)] = TokenBucket(capacity, capacity / self.period, updated=now)
+        bucket.capacity = capacity
+        bucket.rate = capacity / self.period
+        bucket.refill(now)
+        return bucket
+
+    @staticmethod
+    def get_keys(sender: str, room_id: str) -> List[Tuple[str, str]]:
+        return [("user", sender), ("room", room_id), ("global", "")]
+
+    def is_limited(self, sender: str) -> bool:
+        return self.enable and sender not in self.exempt_users
+
+    """
+        检查是否可以发起请求, 可以时扣除一个请求数, 超出任何一个限制时返回原因, 不扣除
+    """
+
+    def check(self, sender: str, room_id: str) -> Optional[Throttle]:
+        if not self.is_limited(sender):
+            return None
+        now = time.time()
+        requests = []
+        for scope, key in self.get_keys(sender, room_id):
+            bucket = self.get_bucket(scope, key, "requests", now)
+            if bucket is not None:
+                if bucket.tokens < 1:
+                    return Throttle(scope, "requests", bucket.wait_time(1))
+                requests.append((scope, key))
+            bucket = self.get_bucket(scope, key, "tokens", now)
+            if bucket is not None and bucket.tokens <= 0:
+                return Throttle(scope, "tokens", bucket.wait_time(1))
+        for scope, key in requests:
+            self.buckets[(scope, key, "requests")].tokens -= 1
+            self.dirty.add((scope, key, "requests"))
+        return None
+
+    """
+        请求完成后按实际用量扣除token数
+    """
+
+    def charge(self, sender: str, room_id: str, tokens: int) -> None:
+        if not self.is_limited(sender) or tokens <= 0:
+            return
+        now = time.time()
+        for scope, key in self.get_keys(sender, room_id):
+            bucket = self.get_bucket(scope, key, "tokens", now)
+            if bucket is not None:
+                bucket.tokens -= tokens
+                self.dirty.add((scope, key, "tokens"))
+
+    """
+        剩余的额度, 返回(scope, kind, 剩余, 容量)
+    """
+
+    def remaining(self, sender: str, room_id: str) -> List[Tuple[str, str, float, float]]:
+        now = time.time()
+        result = []
+        for scope, key in self.get_keys(sender, room_id):
+            for kind in KINDS:
+                bucket = self.get_bucket(scope, key, kind, now)
+                if bucket is not None:
+                    result.append((scope, kind, max(bucket.tokens, 0), bucket.capacity))
+        return result
+
+    async def load(self) -> None:
+        if self.db is None:
+            return
+        rows = await self.db.fetch("SELECT scope, key, kind, tokens, updated FROM rate_limit_bucket")
+        for row in rows:
+            scope, kind = row['scope'], row['kind']
+            if scope not in self.limits or kind not in KINDS or self.limits[scope][kind] <= 0:
+                continue
+            capacity = self.limits[scope][kind]
+            self.buckets[(scope, row['key'], kind)] = TokenBucket(capacity, capacity / self.period,
+                                                                  row['tokens'], row['updated'] / 1000)
+
+    """
+        保存有变化的令牌桶, 已经补充满的令牌桶从内存和数据库中删除
+    """
+
+    async def save(self) -> None:
+        now = time.time()
+        dirty = self.dirty
+        self.dirty = set()
+        full = []
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.is_full():
+                full.append(key)
+                del self.buckets[key]
+                dirty.discard(key)
+        if self.db is None:
+            return
+        rows = [(*key, self.buckets[key].tokens, int(self.buckets[key].updated * 1000))
+                for key in dirty if key in self.buckets]
+        if rows:
+            await self.db.executemany(
+                "INSERT INTO rate_limit_bucket (scope, key, kind, tokens, updated) VALUES ($1, $2, $3, $4, $5) "
+                "ON CONFLICT (scope, key, kind) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated",
+                rows
+            )
+        if full:
+            await self.db.executemany("DELETE FROM rate_limit_bucket WHERE scope=$1 AND key=$2 AND kind=$3", full)
+
+    async def _save_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            try:
+                await self.save()
+            except Exception as e:
+                self.log.warning(f"failed to save rate limits: {e}")
+
+    def start(self) -> None:
+        self.stop()
+        if self.persist_interval > 0:
+            self.task = asyncio.create_task(self._save_loop())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{max(int(seconds), 1)} seconds"
+    if seconds < 3600:
+        return f"{int(seconds // 60) + 1} minutes"
+    return f"{seconds / 3600:.1f} hours"
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Callable, Optional, Iterable, List
+
+from aiohttp import ClientSession, TCPConnector, ClientTimeout
+
+from maubot_llmplus.endpoints import EndpointPool
+from maubot_llmplus.platforms import Platform
+from maubot_llmplus.plugin import Config
+
+"""
+    长期持有的平台实例注册表
+    每个配置的平台只创建一个实例, 每个后端使用独立调优的连接池,
+    只有在配置变化或者切换平台/模型时才重建
+"""
+
+
+class PlatformRegistry:
+    config: Config
+    factory: Callable[[str, ClientSession], Platform]
+    platforms: Dict[str, Platform]
+    sessions: Dict[str, ClientSession]
+    endpoint_pools: Dict[str, EndpointPool]
+    # 等待关闭的旧连接池
+    retiring: Dict[asyncio.Task, List[ClientSession]]
+    log: logging.Logger
+
+    def __init__(self, config: Config, factory: Callable[[str, ClientSession], Platform],
+                 log: logging.Logger) -> None:
+        self.config = config
+        self.factory = factory
+        self.log = log
+        self.platforms = {}
+        self.sessions = {}
+        self.endpoint_pools = {}
+        self.retiring = {}
+
+    """
+        获取平台实例, 不存在时创建
+        name为cur_platform格式的平台名称, 例如 openai, local_ai#ollama
+        model不为空并且不是平台当前的模型时, 返回使用这个模型的单独实例, 与平台共享连接池和后端池
+    """
+
+    def get(self, name: str, model: Optional[str] = None) -> Platform:
+        platform = self.platforms.get(name)
+        # 当前使用的平台的模型被切换后需要重建
+        if platform is None or (name == self.config.cur_platform and platform.model != self.config.cur_model):
+            platform = self.platforms[name] = self.factory(name, self.get_session(name))
+            platform.endpoints = self.get_endpoint_pool(name, platform)
+        if not model or model == platform.model:
+            return platform
+        key = f"{name}@{model}"
+        model_platform = self.platforms.get(key)
+        if model_platform is None:
+            model_platform = self.platforms[key] = self.factory(name, self.get_session(name))
+            model_platform.model = model
+            model_platform.endpoints = self.get_endpoint_pool(name, model_platform)
+        return model_platform
+
+    """
+        获取平台的后端池, 切换模型重建平台实例时保留地址的延迟和熔断状态
+    """
+
+    def get_endpoint_pool(self, name: str, platform: Platform) -> EndpointPool:
+        pool = self.endpoint_pools.get(name)
+        if pool is None:
+            pool_config = self.config['endpoints']
+            pool = self.endpoint_pools[name] = EndpointPool([e.url for e in platform.endpoints.endpoints],
+                                                            failure_threshold=pool_config['failure_threshold'],
+                                                            recovery_time=pool_config['recovery_time'],
+                                                            hedge=pool_config['hedge'],
+                                                            hedge_min_samples=pool_config['hedge_min_samples'])
+            pool.start_health_checks(platform.http, platform.health_path, platform.get_health_headers(),
+                                     pool_config['health_check_interval'], self.log)
+        return pool
+
+    """
+        获取后端的连接池, 与平台实例和后端池一样按完整的平台名称区分, 例如 local_ai#ollama 和 local_ai#lmstudio 使用不同的连接池
+        平台配置中的connection_pool覆盖全局的connection_pool配置
+    """
+
+    def get_session(self, name: str) -> ClientSession:
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            pool_config = dict(self.config['connection_pool'])
+            pool_config.update(self.config['platforms'][name.partition('#')[0]].get('connection_pool') or {})
+            connector = TCPConnector(limit=pool_config['limit'],
+                                     limit_per_host=pool_config['limit_per_host'],
+                                     keepalive_timeout=pool_config['keepalive_timeout'],
+                                     ttl_dns_cache=pool_config['dns_cache_ttl'])
+            timeout = ClientTimeout(connect=pool_config['connect_timeout'],
+                                    sock_read=pool_config['read_timeout'])
+            session = self.sessions[name] = ClientSession(connector=connector, timeout=timeout)
+        return session
+
+    """
+        丢弃平台实例, 下次获取时重建, 连接池保留
+    """
+
+    def invalidate(self, name: str) -> None:
+        for key in [k for k in self.platforms if k == name or k.startswith(f"{name}@")]:
+            del self.platforms[key]
+
+    """
+        配置变化时丢弃所有平台实例, 之后的请求使用新建的连接池
+        进行中的请求仍然持有旧的平台实例, 旧的连接池在tasks全部完成并且后端池中没有进行中的请求之后关闭,
+        最多等待grace_period秒
+    """
+
+    def retire(self, grace_period: float, tasks: Iterable[asyncio.Task] = ()) -> None:
+        self.platforms.clear()
+        pools = list(self.endpoint_pools.values())
+        for pool in pools:
+            pool.stop_health_checks()
+        self.endpoint_pools.clear()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        task = asyncio.create_task(self._close_when_idle(sessions, pools, [t for t in tasks if not t.done()],
+                                                         grace_period))
+        self.retiring[task] = sessions
+        task.add_done_callback(lambda t: self.retiring.pop(t, None))
+
+    async def _close_when_idle(self, sessions: List[ClientSession], pools: List[EndpointPool],
+                               tasks: List[asyncio.Task], grace_period: float) -> None:
+        deadline = time.monotonic() + grace_period
+        try:
+            if tasks:
+                await asyncio.wait(tasks, timeout=grace_period)
+            while time.monotonic() < deadline and any(e.in_flight for pool in pools for e in pool.endpoints):
+                await asyncio.sleep(1)
+        finally:
+            for session in sessions:
+                await session.close()
+        self.log.debug(f"closed {len(sessions)} retired connection pools")
+
+    """
+        关闭所有连接池并丢弃所有平台实例, 在插件停止时调用
+    """
+
+    async def close(self) -> None:
+        for task, sessions in list(self.retiring.items()):
+            task.cancel()
+            for session in sessions:
+                await session.close()
+        self.retiring.clear()
+        self.platforms.clear()
+        for pool in self.endpoint_pools.values():
+            pool.stop_health_checks()
+        self.endpoint_pools.clear()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
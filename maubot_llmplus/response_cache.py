@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Callable, Awaitable, Tuple, Union
+
+from maubot_llmplus.platforms import ChatCompletion
+
+# 系统提示词中注入的时间格式, 默认的timestamp_format没有秒
+TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}(:\d{2})?")
+
+"""
+    AI响应缓存
+    按请求地址和请求体(完整的消息上下文, 模型和采样参数)的哈希缓存结果, 内存中按LRU和ttl淘汰,
+    可选地同时写入磁盘; 同时进行中的相同请求(包括流式请求)只调用一次接口
+"""
+
+
+class ResponseCache:
+    enable: bool
+    max_entries: int
+    ttl: float
+    disk_path: Optional[str]
+    normalize_timestamps: bool
+    entries: OrderedDict
+    in_flight: Dict[str, asyncio.Future]
+
+    def __init__(self, enable: bool, max_entries: int, ttl: float, disk_path: Optional[str],
+                 normalize_timestamps: bool) -> None:
+        self.enable = enable
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.normalize_timestamps = normalize_timestamps
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        if self.enable and self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    """
+        生成缓存key, 未开启缓存时返回None
+        stream字段不影响结果, 不参与计算; 开启normalize_timestamps时忽略系统提示词中的时间
+    """
+
+    def make_key(self, endpoint: str, req_body: dict) -> Optional[str]:
+        if not self.enable:
+            return None
+        body = {k: v for k, v in req_body.items() if k != 'stream'}
+        key_material = json.dumps({"endpoint": endpoint, "body": body}, sort_keys=True, ensure_ascii=False)
+        if self.normalize_timestamps:
+            key_material = TIMESTAMP_PATTERN.sub("<timestamp>", key_material)
+        return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+    """
+        获取缓存结果, 没有缓存时登记为这个请求的发起方(leader), 返回(None, future)
+        相同的请求正在进行中时等待其结果, 发起方被取消时由一个等待者接替发起请求, 其他等待者继续等待
+        发起方完成后必须调用release, 未开启缓存时返回(None, None)
+    """
+
+    async def claim(self, key: Optional[str]) -> Tuple[Optional[ChatCompletion], Optional[asyncio.Future]]:
+        if key is None:
+            return None, None
+        while True:
+            cached = self._get_memory(key)
+            if cached is not None:
+                return cached, None
+            future = self.in_flight.get(key)
+            if future is None:
+                break
+            cached = await self._wait_in_flight(future)
+            if cached is not None:
+                return cached, None
+        # 在第一次await之前登记, 之后到达的相同请求都会等待这次调用
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            cached = await self._get_disk(key)
+        except BaseException as e:
+            self.release(key, future, e)
+            raise
+        if cached is not None:
+            self.release(key, future, cached)
+            return cached, None
+        return None, future
+
+    """
+        发起方完成, result为结果或者异常, 取消(包括流式请求的调用方提前停止读取)时交给等待者接替
+    """
+
+    def release(self, key: Optional[str], future: Optional[asyncio.Future],
+                result: Union[ChatCompletion, BaseException]) -> None:
+        if future is None:
+            return
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if future.done():
+            return
+        if isinstance(result, (asyncio.CancelledError, GeneratorExit)):
+            future.cancel()
+        elif isinstance(result, BaseException):
+            future.set_exception(result)
+            # 没有其他等待者时避免未获取异常的警告
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def set(self, key: Optional[str], chat_completion: ChatCompletion) -> None:
+        # 失败或为空的结果不缓存
+        if key is None or not chat_completion.message.get('content'):
+            return
+        expires = time.time() + self.ttl
+        self._set_memory(key, chat_completion, expires)
+        if self.disk_path:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, chat_completion, expires)
+
+    """
+        缓存命中时直接返回, 否则调用factory获取结果并写入缓存, 同时进行中的相同请求共享同一次调用
+    """
+
+    async def get_or_create(self, key: Optional[str],
+                            factory: Callable[[], Awaitable[ChatCompletion]]) -> ChatCompletion:
+        cached, future = await self.claim(key)
+        if cached is not None:
+            return cached
+        try:
+            chat_completion = await factory()
+            await self.set(key, chat_completion)
+        except BaseException as e:
+            self.release(key, future, e)
+            raise
+        self.release(key, future, chat_completion)
+        return chat_completion
+
+    def _get_memory(self, key: str) -> Optional[ChatCompletion]:
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+        if cached[1] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return cached[0]
+
+    async def _wait_in_flight(self, future: asyncio.Future) -> Optional[ChatCompletion]:
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 发起请求的一方被取消时返回None, 由调用方重新检查并接替
+            if not future.cancelled():
+                raise
+            return None
+
+    async def _get_disk(self, key: str) -> Optional[ChatCompletion]:
+        if not self.disk_path:
+            return None
+        cached = await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key)
+        if cached is None:
+            return None
+        self._set_memory(key, cached[0], cached[1])
+        return cached[0]
+
+    def _set_memory(self, key: str, chat_completion: ChatCompletion, expires: float) -> None:
+        self.entries[key] = (chat_completion, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = os.path.join(self.disk_path, f"{key}.json")
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data['expires'] <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return ChatCompletion(message=data['message'], finish_reason=data['finish_reason'],
+                              model=data['model']), data['expires']
+
+    def _write_disk(self, key: str, chat_completion: ChatCompletion, expires: float) -> None:
+        path = os.path.join(self.disk_path, f"{key}.json")
+        data = {"message": chat_completion.message, "finish_reason": chat_completion.finish_reason,
+                "model": chat_completion.model, "expires": expires}
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
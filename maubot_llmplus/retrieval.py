@@ -0,0 +1,382 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Callable, Awaitable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+"""
+    检索到的一条历史消息, score为与当前消息的余弦相似度
+"""
+
+
+class RetrievedMessage:
+    event_id: str
+    sender: str
+    text: str
+    timestamp: int
+    score: float
+
+    def __init__(self, event_id: str, sender: str, text: str, timestamp: int, score: float) -> None:
+        self.event_id = event_id
+        self.sender = sender
+        self.text = text
+        self.timestamp = timestamp
+        self.score = score
+
+
+"""
+    一个聊天室的向量索引
+    向量归一化后按行保存在预留了容量的float32矩阵中, 添加消息不需要复制整个矩阵, 检索为一次矩阵乘法
+    保存为npz文件, 消息的文本等元数据以json编码保存在同一个文件中, 读取时不需要pickle
+"""
+
+
+class RoomIndex:
+    vectors: Optional["np.ndarray"]
+    timestamps: Optional["np.ndarray"]
+    size: int
+    event_ids: List[str]
+    senders: List[str]
+    texts: List[str]
+    positions: Dict[str, int]
+    dirty: bool
+
+    def __init__(self) -> None:
+        self.vectors = None
+        self.timestamps = None
+        self.size = 0
+        self.event_ids = []
+        self.senders = []
+        self.texts = []
+        self.positions = {}
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return self.size
+
+    """
+        添加或更新一条消息, 已经索引的消息(被编辑)替换原来的文本和向量
+        向量的维度变化(更换了嵌入模型)时清空索引, 不同模型的向量不能比较
+    """
+
+    def add(self, event_id: str, sender: str, text: str, timestamp: int, vector: List[float]) -> None:
+        vector = normalize(vector)
+        if self.vectors is not None and self.vectors.shape[1] != vector.shape[0]:
+            self.clear()
+        position = self.positions.get(event_id)
+        if position is None:
+            self.reserve(self.size + 1, vector.shape[0])
+            position = self.positions[event_id] = self.size
+            self.event_ids.append(event_id)
+            self.senders.append(sender)
+            self.texts.append(text)
+            self.timestamps[position] = timestamp
+            self.size += 1
+        else:
+            # 编辑消息保留原消息的时间
+            self.texts[position] = text
+        self.vectors[position] = vector
+        self.dirty = True
+
+    def reserve(self, size: int, dim: int) -> None:
+        if self.vectors is not None and self.vectors.shape[0] >= size:
+            return
+        capacity = max(size, 64, 0 if self.vectors is None else self.vectors.shape[0] * 2)
+        vectors = np.zeros((capacity, dim), dtype=np.float32)
+        timestamps = np.zeros(capacity, dtype=np.int64)
+        if self.vectors is not None:
+            vectors[:self.size] = self.vectors[:self.size]
+            timestamps[:self.size] = self.timestamps[:self.size]
+        self.vectors = vectors
+        self.timestamps = timestamps
+
+    def clear(self) -> None:
+        self.__init__()
+        self.dirty = True
+
+    def remove(self, event_id: str) -> bool:
+        position = self.positions.get(event_id)
+        if position is None:
+            return False
+        keep = np.ones(self.size, dtype=bool)
+        keep[position] = False
+        self.compact(keep)
+        return True
+
+    """
+        超过max_entries条消息时删除最早的消息, 多保留十分之一, 不需要每添加一条消息就整理一次矩阵
+    """
+
+    def trim(self, max_entries: int) -> None:
+        if max_entries <= 0 or self.size <= max_entries + max_entries // 10:
+            return
+        keep = np.zeros(self.size, dtype=bool)
+        keep[np.argsort(self.timestamps[:self.size], kind='stable')[-max_entries:]] = True
+        self.compact(keep)
+
+    def compact(self, keep: "np.ndarray") -> None:
+        size = int(keep.sum())
+        self.vectors[:size] = self.vectors[:self.size][keep]
+        self.timestamps[:size] = self.timestamps[:self.size][keep]
+        kept = np.flatnonzero(keep)
+        self.event_ids = [self.event_ids[i] for i in kept]
+        self.senders = [self.senders[i] for i in kept]
+        self.texts = [self.texts[i] for i in kept]
+        self.positions = {event_id: i for i, event_id in enumerate(self.event_ids)}
+        self.size = size
+        self.dirty = True
+
+    """
+        检索早于before(毫秒)且与query最相似的k条消息, 按时间顺序返回, exclude中的消息不返回
+    """
+
+    def search(self, query: List[float], k: int, before: int, exclude: Set[str],
+               min_score: float) -> List[RetrievedMessage]:
+        if self.size == 0 or k <= 0:
+            return []
+        query = normalize(query)
+        if query.shape[0] != self.vectors.shape[1]:
+            return []
+        scores = self.vectors[:self.size] @ query
+        scores[self.timestamps[:self.size] >= before] = -np.inf
+        for event_id in exclude:
+            position = self.positions.get(event_id)
+            if position is not None:
+                scores[position] = -np.inf
+        candidates = np.flatnonzero(scores >= min_score)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        return sorted((RetrievedMessage(self.event_ids[i], self.senders[i], self.texts[i],
+                                        int(self.timestamps[i]), float(scores[i])) for i in candidates),
+                      key=lambda m: m.timestamp)
+
+    def save(self, path: str) -> None:
+        meta = json.dumps({"event_ids": self.event_ids, "senders": self.senders, "texts": self.texts},
+                          ensure_ascii=False).encode('utf-8')
+        vectors = self.vectors[:self.size] if self.vectors is not None else np.zeros((0, 0), dtype=np.float32)
+        timestamps = self.timestamps[:self.size] if self.timestamps is not None else np.zeros(0, dtype=np.int64)
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, vectors=vectors, timestamps=timestamps, meta=np.frombuffer(meta, dtype=np.uint8))
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "RoomIndex":
+        index = cls()
+        with np.load(path) as data:
+            meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+            vectors = data['vectors']
+            timestamps = data['timestamps']
+        if len(meta['event_ids']) == 0:
+            return index
+        index.reserve(vectors.shape[0], vectors.shape[1])
+        index.vectors[:vectors.shape[0]] = vectors
+        index.timestamps[:vectors.shape[0]] = timestamps
+        index.size = vectors.shape[0]
+        index.event_ids = meta['event_ids']
+        index.senders = meta['senders']
+        index.texts = meta['texts']
+        index.positions = {event_id: i for i, event_id in enumerate(index.event_ids)}
+        return index
+
+
+def normalize(vector: List[float]) -> "np.ndarray":
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+"""
+    相关历史消息的检索
+    聊天室中的消息在后台批量转换为向量并加入聊天室的索引, 构建上下文时检索与当前消息最相似的较早的消息,
+    和最近的消息一起发送, 不需要发送很长的上下文也能用到相关的历史
+    最近使用的max_rooms个聊天室的索引保存在内存中, 配置了disk_path时每隔persist_interval秒保存有变化的索引,
+    相对路径的disk_path保存在插件的数据目录data_dir中
+    embed为调用嵌入接口的函数, 参数为文本列表, 返回对应的向量列表
+"""
+
+
+class MessageRetriever:
+    embed: Callable[[List[str]], Awaitable[List[List[float]]]]
+    log: logging.Logger
+    enable: bool
+    top_k: int
+    min_score: float
+    min_length: int
+    max_entries: int
+    max_rooms: int
+    batch_size: int
+    index_delay: float
+    timeout: float
+    disk_path: Optional[str]
+    persist_interval: float
+    indexes: OrderedDict
+    pending: Dict[str, OrderedDict]
+    tasks: Dict[str, asyncio.Task]
+    task: Optional[asyncio.Task]
+
+    def __init__(self, embed: Callable[[List[str]], Awaitable[List[List[float]]]], log: logging.Logger) -> None:
+        self.embed = embed
+        self.log = log
+        self.enable = False
+        self.indexes = OrderedDict()
+        self.pending = {}
+        self.tasks = {}
+        self.task = None
+
+    def configure(self, config: dict, data_dir: str) -> None:
+        self.enable = config['enable']
+        if self.enable and np is None:
+            self.log.warning("retrieval is disabled because numpy is not installed")
+            self.enable = False
+        self.top_k = config['top_k']
+        self.min_score = config['min_score']
+        self.min_length = config['min_length']
+        self.max_entries = config['max_entries']
+        self.max_rooms = config['max_rooms']
+        self.batch_size = max(config['batch_size'], 1)
+        self.index_delay = config['index_delay']
+        self.timeout = config['timeout']
+        self.disk_path = os.path.join(data_dir, config['disk_path']) if config['disk_path'] else None
+        self.persist_interval = config['persist_interval']
+        if self.enable and self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+
+    def get_path(self, room_id: str) -> str:
+        return os.path.join(self.disk_path, f"{hashlib.sha256(room_id.encode('utf-8')).hexdigest()}.npz")
+
+    """
+        获取聊天室的索引, 不在内存中时从磁盘读取, 超出max_rooms时保存并移除最久没有使用的索引
+    """
+
+    async def get_index(self, room_id: str) -> RoomIndex:
+        index = self.indexes.get(room_id)
+        if index is not None:
+            self.indexes.move_to_end(room_id)
+            return index
+        index = RoomIndex()
+        if self.disk_path and os.path.exists(self.get_path(room_id)):
+            try:
+                index = await asyncio.get_running_loop().run_in_executor(None, RoomIndex.load,
+                                                                         self.get_path(room_id))
+            except Exception as e:
+                self.log.warning(f"failed to load retrieval index of {room_id}: {e}")
+        # 读取期间可能已经由其他任务加入
+        if room_id in self.indexes:
+            return self.indexes[room_id]
+        self.indexes[room_id] = index
+        while len(self.indexes) > self.max_rooms:
+            evicted_room, evicted = self.indexes.popitem(last=False)
+            await self.save_index(evicted_room, evicted)
+        return index
+
+    async def save_index(self, room_id: str, index: RoomIndex) -> None:
+        if not self.disk_path or not index.dirty:
+            return
+        index.dirty = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, index.save, self.get_path(room_id))
+        except Exception as e:
+            index.dirty = True
+            self.log.warning(f"failed to save retrieval index of {room_id}: {e}")
+
+    """
+        把消息加入索引, 在后台等待index_delay秒后批量转换为向量, 等待期间被编辑的消息只转换一次
+    """
+
+    def add(self, room_id: str, event_id: str, sender: str, text: str, timestamp: int) -> None:
+        if not self.enable or len(text.strip()) < self.min_length:
+            return
+        self.pending.setdefault(room_id, OrderedDict())[event_id] = (sender, text, timestamp)
+        if room_id not in self.tasks:
+            self.tasks[room_id] = asyncio.create_task(self.flush(room_id))
+
+    async def flush(self, room_id: str) -> None:
+        try:
+            await asyncio.sleep(self.index_delay)
+            pending = self.pending.get(room_id)
+            while pending:
+                batch = []
+                while pending and len(batch) < self.batch_size:
+                    event_id, (sender, text, timestamp) = pending.popitem(last=False)
+                    batch.append((event_id, sender, text, timestamp))
+                try:
+                    vectors = await self.embed([text for _, _, text, _ in batch])
+                except Exception as e:
+                    self.log.warning(f"failed to embed {len(batch)} messages of {room_id}: {e}")
+                    continue
+                index = await self.get_index(room_id)
+                for (event_id, sender, text, timestamp), vector in zip(batch, vectors):
+                    index.add(event_id, sender, text, timestamp, vector)
+                index.trim(self.max_entries)
+        finally:
+            # 在同一步中移除任务和等待队列, 之后加入的消息会启动新的任务
+            self.tasks.pop(room_id, None)
+            self.pending.pop(room_id, None)
+
+    async def remove(self, room_id: str, event_id: str) -> None:
+        if not self.enable:
+            return
+        self.pending.get(room_id, {}).pop(event_id, None)
+        # 没有索引的聊天室不需要读取
+        if room_id not in self.indexes and not (self.disk_path and os.path.exists(self.get_path(room_id))):
+            return
+        (await self.get_index(room_id)).remove(event_id)
+
+    """
+        检索与当前消息最相似, 早于before且不在exclude中的消息, 当前消息使用同一个向量直接加入索引
+        嵌入接口超时或失败时返回空列表, 不影响请求
+    """
+
+    async def search(self, room_id: str, event_id: str, sender: str, text: str, timestamp: int,
+                     before: int, exclude: Set[str]) -> List[RetrievedMessage]:
+        if not self.enable or not text.strip():
+            return []
+        try:
+            vector = (await asyncio.wait_for(self.embed([text]), self.timeout))[0]
+        except Exception as e:
+            self.log.warning(f"failed to embed the message {event_id}: {e!r}")
+            return []
+        index = await self.get_index(room_id)
+        results = index.search(vector, self.top_k, before, exclude, self.min_score)
+        if len(text.strip()) >= self.min_length:
+            self.pending.get(room_id, {}).pop(event_id, None)
+            index.add(event_id, sender, text, timestamp, vector)
+        return results
+
+    async def save(self) -> None:
+        for room_id, index in list(self.indexes.items()):
+            await self.save_index(room_id, index)
+
+    async def _save_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.save()
+
+    def start(self) -> None:
+        self.stop()
+        if self.enable and self.disk_path and self.persist_interval > 0:
+            self.task = asyncio.create_task(self._save_loop())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    """
+        停止时取消还没有完成的向量转换并保存所有有变化的索引
+    """
+
+    async def close(self) -> None:
+        self.stop()
+        for task in list(self.tasks.values()):
+            task.cancel()
+        self.tasks.clear()
+        self.pending.clear()
+        await self.save()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import re
+from typing import Callable, Awaitable, Dict, List, Optional
+
+# 请求分类的结果, fast为响应快的小模型, large为能力强的大模型
+TIERS = ["fast", "large"]
+# 回答因为长度限制被截断时的finish_reason, anthropic为max_tokens, 其他平台为length
+TRUNCATED = ["length", "max_tokens"]
+
+CLASSIFIER_PROMPT = ("Decide whether answering the chat message below needs a large language model. "
+                     "Reply with the single word SIMPLE for greetings, thanks, small talk and short factual "
+                     "questions, or COMPLEX for anything that needs reasoning, writing, coding or knowledge.\n\n"
+                     "Message: ")
+
+"""
+    路由结果, platform为cur_platform格式的平台名称, model为空时使用平台当前的模型, reason为选择的依据
+"""
+
+
+class Route:
+    tier: str
+    platform: str
+    model: str
+    reason: str
+
+    def __init__(self, tier: str, platform: str, model: str, reason: str) -> None:
+        self.tier = tier
+        self.platform = platform
+        self.model = model
+        self.reason = reason
+
+
+"""
+    快速模型和大模型之间的路由
+    按顺序匹配规则: 聊天室的固定设置, 大模型关键词, 快速模型关键词, 消息长度,
+    都没有匹配时可选地询问一个很小的分类模型, 仍然无法确定时使用default
+    classify为调用分类模型的函数, 参数为提示词, 返回模型的回答, current返回当前使用的平台名称
+"""
+
+
+class ModelRouter:
+    classify: Callable[[str], Awaitable[str]]
+    current: Callable[[], str]
+    log: logging.Logger
+    enable: bool
+    tiers: Dict[str, Dict[str, str]]
+    rooms: Dict[str, str]
+    large_keywords: List[re.Pattern]
+    fast_keywords: List[re.Pattern]
+    fast_max_words: int
+    classifier: bool
+    classifier_timeout: float
+    default: str
+    fallback: bool
+
+    def __init__(self, classify: Callable[[str], Awaitable[str]], current: Callable[[], str],
+                 log: logging.Logger) -> None:
+        self.classify = classify
+        self.current = current
+        self.log = log
+        self.enable = False
+
+    def configure(self, config: dict) -> None:
+        self.enable = config['enable']
+        self.tiers = {tier: {'platform': (config[tier] or {}).get('platform') or '',
+                             'model': (config[tier] or {}).get('model') or ''} for tier in TIERS}
+        self.rooms = {room_id: tier for room_id, tier in (config['rooms'] or {}).items() if tier in TIERS}
+        self.large_keywords = [re.compile(k, re.IGNORECASE) for k in config['large_keywords'] or []]
+        self.fast_keywords = [re.compile(k, re.IGNORECASE) for k in config['fast_keywords'] or []]
+        self.fast_max_words = config['fast_max_words']
+        self.classifier = config['classifier']['enable']
+        self.classifier_timeout = config['classifier']['timeout']
+        self.default = config['default'] if config['default'] in TIERS else 'large'
+        self.fallback = config['fallback']
+
+    """
+        没有配置平台时使用当前平台, 没有配置模型时使用平台当前的模型
+    """
+
+    def get_route(self, tier: str, reason: str) -> Route:
+        return Route(tier, self.tiers[tier]['platform'] or self.current(), self.tiers[tier]['model'], reason)
+
+    """
+        选择回答这条消息的模型
+    """
+
+    async def route(self, room_id: str, text: str) -> Route:
+        tier = self.rooms.get(room_id)
+        if tier is not None:
+            return self.get_route(tier, "room")
+        if any(k.search(text) for k in self.large_keywords):
+            return self.get_route("large", "keyword")
+        if any(k.search(text) for k in self.fast_keywords):
+            return self.get_route("fast", "keyword")
+        if len(text.split()) > self.fast_max_words:
+            return self.get_route("large", "length")
+        if self.classifier:
+            tier = await self.run_classifier(text)
+            if tier is not None:
+                return self.get_route(tier, "classifier")
+        return self.get_route(self.default, "default")
+
+    async def run_classifier(self, text: str) -> Optional[str]:
+        try:
+            answer = await asyncio.wait_for(self.classify(CLASSIFIER_PROMPT + text), self.classifier_timeout)
+        except Exception as e:
+            self.log.warning(f"failed to classify message: {e!r}")
+            return None
+        answer = answer.strip().upper()
+        if "COMPLEX" in answer:
+            return "large"
+        if "SIMPLE" in answer:
+            return "fast"
+        return None
+
+    """
+        快速模型的回答为空或者因为长度限制被截断时, 由大模型重新回答
+    """
+
+    def needs_fallback(self, route: Route, content: Optional[str], finish_reason: Optional[str]) -> bool:
+        if not self.fallback or route.tier != "fast" or self.tiers["fast"] == self.tiers["large"]:
+            return False
+        return not (content or '').strip() or finish_reason in TRUNCATED
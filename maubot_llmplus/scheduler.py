@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, Optional, Callable, Awaitable, AsyncIterator
+
+"""
+    等待队列已满时抛出
+"""
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Ticket:
+    key: Hashable
+    future: asyncio.Future
+    enqueued_at: float
+    granted: bool
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+
+
+"""
+    单个后端的并发控制和等待队列
+    等待中的请求按key(聊天室, 用户)分组, 有空闲位置时在各组之间轮询分配, 避免一个繁忙的聊天室占满后端
+"""
+
+
+class BackendQueue:
+    max_concurrency: int
+    active: int
+    waiting: OrderedDict
+    wait_times: deque
+
+    def __init__(self, max_concurrency: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = OrderedDict()
+        # 最近的等待时间(秒)
+        self.wait_times = deque(maxlen=100)
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self.waiting.values())
+
+    def acquire(self, key: Hashable, max_queue: int) -> Ticket:
+        ticket = Ticket(key)
+        if self.active < self.max_concurrency and not self.waiting:
+            self._grant(ticket)
+            return ticket
+        if self.depth >= max_queue:
+            raise QueueFullError(f"too many requests are waiting ({max_queue}), please try again later")
+        self.waiting.setdefault(key, deque()).append(ticket)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket.granted:
+            self.active -= 1
+        else:
+            # 等待中被取消, 从队列中移除
+            queue = self.waiting.get(ticket.key)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self.waiting[ticket.key]
+        self.dispatch()
+
+    """
+        计算等待中的请求在轮询分配下的位置, 从1开始
+    """
+
+    def position(self, ticket: Ticket) -> int:
+        own_queue = self.waiting.get(ticket.key)
+        if not own_queue or ticket not in own_queue:
+            return 0
+        index = own_queue.index(ticket)
+        position = 0
+        before = True
+        for key, queue in self.waiting.items():
+            if key == ticket.key:
+                before = False
+                position += index + 1
+            else:
+                position += min(len(queue), index + 1 if before else index)
+        return position
+
+    def _grant(self, ticket: Ticket) -> None:
+        ticket.granted = True
+        self.active += 1
+        self.wait_times.append(time.monotonic() - ticket.enqueued_at)
+        if not ticket.future.done():
+            ticket.future.set_result(None)
+
+    def dispatch(self) -> None:
+        while self.active < self.max_concurrency and self.waiting:
+            key, queue = next(iter(self.waiting.items()))
+            ticket = queue.popleft()
+            # 分配后把这一组移到最后, 实现轮询
+            if queue:
+                self.waiting.move_to_end(key)
+            else:
+                del self.waiting[key]
+            self._grant(ticket)
+
+
+"""
+    推理请求调度器, 限制每个后端的并发请求数, 超出时排队等待
+"""
+
+
+class InferenceScheduler:
+    queues: Dict[str, BackendQueue]
+
+    def __init__(self) -> None:
+        self.queues = {}
+
+    def get_queue(self, backend: str, max_concurrency: int) -> BackendQueue:
+        queue = self.queues.get(backend)
+        if queue is None:
+            queue = self.queues[backend] = BackendQueue(max_concurrency)
+        elif queue.max_concurrency != max_concurrency:
+            # 配置变化后立即生效
+            queue.max_concurrency = max_concurrency
+            queue.dispatch()
+        return queue
+
+    """
+        获取一个执行位置, 需要等待时调用on_queued通知排队位置
+    """
+
+    @asynccontextmanager
+    async def slot(self, backend: str, key: Hashable, max_concurrency: int, max_queue: int,
+                   on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> AsyncIterator[Ticket]:
+        queue = self.get_queue(backend, max_concurrency)
+        ticket = queue.acquire(key, max_queue)
+        try:
+            if not ticket.granted:
+                if on_queued:
+                    await on_queued(queue.position(ticket))
+                await ticket.future
+            yield ticket
+        finally:
+            queue.release(ticket)
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {}
+        for backend, queue in self.queues.items():
+            wait_times = list(queue.wait_times)
+            stats[backend] = {
+                "active": queue.active,
+                "max_concurrency": queue.max_concurrency,
+                "queue_depth": queue.depth,
+                "avg_wait": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "max_wait": max(wait_times) if wait_times else 0.0,
+            }
+        return stats
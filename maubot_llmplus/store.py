@@ -0,0 +1,356 @@
+import asyncio
+import logging
+import time
+from typing import Optional, List, Set, Tuple, Iterable, Dict, Callable, Awaitable
+
+from mautrix.types import MessageEvent, TextMessageEventContent, MessageType, EventType, RoomID, EventID, UserID
+from mautrix.util.async_db import Database, Connection
+
+"""
+    会话存储的表结构, 由插件数据库的升级表(db.py)按版本调用
+"""
+
+
+async def create_conversation_tables(conn: Connection) -> None:
+    # thread_id为thread的根消息, 不在thread中的消息为空字符串
+    await conn.execute(
+        """CREATE TABLE conversation_turn (
+            room_id     TEXT    NOT NULL,
+            event_id    TEXT    NOT NULL,
+            thread_id   TEXT    NOT NULL DEFAULT '',
+            sender      TEXT    NOT NULL,
+            role        TEXT    NOT NULL,
+            text        TEXT    NOT NULL,
+            token_count INTEGER,
+            timestamp   BIGINT  NOT NULL,
+            PRIMARY KEY (room_id, event_id)
+        )"""
+    )
+    await conn.execute(
+        "CREATE INDEX conversation_turn_room_thread_timestamp_idx "
+        "ON conversation_turn (room_id, thread_id, timestamp)"
+    )
+    await conn.execute("CREATE INDEX conversation_turn_timestamp_idx ON conversation_turn (timestamp)")
+    # 已经从homeserver补全过历史消息的会话, 之后的消息都是实时收到的, 会话在数据库中是连续的
+    await conn.execute(
+        """CREATE TABLE conversation_backfill (
+            room_id   TEXT   NOT NULL,
+            thread_id TEXT   NOT NULL DEFAULT '',
+            timestamp BIGINT NOT NULL,
+            PRIMARY KEY (room_id, thread_id)
+        )"""
+    )
+
+
+"""
+    每个聊天室最后一条实时收到并保存的消息, 插件重新启动或者重新加载配置后从这里补全停止期间的消息
+"""
+
+
+async def create_conversation_sync_table(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE conversation_sync (
+            room_id   TEXT   NOT NULL PRIMARY KEY,
+            event_id  TEXT   NOT NULL,
+            timestamp BIGINT NOT NULL
+        )"""
+    )
+
+
+"""
+    一条会话消息, role为user或assistant
+"""
+
+
+class ConversationTurn:
+    room_id: RoomID
+    event_id: EventID
+    thread_id: str
+    sender: UserID
+    role: str
+    text: str
+    token_count: Optional[int]
+    timestamp: int
+
+    def __init__(self, room_id: RoomID, event_id: EventID, thread_id: str, sender: UserID, role: str, text: str,
+                 token_count: Optional[int], timestamp: int) -> None:
+        self.room_id = room_id
+        self.event_id = event_id
+        self.thread_id = thread_id
+        self.sender = sender
+        self.role = role
+        self.text = text
+        self.token_count = token_count
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_event(cls, evt: MessageEvent, bot_mxid: UserID, token_count: Optional[int]) -> 'ConversationTurn':
+        return cls(evt.room_id, evt.event_id, evt.content.get_thread_parent() or '', evt.sender,
+                   'assistant' if evt.sender == bot_mxid else 'user', evt.content.body, token_count,
+                   evt.timestamp)
+
+    def to_row(self) -> tuple:
+        return (self.room_id, self.event_id, self.thread_id, self.sender, self.role, self.text, self.token_count,
+                self.timestamp)
+
+    """
+        转换为消息事件, 构建上下文的代码与从homeserver获取的消息共用
+    """
+
+    def to_event(self) -> MessageEvent:
+        return MessageEvent(type=EventType.ROOM_MESSAGE, room_id=self.room_id, event_id=self.event_id,
+                            sender=self.sender, timestamp=self.timestamp,
+                            content=TextMessageEventContent(msgtype=MessageType.TEXT, body=self.text))
+
+
+"""
+    持久化的会话存储, 保存在插件数据库中, 重启后不需要重新从homeserver获取历史消息
+    构建上下文时只需要一次按(room_id, thread_id, timestamp)索引的查询
+    定时删除超过retention_days天的消息, 每个聊天室最多保留max_turns_per_room条消息
+    插件停止期间的消息没有被保存, 启动时读取每个聊天室最后保存的消息(resume_from),
+    之后第一次使用这个聊天室时从homeserver补全这段时间的消息
+    最后保存的消息先记录在内存中, 每sync_interval秒批量写入一次, 插件停止时写入剩余的记录
+"""
+
+
+class ConversationStore:
+    db: Database
+    log: logging.Logger
+    retention_days: float
+    max_turns_per_room: int
+    prune_interval: float
+    sync_interval: float
+    backfilled: Set[Tuple[RoomID, str]]
+    resume_from: Dict[RoomID, Tuple[EventID, int]]
+    catching_up: Dict[RoomID, asyncio.Task]
+    # 还没有写入conversation_sync的每个聊天室最后保存的消息
+    pending_sync: Dict[RoomID, Tuple[EventID, int]]
+    load_task: Optional[asyncio.Task]
+    prune_task: Optional[asyncio.Task]
+    sync_task: Optional[asyncio.Task]
+
+    def __init__(self, db: Database, log: logging.Logger, retention_days: float, max_turns_per_room: int,
+                 prune_interval: float, sync_interval: float) -> None:
+        self.db = db
+        self.log = log
+        self.retention_days = retention_days
+        self.max_turns_per_room = max_turns_per_room
+        self.prune_interval = prune_interval
+        self.sync_interval = sync_interval
+        self.backfilled = set()
+        self.resume_from = {}
+        self.catching_up = {}
+        self.pending_sync = {}
+        self.load_task = None
+        self.prune_task = None
+        self.sync_task = None
+
+    """
+        保存一条实时收到的消息, 同时记录为这个聊天室最后保存的消息, sync_interval为0时立即写入
+    """
+
+    async def add_turn(self, turn: ConversationTurn) -> None:
+        await self.add_turns([turn])
+        last = self.pending_sync.get(turn.room_id)
+        if last is None or turn.timestamp >= last[1]:
+            self.pending_sync[turn.room_id] = (turn.event_id, turn.timestamp)
+        if self.sync_interval <= 0:
+            await self.flush_sync()
+
+    async def add_turns(self, turns: Iterable[ConversationTurn]) -> None:
+        rows = [turn.to_row() for turn in turns]
+        if not rows:
+            return
+        await self.db.executemany(
+            "INSERT INTO conversation_turn (room_id, event_id, thread_id, sender, role, text, token_count, timestamp) "
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (room_id, event_id) DO NOTHING",
+            rows
+        )
+
+    async def update_text(self, room_id: RoomID, event_id: EventID, text: str, token_count: Optional[int]) -> None:
+        await self.db.execute("UPDATE conversation_turn SET text=$3, token_count=$4 WHERE room_id=$1 AND event_id=$2",
+                              room_id, event_id, text, token_count)
+
+    async def delete_turn(self, room_id: RoomID, event_id: EventID) -> None:
+        await self.db.execute("DELETE FROM conversation_turn WHERE room_id=$1 AND event_id=$2", room_id, event_id)
+
+    """
+        获取会话中某个时间之前的消息, 从新到旧排列
+        thread_id为None时获取不在thread中的消息, 否则获取thread的根消息和thread中的消息
+    """
+
+    async def get_turns_before(self, room_id: RoomID, thread_id: Optional[str], timestamp: int,
+                               limit: int) -> List[ConversationTurn]:
+        rows = await self.db.fetch(
+            "SELECT room_id, event_id, thread_id, sender, role, text, token_count, timestamp "
+            "FROM conversation_turn WHERE room_id=$1 AND (thread_id=$2 OR event_id=$2) AND timestamp<$3 "
+            "ORDER BY timestamp DESC LIMIT $4",
+            room_id, thread_id or '', timestamp, limit
+        )
+        return [ConversationTurn(*row) for row in rows]
+
+    async def is_backfilled(self, room_id: RoomID, thread_id: Optional[str]) -> bool:
+        key = (room_id, thread_id or '')
+        if key in self.backfilled:
+            return True
+        row = await self.db.fetchrow("SELECT 1 FROM conversation_backfill WHERE room_id=$1 AND thread_id=$2", *key)
+        if row is not None:
+            self.backfilled.add(key)
+        return row is not None
+
+    """
+        保存从homeserver获取的历史消息, 之后这个会话的上下文只从数据库中读取
+    """
+
+    async def backfill(self, room_id: RoomID, thread_id: Optional[str], turns: List[ConversationTurn]) -> None:
+        key = (room_id, thread_id or '')
+        async with self.db.acquire() as conn, conn.transaction():
+            await conn.executemany(
+                "INSERT INTO conversation_turn "
+                "(room_id, event_id, thread_id, sender, role, text, token_count, timestamp) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) ON CONFLICT (room_id, event_id) DO NOTHING",
+                [turn.to_row() for turn in turns]
+            )
+            await conn.execute(
+                "INSERT INTO conversation_backfill (room_id, thread_id, timestamp) VALUES ($1, $2, $3) "
+                "ON CONFLICT (room_id, thread_id) DO NOTHING",
+                *key, int(time.time() * 1000)
+            )
+        self.backfilled.add(key)
+
+    """
+        等待启动时读取上次运行时最后保存的消息, 读取被取消或失败时也会返回
+    """
+
+    async def wait_loaded(self) -> None:
+        if self.load_task is not None:
+            await asyncio.wait([self.load_task])
+
+    """
+        批量写入每个聊天室最后保存的消息, 先读取上次运行时最后保存的消息, 再覆盖
+    """
+
+    async def flush_sync(self) -> None:
+        await self.wait_loaded()
+        await self._write_sync()
+
+    async def _write_sync(self) -> None:
+        if not self.pending_sync:
+            return
+        pending, self.pending_sync = self.pending_sync, {}
+        try:
+            await self.db.executemany(
+                "INSERT INTO conversation_sync (room_id, event_id, timestamp) VALUES ($1, $2, $3) "
+                "ON CONFLICT (room_id) DO UPDATE SET event_id=excluded.event_id, timestamp=excluded.timestamp "
+                "WHERE excluded.timestamp>=conversation_sync.timestamp",
+                [(room_id, event_id, timestamp) for room_id, (event_id, timestamp) in pending.items()]
+            )
+        except BaseException:
+            # 写入失败时保留没有写入的记录, 写入期间又收到新消息的聊天室保留较新的记录
+            for room_id, position in pending.items():
+                if room_id not in self.pending_sync or self.pending_sync[room_id][1] < position[1]:
+                    self.pending_sync[room_id] = position
+            raise
+
+    async def load(self) -> None:
+        rows = await self.db.fetch("SELECT room_id, event_id, timestamp FROM conversation_sync")
+        self.resume_from = {row['room_id']: (row['event_id'], row['timestamp']) for row in rows}
+
+    """
+        补全聊天室在插件停止期间的消息, 每个聊天室只补全一次, 同时使用这个聊天室的请求等待同一次补全
+        fetch的参数为最后保存的消息和它的时间戳, 返回之后的消息, 补全失败时只记录日志, 下次使用时重试
+    """
+
+    async def catch_up(self, room_id: RoomID,
+                       fetch: Callable[[EventID, int], Awaitable[List[ConversationTurn]]]) -> None:
+        await self.wait_loaded()
+        if room_id not in self.resume_from:
+            return
+        task = self.catching_up.get(room_id)
+        if task is None:
+            task = self.catching_up[room_id] = asyncio.create_task(self._catch_up(room_id, fetch))
+        await asyncio.shield(task)
+
+    async def _catch_up(self, room_id: RoomID,
+                        fetch: Callable[[EventID, int], Awaitable[List[ConversationTurn]]]) -> None:
+        try:
+            turns = await fetch(*self.resume_from[room_id])
+            await self.add_turns(turns)
+            self.resume_from.pop(room_id, None)
+            self.log.debug(f"caught up {len(turns)} messages in {room_id}")
+        except Exception as e:
+            self.log.warning(f"failed to catch up conversation in {room_id}: {e}")
+        finally:
+            self.catching_up.pop(room_id, None)
+
+    """
+        删除超过保留时间的消息和每个聊天室超出数量上限的最早的消息
+    """
+
+    async def prune(self) -> None:
+        if self.retention_days > 0:
+            cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+            await self.db.execute("DELETE FROM conversation_turn WHERE timestamp<$1", cutoff)
+        if self.max_turns_per_room > 0:
+            rows = await self.db.fetch("SELECT room_id FROM conversation_turn GROUP BY room_id HAVING COUNT(*)>$1",
+                                       self.max_turns_per_room)
+            for row in rows:
+                await self.db.execute(
+                    "DELETE FROM conversation_turn WHERE room_id=$1 AND timestamp<("
+                    "SELECT timestamp FROM conversation_turn WHERE room_id=$1 "
+                    "ORDER BY timestamp DESC LIMIT 1 OFFSET $2)",
+                    row['room_id'], self.max_turns_per_room - 1
+                )
+
+    async def _prune_loop(self) -> None:
+        while True:
+            try:
+                await self.prune()
+            except Exception as e:
+                self.log.warning(f"failed to prune conversation store: {e}")
+            await asyncio.sleep(self.prune_interval)
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.flush_sync()
+            except Exception as e:
+                self.log.warning(f"failed to save conversation sync positions: {e}")
+
+    async def _load(self) -> None:
+        try:
+            # 重新加载配置时旧的存储还没有写入的记录是这次运行中实时收到的消息, 先写入再读取
+            await self._write_sync()
+            await self.load()
+        except Exception as e:
+            self.log.warning(f"failed to load conversation sync positions: {e}")
+
+    """
+        启动后台任务, pending_sync为重新加载配置前的存储还没有写入的记录
+    """
+
+    def start(self, pending_sync: Optional[Dict[RoomID, Tuple[EventID, int]]] = None) -> None:
+        self.stop()
+        self.pending_sync.update(pending_sync or {})
+        self.load_task = asyncio.create_task(self._load())
+        if self.prune_interval > 0:
+            self.prune_task = asyncio.create_task(self._prune_loop())
+        if self.sync_interval > 0:
+            self.sync_task = asyncio.create_task(self._sync_loop())
+
+    def stop(self) -> None:
+        for task in (self.load_task, self.prune_task, self.sync_task):
+            if task:
+                task.cancel()
+        self.load_task = None
+        self.prune_task = None
+        self.sync_task = None
+
+    """
+        停止后台任务并写入还没有写入的记录, 在插件停止时调用
+    """
+
+    async def close(self) -> None:
+        self.stop()
+        await self._write_sync()
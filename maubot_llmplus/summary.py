@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Callable, Awaitable, Dict, Hashable
+
+"""
+    会话摘要, until为已经被摘要的最新一条消息的时间戳(毫秒), 更早的消息不再原样发送
+"""
+
+
+class ConversationSummary:
+    text: str
+    until: int
+
+    def __init__(self, text: str, until: int) -> None:
+        self.text = text
+        self.until = until
+
+
+"""
+    滚动会话摘要
+    历史消息超过阈值时, 在后台把较早的消息和已有的摘要一起压缩为新的摘要, 按聊天室/thread缓存,
+    构建上下文时用摘要代替已经被摘要的原始消息, 使提示词的长度基本保持不变
+    complete为调用摘要模型的函数, 参数为消息列表, 返回摘要文本
+"""
+
+
+class ConversationSummarizer:
+    complete: Callable[[List[dict]], Awaitable[str]]
+    log: logging.Logger
+    max_words: int
+    max_entries: int
+    summaries: OrderedDict
+    tasks: Dict[Hashable, asyncio.Task]
+
+    def __init__(self, complete: Callable[[List[dict]], Awaitable[str]], log: logging.Logger,
+                 max_words: int, max_entries: int) -> None:
+        self.complete = complete
+        self.log = log
+        self.max_words = max_words
+        self.max_entries = max_entries
+        self.summaries = OrderedDict()
+        self.tasks = {}
+
+    def get(self, key: Hashable) -> Optional[ConversationSummary]:
+        summary = self.summaries.get(key)
+        if summary is not None:
+            self.summaries.move_to_end(key)
+        return summary
+
+    """
+        在后台把messages(按时间顺序的(发送者, 文本, 时间戳))合并到摘要中, 同一个会话同时只有一个摘要任务
+    """
+
+    def schedule(self, key: Hashable, messages: List[Tuple[str, str, int]]) -> None:
+        if not messages or key in self.tasks:
+            return
+        task = self.tasks[key] = asyncio.create_task(self.summarize(key, messages))
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    async def summarize(self, key: Hashable, messages: List[Tuple[str, str, int]]) -> None:
+        previous = self.summaries.get(key)
+        # 已经被其他任务摘要过的消息不再重复摘要
+        if previous is not None:
+            messages = [m for m in messages if m[2] > previous.until]
+            if not messages:
+                return
+        transcript = "\n".join(f"{sender}: {text}" for sender, text, _ in messages)
+        prompt = (f"Summarize the conversation below so it can replace the original messages as context for "
+                  f"continuing the chat. Keep names, facts, decisions and open questions. "
+                  f"Reply with the summary only, in at most {self.max_words} words.\n\n")
+        if previous is not None:
+            prompt += f"Summary of the earlier conversation:\n{previous.text}\n\n"
+        prompt += f"New messages:\n{transcript}"
+        try:
+            text = await self.complete([{"role": "user", "content": prompt}])
+        except Exception as e:
+            self.log.warning(f"failed to summarize conversation {key}: {e}")
+            return
+        if not text.strip():
+            return
+        self.summaries[key] = ConversationSummary(text.strip(), messages[-1][2])
+        self.summaries.move_to_end(key)
+        while len(self.summaries) > self.max_entries:
+            self.summaries.popitem(last=False)
+
+    def stop(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
@@ -1,31 +1,27 @@
 import json
-from collections import deque
 
-from typing import List
+from typing import List, AsyncGenerator, Tuple, Optional
 
 from aiohttp import ClientSession
-from mautrix.types import MessageEvent
 from mautrix.util.config import BaseProxyConfig
 
 import maubot_llmplus.platforms
-from maubot_llmplus.platforms import Platform, ChatCompletion
-from maubot_llmplus.plugin import AbsExtraConfigPlugin
+from maubot_llmplus.platforms import Platform, ChatCompletion, ChatCompletionChunk, ModelInfo
 
 
 class OpenAi(Platform):
     max_tokens: int
     temperature: int
 
-    def __init__(self, config: BaseProxyConfig, http: ClientSession) -> None:
-        super().__init__(config, http)
+    def __init__(self, config: BaseProxyConfig, http: ClientSession, key: Optional[str] = None) -> None:
+        super().__init__(config, http, key)
         self.max_tokens = self.config['max_tokens']
         self.temperature = self.config['temperature']
 
-    async def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
-        full_context = []
-        context = await maubot_llmplus.platforms.get_context(plugin, self, evt)
-        full_context.extend(list(context))
+    def get_health_headers(self) -> dict:
+        return {'Authorization': f"Bearer {self.api_key}"}
 
+    def get_chat_request(self, full_context: list, stream: bool) -> Tuple[str, dict, dict]:
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -41,9 +37,15 @@ class OpenAi(Platform):
         if 'temperature' in self.config and self.temperature:
             data["temperature"] = self.temperature
 
-        endpoint = f"{self.url}/v1/chat/completions"
+        if stream:
+            data["stream"] = True
+
+        path = "/v1/chat/completions"
+        return path, headers, data
+
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
         async with self.http.post(
-                endpoint, headers=headers, data=json.dumps(data)
+                endpoint, headers=headers, data=json.dumps(req_body)
         ) as response:
             # plugin.log.debug(f"响应内容：{response.status}, {await response.json()}")
             if response.status != 200:
@@ -54,13 +56,27 @@ class OpenAi(Platform):
                 )
             response_json = await response.json()
             choice = response_json["choices"][0]
+            usage = response_json.get("usage") or {}
             return ChatCompletion(
                 message=choice["message"],
                 finish_reason=choice["finish_reason"],
-                model=choice.get("model", None)
+                model=choice.get("model", None),
+                usage=maubot_llmplus.platforms.get_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
             )
 
-    async def list_models(self) -> List[str]:
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        async with self.http.post(
+                endpoint, headers=headers, data=json.dumps(req_body)
+        ) as response:
+            if response.status != 200:
+                yield ChatCompletionChunk(content='', finish_reason=f"Error: {await response.text()}",
+                                          error=True)
+                return
+            async for chunk in maubot_llmplus.platforms.iter_openai_stream(response):
+                yield chunk
+
+    async def fetch_models(self) -> List[ModelInfo]:
         # 调用openai接口获取模型列表
         full_url = f"{self.url}/v1/models"
         headers = {'Authorization': f"Bearer {self.api_key}"}
@@ -68,7 +84,16 @@ class OpenAi(Platform):
             if response.status != 200:
                 return []
             response_data = await response.json()
-            return [f"- {m['id']}" for m in response_data["data"]]
+            return [ModelInfo(name=m['id']) for m in response_data["data"]]
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        headers = {'Authorization': f"Bearer {self.api_key}"}
+        async with self.http.post(f"{self.url}/v1/embeddings", headers=headers,
+                                  json={'model': model, 'input': texts}) as response:
+            if response.status != 200:
+                raise ValueError(f"Error: {await response.text()}")
+            response_data = await response.json()
+        return [item['embedding'] for item in sorted(response_data['data'], key=lambda item: item['index'])]
 
     def get_type(self) -> str:
         return "openai"
@@ -76,22 +101,57 @@ class OpenAi(Platform):
 
 class Anthropic(Platform):
     max_tokens: int
+    cache_control: bool
 
-    def __init__(self, config: BaseProxyConfig, http: ClientSession) -> None:
-        super().__init__(config, http)
+    def __init__(self, config: BaseProxyConfig, http: ClientSession, key: Optional[str] = None) -> None:
+        super().__init__(config, http, key)
         self.max_tokens = self.config['max_tokens']
+        self.cache_control = config['prompt_cache']['anthropic_cache_control']
 
-    async def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
-        full_chat_context = []
-        system_context = deque()
-        chat_context = await maubot_llmplus.platforms.get_chat_context(system_context, plugin, self, evt)
-        full_chat_context.extend(list(chat_context))
+    def get_health_headers(self) -> dict:
+        return {"x-api-key": self.api_key, "anthropic-version": "2023-06-01"}
 
-        endpoint = f"{self.url}/v1/messages"
+    """
+        anthropic的系统提示词通过请求体的system字段发送, messages中只包含聊天消息
+        上下文开头的系统消息(系统提示词, 会话摘要)合并到system字段, 之后的系统消息(当前时间)合并到下一条用户消息中
+        开启cache_control时每条系统消息作为system中单独的一段, 静态的系统提示词, 最后一段系统消息和
+        当前消息之前的最后一条消息作为提示词缓存的断点, 会话摘要变化时系统提示词的缓存仍然有效
+    """
+
+    def get_chat_request(self, full_chat_context: list, stream: bool) -> Tuple[str, dict, dict]:
+        path = "/v1/messages"
         headers = {"x-api-key": self.api_key, "anthropic-version": "2023-06-01", "content-type": "application/json"}
-        req_body = {"model": self.model, "max_tokens": self.max_tokens, "system": self.system_prompt,
-                    "messages": full_chat_context}
+        leading = 0
+        while leading < len(full_chat_context) and full_chat_context[leading]["role"] == "system":
+            leading += 1
+        system = [m["content"] for m in full_chat_context[:leading]]
+        messages = []
+        notes = []
+        for m in full_chat_context[leading:]:
+            if m["role"] == "system":
+                notes.append(m["content"])
+                continue
+            if notes and m["role"] == "user":
+                m = {"role": "user", "content": "\n\n".join(notes + [m["content"]])}
+                notes = []
+            messages.append(m)
+        if self.cache_control and len(messages) >= 2:
+            messages[-2] = {"role": messages[-2]["role"],
+                            "content": [{"type": "text", "text": messages[-2]["content"],
+                                         "cache_control": {"type": "ephemeral"}}]}
+        req_body = {"model": self.model, "max_tokens": self.max_tokens, "messages": messages}
+        if system and self.cache_control:
+            blocks = [{"type": "text", "text": text} for text in system]
+            blocks[0]["cache_control"] = {"type": "ephemeral"}
+            blocks[-1]["cache_control"] = {"type": "ephemeral"}
+            req_body["system"] = blocks
+        elif system:
+            req_body["system"] = "\n\n".join(system)
+        if stream:
+            req_body["stream"] = True
+        return path, headers, req_body
 
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
         async with self.http.post(endpoint, headers=headers, data=json.dumps(req_body)) as response:
             # plugin.log.debug(f"响应内容：{response.status}, {await response.json()}")
             if response.status != 200:
@@ -102,48 +162,89 @@ class Anthropic(Platform):
                 )
             response_json = await response.json()
             text = "\n\n".join(c["text"] for c in response_json["content"])
+            usage = response_json.get("usage") or {}
             return ChatCompletion(
                 message=dict(role="assistant", content=text),
                 finish_reason=response_json['stop_reason'],
-                model=response_json['model']
+                model=response_json['model'],
+                usage=maubot_llmplus.platforms.get_usage(get_input_tokens(usage), usage.get("output_tokens"))
             )
         pass
 
-    async def list_models(self) -> List[str]:
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        async with self.http.post(endpoint, headers=headers, data=json.dumps(req_body)) as response:
+            if response.status != 200:
+                yield ChatCompletionChunk(content='', finish_reason=f"Error: {await response.text()}",
+                                          error=True)
+                return
+            model = None
+            prompt_tokens = None
+            # anthropic的SSE事件: message_start携带模型和输入token数, content_block_delta携带文本,
+            # message_delta携带结束原因和输出token数
+            async for data in maubot_llmplus.platforms.iter_sse(response):
+                if data['type'] == 'message_start':
+                    model = data['message'].get('model')
+                    prompt_tokens = get_input_tokens(data['message'].get('usage') or {})
+                elif data['type'] == 'content_block_delta' and data['delta'].get('type') == 'text_delta':
+                    yield ChatCompletionChunk(content=data['delta']['text'], model=model)
+                elif data['type'] == 'message_delta' and data['delta'].get('stop_reason'):
+                    usage = maubot_llmplus.platforms.get_usage(prompt_tokens,
+                                                               (data.get('usage') or {}).get('output_tokens'))
+                    yield ChatCompletionChunk(content='', finish_reason=data['delta']['stop_reason'], model=model,
+                                              usage=usage)
+
+    async def fetch_models(self) -> List[ModelInfo]:
         # 由于没有列出所有支持的模型的api，所有只能写死在代码中
-        models = ["claude-3-5-sonnet-20240620", "claude-3-opus-20240229	", "claude-3-sonnet-20240229",
+        models = ["claude-3-5-sonnet-20240620", "claude-3-opus-20240229", "claude-3-sonnet-20240229",
                   "claude-3-haiku-20240307"]
-        return [f"- {m}" for m in models]
+        return [ModelInfo(name=m, context_length=200000) for m in models]
 
     def get_type(self) -> str:
         return "anthropic"
 
 
+"""
+    anthropic的输入token数, 从提示词缓存读取和写入缓存的token不计入input_tokens, 需要加上
+"""
+
+
+def get_input_tokens(usage: dict) -> Optional[int]:
+    if usage.get("input_tokens") is None:
+        return None
+    return usage["input_tokens"] + (usage.get("cache_creation_input_tokens") or 0) + \
+        (usage.get("cache_read_input_tokens") or 0)
+
+
 class XAi(Platform):
+    temperature: int
 
-    def __init__(self, config: BaseProxyConfig, http: ClientSession) -> None:
-        super().__init__(config, http)
+    def __init__(self, config: BaseProxyConfig, http: ClientSession, key: Optional[str] = None) -> None:
+        super().__init__(config, http, key)
+        self.temperature = self.config['temperature']
 
-    def create_chat_completion(self, plugin: AbsExtraConfigPlugin, evt: MessageEvent) -> ChatCompletion:
-        full_context = []
-        context = await maubot_llmplus.platforms.get_context(plugin, self, evt)
-        full_context.extend(list(context))
+    def get_health_headers(self) -> dict:
+        return {'Authorization': f"Bearer {self.api_key}"}
 
+    def get_chat_request(self, full_context: list, stream: bool) -> Tuple[str, dict, dict]:
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
         request_body = {
-            "message": full_context,
+            "messages": full_context,
             "model": self.model,
-            "stream": False
+            "stream": stream
         }
 
         if 'temperature' in self.config and self.temperature:
             request_body["temperature"] = self.temperature
 
-        endpoint = f"{self.url}/v1/chat/completions"
-        with self.http.post(url=endpoint, data=json.dumps(request_body), headers=headers) as resp:
+        path = "/v1/chat/completions"
+        return path, headers, request_body
+
+    async def request_chat_completion(self, endpoint: str, headers: dict, req_body: dict) -> ChatCompletion:
+        async with self.http.post(url=endpoint, data=json.dumps(req_body), headers=headers) as response:
             # plugin.log.debug(f"响应内容：{response.status}, {await response.json()}")
             if response.status != 200:
                 return ChatCompletion(
@@ -153,23 +254,36 @@ class XAi(Platform):
                 )
             response_json = await response.json()
             choice = response_json["choices"][0]
+            usage = response_json.get("usage") or {}
             return ChatCompletion(
                 message=choice["message"],
                 finish_reason=choice["finish_reason"],
-                model=response_json["model"]
+                model=response_json["model"],
+                usage=maubot_llmplus.platforms.get_usage(usage.get("prompt_tokens"), usage.get("completion_tokens"))
             )
 
         pass
 
-    def list_models(self) -> List[str]:
+    async def request_chat_completion_stream(self, endpoint: str, headers: dict,
+                                             req_body: dict) -> AsyncGenerator[ChatCompletionChunk, None]:
+        async with self.http.post(url=endpoint, data=json.dumps(req_body), headers=headers) as response:
+            if response.status != 200:
+                yield ChatCompletionChunk(content='', finish_reason=f"Error: {await response.text()}",
+                                          error=True)
+                return
+            async for chunk in maubot_llmplus.platforms.iter_openai_stream(response):
+                yield chunk
+
+    async def fetch_models(self) -> List[ModelInfo]:
         # 调用openai接口获取模型列表
         full_url = f"{self.url}/v1/models"
-        async with self.http.get(full_url) as response:
+        headers = {'Authorization': f"Bearer {self.api_key}"}
+        async with self.http.get(full_url, headers=headers) as response:
             if response.status != 200:
                 return []
             response_data = await response.json()
-            return [f"- {m['id']}" for m in response_data["models"]]
+            return [ModelInfo(name=m['id']) for m in response_data["data"]]
         pass
 
     def get_type(self) -> str:
-        return "xai"
\ No newline at end of file
+        return "xai"
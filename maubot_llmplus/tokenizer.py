@@ -0,0 +1,173 @@
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from mautrix.types import MessageEvent
+
+log = logging.getLogger("maubot.llmplus.tokenizer")
+
+# 中日韩字符, 大多数分词器中每个字符约为一个token
+CJK_PATTERN = re.compile("[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+"""
+    token计数器, 按event_id缓存每条消息的token数量, 每条消息只计算一次
+"""
+
+
+class TokenCounter:
+    max_cached: int
+    cached: OrderedDict
+
+    def __init__(self, max_cached: int = 10000) -> None:
+        self.max_cached = max_cached
+        self.cached = OrderedDict()
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError()
+
+    def count_event(self, evt: MessageEvent) -> int:
+        body = evt.content.body
+        cached = self.cached.get(evt.event_id)
+        # 消息被编辑后内容会变化, 需要重新计算
+        if cached is not None and cached[0] == body:
+            self.cached.move_to_end(evt.event_id)
+            return cached[1]
+        tokens = self.count(body)
+        self.remember(evt.event_id, body, tokens)
+        return tokens
+
+    """
+        记录已知的token数量, 例如从会话存储中读取的消息
+    """
+
+    def remember(self, event_id: str, body: str, tokens: int) -> None:
+        self.cached[event_id] = (body, tokens)
+        self.cached.move_to_end(event_id)
+        while len(self.cached) > self.max_cached:
+            self.cached.popitem(last=False)
+
+
+"""
+    近似计数: 中日韩字符每个算一个token, 其他字符按每4个字符一个token计算
+"""
+
+
+class ApproximateTokenCounter(TokenCounter):
+
+    def count(self, text: str) -> int:
+        cjk_chars = len(CJK_PATTERN.findall(text))
+        return cjk_chars + math.ceil((len(text) - cjk_chars) / 4)
+
+
+"""
+    精确计数器, 编码在后台线程中加载(tiktoken第一次使用某个编码时需要下载), 不阻塞事件循环
+    加载完成之前按近似计数, 近似的结果不按event_id缓存, 加载失败时一直使用近似计数
+"""
+
+
+class ExactTokenCounter(ApproximateTokenCounter):
+    name: str
+    ready: bool
+
+    def __init__(self, name: str) -> None:
+        super().__init__()
+        self.name = name
+        self.ready = False
+        threading.Thread(target=self._load, name=f"tokenizer-{name}", daemon=True).start()
+
+    def _load(self) -> None:
+        try:
+            self.load()
+        except Exception as e:
+            log.warning(f"tokenizer {self.name} is not available, falling back to approximate counting: {e}")
+            return
+        self.ready = True
+
+    def load(self) -> None:
+        raise NotImplementedError()
+
+    def count_exact(self, text: str) -> int:
+        raise NotImplementedError()
+
+    def count(self, text: str) -> int:
+        if not self.ready:
+            return super().count(text)
+        return self.count_exact(text)
+
+    def count_event(self, evt: MessageEvent) -> int:
+        if not self.ready:
+            return super().count(evt.content.body)
+        return super().count_event(evt)
+
+
+"""
+    使用tiktoken的编码精确计数, 需要安装tiktoken, 编码文件没有缓存在本地时在后台下载
+"""
+
+
+class TiktokenCounter(ExactTokenCounter):
+
+    def __init__(self, encoding: str) -> None:
+        import tiktoken
+        self.tiktoken = tiktoken
+        self.encoding_name = encoding
+        self.encoding = None
+        super().__init__(f"tiktoken {encoding}")
+
+    def load(self) -> None:
+        self.encoding = self.tiktoken.get_encoding(self.encoding_name)
+
+    def count_exact(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+"""
+    使用本地的HuggingFace tokenizer.json精确计数, 需要安装tokenizers
+"""
+
+
+class HuggingFaceTokenCounter(ExactTokenCounter):
+
+    def __init__(self, path: str) -> None:
+        from tokenizers import Tokenizer
+        self.tokenizer_class = Tokenizer
+        self.path = path
+        self.tokenizer = None
+        super().__init__(f"huggingface {path}")
+
+    def load(self) -> None:
+        self.tokenizer = self.tokenizer_class.from_file(self.path)
+
+    def count_exact(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+counters = {}
+
+"""
+    根据平台的tokenizer配置获取计数器, 相同配置共享同一个计数器
+    精确计数器不可用时回退到近似计数, 精确计数器的编码在后台加载
+"""
+
+
+def get_token_counter(tokenizer_config: Optional[dict]) -> TokenCounter:
+    tokenizer_config = dict(tokenizer_config or {})
+    key: Tuple = tuple(sorted(tokenizer_config.items()))
+    counter = counters.get(key)
+    if counter is not None:
+        return counter
+    tokenizer_type = tokenizer_config.get('type', 'approximate')
+    try:
+        if tokenizer_type == 'tiktoken':
+            counter = TiktokenCounter(tokenizer_config.get('encoding', 'cl100k_base'))
+        elif tokenizer_type == 'huggingface':
+            counter = HuggingFaceTokenCounter(tokenizer_config['path'])
+    except Exception as e:
+        log.warning(f"tokenizer {tokenizer_type} is not available, falling back to approximate counting: {e}")
+    if counter is None:
+        counter = ApproximateTokenCounter()
+    counters[key] = counter
+    return counter
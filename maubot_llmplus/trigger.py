@@ -0,0 +1,90 @@
+import re
+from collections import OrderedDict
+from typing import List, Dict, Optional, Pattern
+
+from mautrix.types import RoomID, EventID, UserID, StateEvent, Membership
+
+"""
+    预编译的回应触发规则, 只在配置重新加载时重建
+    同时缓存聊天室的成员数量和已经满足回应条件的thread根消息, 让不需要回应的消息无需请求homeserver
+"""
+
+
+class TriggerEngine:
+    name_pattern: Pattern
+    allowed_patterns: List[Pattern]
+    # 最近判断过的sender的结果, 最多保留max_senders个
+    allowed_senders: OrderedDict
+    max_senders: int
+    member_counts: Dict[RoomID, int]
+    qualified_threads: OrderedDict
+    max_threads: int
+
+    def __init__(self, bot_name: str, allowed_users: List[str], max_threads: int = 1000,
+                 max_senders: int = 1000) -> None:
+        self.name_pattern = re.compile("(^|\\s)(@)?" + bot_name + "([ :,.!?]|$)", re.IGNORECASE)
+        self.allowed_patterns = [re.compile(u) for u in allowed_users]
+        self.allowed_senders = OrderedDict()
+        self.max_senders = max_senders
+        self.member_counts = {}
+        self.qualified_threads = OrderedDict()
+        self.max_threads = max_threads
+
+    """
+        判断sender是否匹配allowed_users中的规则, 列表为空时全部允许
+    """
+
+    def is_allow(self, sender: UserID) -> bool:
+        if not self.allowed_patterns:
+            return True
+        allowed = self.allowed_senders.get(sender)
+        if allowed is not None:
+            self.allowed_senders.move_to_end(sender)
+            return allowed
+        allowed = self.allowed_senders[sender] = any(p.match(sender) for p in self.allowed_patterns)
+        while len(self.allowed_senders) > self.max_senders:
+            self.allowed_senders.popitem(last=False)
+        return allowed
+
+    def mentions_bot(self, body: str) -> bool:
+        return self.name_pattern.search(body) is not None
+
+    """
+        去掉消息中对机器人的称呼, 只保留问题本身
+    """
+
+    def strip_mention(self, body: str) -> str:
+        return self.name_pattern.sub(" ", body).strip()
+
+    def get_member_count(self, room_id: RoomID) -> Optional[int]:
+        return self.member_counts.get(room_id)
+
+    def set_member_count(self, room_id: RoomID, count: int) -> None:
+        self.member_counts[room_id] = count
+
+    """
+        根据m.room.member事件更新聊天室成员数量, 无法确定变化时使缓存失效
+    """
+
+    def on_member_event(self, evt: StateEvent) -> None:
+        count = self.member_counts.get(evt.room_id)
+        if count is None:
+            return
+        if not evt.prev_content.membership:
+            self.member_counts.pop(evt.room_id, None)
+            return
+        was_joined = evt.prev_content.membership == Membership.JOIN
+        is_joined = evt.content.membership == Membership.JOIN
+        self.member_counts[evt.room_id] = count + int(is_joined) - int(was_joined)
+
+    def is_qualified_thread(self, room_id: RoomID, thread_root: EventID) -> bool:
+        key = (room_id, thread_root)
+        if key in self.qualified_threads:
+            self.qualified_threads.move_to_end(key)
+            return True
+        return False
+
+    def add_qualified_thread(self, room_id: RoomID, thread_root: EventID) -> None:
+        self.qualified_threads[(room_id, thread_root)] = True
+        while len(self.qualified_threads) > self.max_threads:
+            self.qualified_threads.popitem(last=False)
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple, Callable
+
+from maubot_llmplus.registry import PlatformRegistry
+
+"""
+    本地模型的预热
+    插件启动和切换平台/模型时在后台预加载当前模型, 避免第一个请求等待几十秒的模型加载,
+    在配置的繁忙时段内每隔ping_interval秒重新预热一次, 防止空闲的模型被后端卸载
+"""
+
+
+class ModelWarmer:
+    registry: PlatformRegistry
+    log: logging.Logger
+    current: Callable[[], str]
+    enable: bool
+    ping_interval: float
+    busy_hours: List[Tuple[datetime.time, datetime.time]]
+    warming: Dict[str, asyncio.Task]
+    task: Optional[asyncio.Task]
+
+    def __init__(self, registry: PlatformRegistry, log: logging.Logger, current: Callable[[], str],
+                 enable: bool, ping_interval: float, busy_hours: List[str]) -> None:
+        self.registry = registry
+        self.log = log
+        self.current = current
+        self.enable = enable
+        self.ping_interval = ping_interval
+        self.busy_hours = [parse_time_range(r) for r in busy_hours]
+        self.warming = {}
+        self.task = None
+
+    async def warm_up(self, name: str) -> None:
+        platform = self.registry.get(name)
+        try:
+            if await platform.warm_up():
+                self.log.debug(f"warmed up {platform.model} of {name}")
+        except Exception as e:
+            self.log.warning(f"failed to warm up {platform.model} of {name}: {e}")
+
+    """
+        在后台预热某个平台的当前模型, 同一个平台同时只有一个预热任务, 没有开启预热时返回None
+    """
+
+    def warm_up_in_background(self, name: str) -> Optional[asyncio.Task]:
+        if not self.enable:
+            return None
+        task = self.warming.get(name)
+        if task is None or task.done():
+            task = self.warming[name] = asyncio.create_task(self.warm_up(name))
+        return task
+
+    def is_busy(self, now: Optional[datetime.time] = None) -> bool:
+        now = now or datetime.datetime.now().time()
+        for start, end in self.busy_hours:
+            # 结束时间早于开始时间的时段跨过午夜
+            if start <= end and start <= now < end or start > end and (now >= start or now < end):
+                return True
+        return False
+
+    async def _ping_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            if self.is_busy():
+                self.warm_up_in_background(self.current())
+
+    def start(self) -> None:
+        self.stop()
+        self.warm_up_in_background(self.current())
+        if self.enable and self.ping_interval > 0 and self.busy_hours:
+            self.task = asyncio.create_task(self._ping_loop())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        for task in self.warming.values():
+            task.cancel()
+        self.warming.clear()
+
+
+"""
+    解析 08:00-18:00 形式的时段
+"""
+
+
+def parse_time_range(value: str) -> Tuple[datetime.time, datetime.time]:
+    start, end = value.split('-')
+    return datetime.time.fromisoformat(start.strip()), datetime.time.fromisoformat(end.strip())
@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator, Tuple
+
+from aiohttp import ClientSession
+
+from benchmarks.fake_matrix import FakeMatrixClient
+from benchmarks.mock_backends import MockBackend
+from benchmarks.run import load_config
+from maubot.matrix import MaubotMessageEvent
+from maubot_llmplus.aibot import AiBotPlugin
+
+"""
+    使用基准测试的模拟后端和模拟matrix客户端运行插件, 用于测试完整的消息处理流程
+    options覆盖基准测试的命令行参数, 其他配置在插件启动后通过plugin.config修改
+"""
+
+DEFAULT_OPTIONS = dict(backend="ollama", thread=False, stream=False, backend_concurrency=4, requests=50,
+                       summary=False, database=False, debounce=0, warm_up=False, retrieval=False, routing=False)
+
+
+@asynccontextmanager
+async def running_plugin(tmp_path, **options) -> AsyncIterator[Tuple[AiBotPlugin, FakeMatrixClient, MockBackend]]:
+    backend = MockBackend(latency=0.01, token_rate=1000, tokens=5)
+    url = await backend.start()
+    client = FakeMatrixClient(latency=0)
+    plugin_config = load_config(argparse.Namespace(**{**DEFAULT_OPTIONS, **options}), url)
+    http = ClientSession()
+    plugin = AiBotPlugin(client=client, loop=asyncio.get_running_loop(), http=http, instance_id="test",
+                         log=logging.getLogger("test"), config=plugin_config, database=None, webapp=None,
+                         webapp_url=None, loader=SimpleNamespace(source=str(tmp_path / "test.mbp")))
+    await plugin.start()
+    try:
+        yield plugin, client, backend
+    finally:
+        await plugin.stop()
+        await http.close()
+        await backend.stop()
+
+
+async def send(plugin: AiBotPlugin, client: FakeMatrixClient, room, body: str, sender: str = None) -> None:
+    evt = client.make_event(room.room_id, sender or room.members[1], body, reply_to=room.events[-1].event_id)
+    room.add(evt)
+    await plugin.on_message(MaubotMessageEvent(evt, client))
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from maubot_llmplus.catalog import ModelCatalog, ModelCatalogError
+from maubot_llmplus.platforms import ModelInfo
+
+
+class FakePlatform:
+    def __init__(self, results) -> None:
+        self.results = list(results)
+        self.calls = 0
+
+    async def fetch_models(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return [ModelInfo(name=name) for name in result]
+
+
+def make_catalog(platform: FakePlatform) -> ModelCatalog:
+    return ModelCatalog(SimpleNamespace(get=lambda name: platform), logging.getLogger("test"), 60)
+
+
+def test_load_fetches_directly_when_not_loaded():
+    platform = FakePlatform([["llama3", "qwen"]])
+    catalog = make_catalog(platform)
+
+    async def main():
+        assert catalog.get_models("local_ai#ollama") is None
+        # 并发的调用共用一次获取
+        results = await asyncio.gather(*(catalog.load("local_ai#ollama") for _ in range(3)))
+        assert all([m.name for m in models] == ["llama3", "qwen"] for models in results)
+        assert await catalog.has_model("local_ai#ollama", "qwen")
+        assert not await catalog.has_model("local_ai#ollama", "mistral")
+
+    asyncio.run(main())
+    assert platform.calls == 1
+
+
+def test_failed_refresh_is_reported_and_retried():
+    platform = FakePlatform([ConnectionError("connection refused"), ["llama3"]])
+    catalog = make_catalog(platform)
+
+    async def main():
+        with pytest.raises(ModelCatalogError, match="connection refused"):
+            await catalog.load("local_ai#ollama")
+        # 后端恢复后下一次调用重新获取
+        assert [m.name for m in await catalog.load("local_ai#ollama")] == ["llama3"]
+
+    asyncio.run(main())
+    assert "local_ai#ollama" not in catalog.errors
+
+
+def test_failed_refresh_keeps_previous_models():
+    platform = FakePlatform([["llama3"], ConnectionError("down")])
+    catalog = make_catalog(platform)
+
+    async def main():
+        await catalog.refresh("local_ai#ollama")
+        await catalog.refresh("local_ai#ollama")
+        return await catalog.load("local_ai#ollama")
+
+    assert [m.name for m in asyncio.run(main())] == ["llama3"]
+    assert catalog.errors["local_ai#ollama"] == "down"
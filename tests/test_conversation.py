@@ -0,0 +1,96 @@
+from mautrix.types import MessageEvent, TextMessageEventContent, MessageType, EventType, Format
+
+from maubot_llmplus.conversation import ConversationCache
+
+
+def make_event(n: int, room_id: str = "!r:x", body: str = None) -> MessageEvent:
+    return MessageEvent(type=EventType.ROOM_MESSAGE, room_id=room_id, event_id=f"${n}", sender="@a:x",
+                        timestamp=n, content=TextMessageEventContent(msgtype=MessageType.TEXT,
+                                                                     body=body or f"message {n}"))
+
+
+def make_edit(n: int, original: int, body: str) -> MessageEvent:
+    content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body, format=Format.HTML,
+                                      formatted_body=f"<b>{body}</b>")
+    content.set_edit(f"${original}")
+    return MessageEvent(type=EventType.ROOM_MESSAGE, room_id="!r:x", event_id=f"${n}", sender="@a:x",
+                        timestamp=n, content=content)
+
+
+def ids(events) -> list:
+    return [e.event_id for e in events]
+
+
+def test_timeline_is_used_only_after_backfill():
+    cache = ConversationCache(max_rooms=10, max_messages=10)
+    for n in range(1, 4):
+        cache.add_event(make_event(n))
+    assert cache.get_events_before("!r:x", "$3") is None
+    cache.add_history("!r:x", [make_event(0)])
+    cache.set_backfilled("!r:x")
+    assert ids(cache.get_events_before("!r:x", "$3")) == ["$2", "$1", "$0"]
+    assert cache.get_events_before("!r:x", "$9") is None
+
+
+def test_partial_history_needs_a_token():
+    cache = ConversationCache(max_rooms=10, max_messages=3)
+    cache.add_event(make_event(5))
+    cache.add_history("!r:x", [make_event(3), make_event(4)])
+    assert cache.get_partial_history("!r:x", "$5") is None
+    cache.set_history_token("!r:x", "t1")
+    assert cache.get_partial_history("!r:x", "$5") == ([cache.get_event("!r:x", "$4"),
+                                                         cache.get_event("!r:x", "$3")], "t1")
+    # 淘汰最早的消息之后分页token不再可用
+    cache.add_event(make_event(6))
+    assert ids(cache.rooms["!r:x"].timeline.values()) == ["$4", "$5", "$6"]
+    assert cache.get_partial_history("!r:x", "$6") is None
+
+
+def test_least_recently_used_room_is_evicted():
+    cache = ConversationCache(max_rooms=2, max_messages=10)
+    cache.add_event(make_event(1, room_id="!a:x"))
+    cache.add_event(make_event(2, room_id="!b:x"))
+    cache.add_event(make_event(3, room_id="!a:x"))
+    cache.add_event(make_event(4, room_id="!c:x"))
+    assert list(cache.rooms) == ["!a:x", "!c:x"]
+    assert cache.get_event("!b:x", "$2") is None
+
+
+def test_fetched_events_are_bounded_and_promoted():
+    cache = ConversationCache(max_rooms=10, max_messages=2)
+    for n in range(3):
+        cache.add_fetched_event(make_event(n))
+    assert list(cache.rooms["!r:x"].fetched) == ["$1", "$2"]
+    cache.add_event(make_event(2))
+    assert "$2" not in cache.rooms["!r:x"].fetched
+    assert cache.get_event("!r:x", "$2").content.body == "message 2"
+
+
+def test_edit_replaces_the_cached_content():
+    cache = ConversationCache(max_rooms=10, max_messages=10)
+    cache.add_event(make_event(1))
+    cache.add_fetched_event(make_event(2))
+    cache.add_event(make_edit(3, 1, "edited 1"))
+    cache.apply_edit(make_edit(4, 2, "edited 2"))
+    assert cache.get_event("!r:x", "$1").content.body == "edited 1"
+    assert cache.get_event("!r:x", "$1").content.formatted_body == "<b>edited 1</b>"
+    assert cache.get_event("!r:x", "$2").content.body == "edited 2"
+    # 编辑消息本身不加入时间线
+    assert cache.get_event("!r:x", "$3") is None
+    # 没有缓存原消息时忽略
+    cache.apply_edit(make_edit(5, 9, "edited 9"))
+    assert cache.get_event("!r:x", "$9") is None
+
+
+def test_redact_removes_the_event():
+    cache = ConversationCache(max_rooms=10, max_messages=10)
+    cache.add_event(make_event(1))
+    cache.add_event(make_event(2))
+    cache.add_fetched_event(make_event(0))
+    cache.set_backfilled("!r:x")
+    cache.redact("!r:x", "$1")
+    cache.redact("!r:x", "$0")
+    cache.redact("!other:x", "$1")
+    assert cache.get_events_before("!r:x", "$2") == []
+    assert cache.get_event("!r:x", "$0") is None
+
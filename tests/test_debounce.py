@@ -0,0 +1,61 @@
+import asyncio
+
+import maubot_llmplus.platforms
+from plugin_harness import running_plugin, send
+
+
+def test_burst_is_answered_once_with_all_messages(tmp_path, monkeypatch):
+    contexts = []
+    get_context = maubot_llmplus.platforms.get_context
+
+    async def record_context(plugin, platform, evt):
+        context = await get_context(plugin, platform, evt)
+        contexts.append([m['content'] for m in context])
+        return context
+
+    monkeypatch.setattr(maubot_llmplus.platforms, "get_context", record_context)
+
+    async def main():
+        async with running_plugin(tmp_path, debounce=0.2) as (plugin, client, backend):
+            room = client.create_room("!r:x", ["@a:x", "@b:x", "@c:x"], 4)
+            tasks = []
+            for i in range(3):
+                tasks.append(asyncio.create_task(send(plugin, client, room, f"ai bot, part {i}")))
+                await asyncio.sleep(0.05)
+            await asyncio.gather(*tasks)
+            return backend.requests, dict(plugin.metrics.requests)
+
+    requests, results = asyncio.run(main())
+    # 一组连续消息只调用一次后端, 较早的消息合并到最后一条消息的回答中
+    assert requests == 1
+    assert results == {"coalesced": 2, "ok": 1}
+    assert len(contexts) == 1
+    text = "\n".join(contexts[0])
+    assert all(f"part {i}" in text for i in range(3))
+
+
+def test_max_delay_limits_the_wait(tmp_path):
+    async def main():
+        async with running_plugin(tmp_path, debounce=0.5) as (plugin, client, backend):
+            plugin.config['debounce']['max_delay'] = 0.05
+            room = client.create_room("!r:x", ["@a:x", "@b:x", "@c:x"], 4)
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await send(plugin, client, room, "ai bot, hello")
+            return loop.time() - start, backend.requests
+
+    elapsed, requests = asyncio.run(main())
+    assert requests == 1
+    # 等待时间不超过max_delay, 而不是完整的window
+    assert elapsed < 0.4
+
+
+def test_without_debounce_every_message_is_answered(tmp_path):
+    async def main():
+        async with running_plugin(tmp_path) as (plugin, client, backend):
+            plugin.config['cancel']['on_new_message'] = False
+            room = client.create_room("!r:x", ["@a:x", "@b:x", "@c:x"], 4)
+            await asyncio.gather(*(send(plugin, client, room, f"ai bot, question {i}") for i in range(3)))
+            return backend.requests
+
+    assert asyncio.run(main()) == 3
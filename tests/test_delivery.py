@@ -0,0 +1,63 @@
+from maubot_llmplus.delivery import split_markdown, find_cut, cut_stream, open_fence, json_size
+
+CODE = "```python\n" + "\n".join(f"x{i} = {i}  # value" for i in range(400)) + "\n```"
+
+
+def test_split_markdown_short_text_is_one_part():
+    assert split_markdown("hello\n\nworld", 100) == ["hello\n\nworld"]
+
+
+def test_split_markdown_splits_at_paragraphs():
+    text = "\n\n".join(f"paragraph {i} " + "word " * 20 for i in range(10))
+    parts = split_markdown(text, 300)
+    assert len(parts) > 1
+    assert all(json_size(part) <= 300 for part in parts)
+    # 只在段落之间拆分, 重新拼接后与原文相同
+    assert "\n\n".join(parts) == text
+
+
+def test_split_markdown_reopens_code_fences():
+    parts = split_markdown("intro\n\n" + CODE, 2000)
+    assert len(parts) > 1
+    for part in parts:
+        assert json_size(part) <= 2000
+        assert open_fence(part) is None
+    assert all(part.startswith("```python\n") for part in parts[1:])
+
+
+def test_split_markdown_counts_escaped_characters():
+    parts = split_markdown("你好" * 1000, 600)
+    assert all(json_size(part) <= 600 for part in parts)
+    assert "".join(parts) == "你好" * 1000
+
+
+def test_find_cut_prefers_paragraph_end():
+    text = "first paragraph\n\nsecond paragraph that is longer\nstill second\n"
+    assert text[:find_cut(text, 40)] == "first paragraph"
+
+
+def test_find_cut_ignores_blank_lines_in_code_blocks():
+    text = "```\na\n\nb\n```\nafter\n"
+    assert text[:find_cut(text, 12)] == "```\na\n\nb"
+
+
+def test_find_cut_splits_long_line():
+    text = "word " * 100 + "\n"
+    cut = find_cut(text, 50)
+    assert 0 < cut and json_size(text[:cut]) <= 50
+
+
+def test_cut_stream_closes_and_reopens_fence():
+    text = CODE[:3000]
+    part, rest = cut_stream(text, 2000)
+    assert json_size(part) <= 2000
+    assert part.endswith("\n```")
+    assert open_fence(part) is None
+    assert rest.startswith("```python\n")
+    # 两部分去掉围栏后内容连续
+    assert part[:-len("\n```")] + "\n" + rest[len("```python\n"):] == text
+
+
+def test_cut_stream_outside_code_block():
+    part, rest = cut_stream("first\n\nsecond line\nthird", 15)
+    assert (part, rest) == ("first", "second line\nthird")
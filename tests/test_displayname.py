@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+from maubot_llmplus import displayname
+from maubot_llmplus.displayname import DisplaynameCache
+
+
+class Client:
+    def __init__(self, members: dict = None) -> None:
+        self.calls = 0
+        self.names = {"@a:x": "Alice"}
+        if members is not None:
+            self.state_store = SimpleNamespace(get_member=self.get_member)
+            self.members = members
+
+    async def get_member(self, room_id, user_id):
+        name = self.members.get((room_id, user_id))
+        return SimpleNamespace(displayname=name) if name else None
+
+    async def get_displayname(self, user_id):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return self.names.get(user_id)
+
+    @staticmethod
+    def parse_user_id(user_id):
+        return user_id[1:].split(':', 1)
+
+
+def test_concurrent_lookups_share_one_request():
+    client = Client()
+    cache = DisplaynameCache(client, ttl=60, max_entries=100)
+
+    async def main():
+        names = await asyncio.gather(*(cache.get_displayname("!r:x", "@a:x") for _ in range(5)))
+        assert names == ["Alice"] * 5
+        assert await cache.resolve("!r:x", ["@a:x", "@b:x", "@a:x"]) == {"@a:x": "Alice", "@b:x": "b"}
+
+    asyncio.run(main())
+    assert client.calls == 2
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    client = Client()
+    cache = DisplaynameCache(client, ttl=60, max_entries=100)
+    now = [1000.0]
+    monkeypatch.setattr(displayname, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def main():
+        await cache.get_displayname("!r:x", "@a:x")
+        client.names["@a:x"] = "Alice 2"
+        now[0] += 59
+        assert await cache.get_displayname("!r:x", "@a:x") == "Alice"
+        now[0] += 2
+        assert await cache.get_displayname("!r:x", "@a:x") == "Alice 2"
+
+    asyncio.run(main())
+    assert client.calls == 2
+
+
+def test_room_member_state_and_updates():
+    client = Client(members={("!r:x", "@a:x"): "Alice in r"})
+    cache = DisplaynameCache(client, ttl=60, max_entries=100)
+
+    async def main():
+        assert await cache.get_displayname("!r:x", "@a:x") == "Alice in r"
+        assert await cache.get_displayname("!other:x", "@a:x") == "Alice"
+        cache.update("!r:x", "@a:x", "Renamed")
+        assert await cache.get_displayname("!r:x", "@a:x") == "Renamed"
+        # 离开聊天室后重新获取
+        cache.update("!r:x", "@a:x", None)
+        assert ("!r:x", "@a:x") not in cache.entries
+
+    asyncio.run(main())
+
+
+def test_invalidate_during_lookup_drops_the_result():
+    client = Client()
+    cache = DisplaynameCache(client, ttl=60, max_entries=100)
+
+    async def main():
+        lookup = asyncio.create_task(cache.get_displayname("!r:x", "@a:x"))
+        await asyncio.sleep(0)
+        cache.invalidate("!r:x", "@a:x")
+        assert await lookup == "Alice"
+        assert cache.entries == {}
+
+    asyncio.run(main())
@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+
+from maubot_llmplus.endpoints import EndpointPool
+from maubot_llmplus.platforms import ChatCompletion, ChatCompletionChunk
+
+OK = ChatCompletion(message={'role': 'assistant', 'content': 'ok'}, finish_reason='stop', model='m')
+ERROR = ChatCompletion(message={}, finish_reason='Error: 500', model=None)
+
+
+def test_error_response_fails_over_to_next_endpoint():
+    pool = EndpointPool(["http://a", "http://b"], failure_threshold=2)
+    a, b = pool.endpoints
+    a.latency, b.latency = 0.1, 1.0
+    calls = []
+
+    async def request(endpoint):
+        calls.append(endpoint)
+        return ERROR if endpoint is a else OK
+
+    assert asyncio.run(pool.request(request, failed=lambda c: c.error)) is OK
+    assert calls == [a, b]
+    assert a.failures == 1 and b.failures == 0
+
+
+def test_all_endpoints_failing_returns_last_error():
+    pool = EndpointPool(["http://a", "http://b"], failure_threshold=2)
+
+    async def request(_):
+        return ERROR
+
+    async def main():
+        for _ in range(2):
+            # 失败的结果仍然返回给调用方
+            assert await pool.request(request, failed=lambda c: c.error) is ERROR
+
+    asyncio.run(main())
+    # 两个地址都被熔断
+    assert not any(e.available for e in pool.endpoints)
+
+
+def test_connection_error_fails_over():
+    pool = EndpointPool(["http://dead", "http://alive"])
+    dead = pool.endpoints[0]
+    dead.latency = 0.0
+
+    async def request(endpoint):
+        if endpoint is dead:
+            raise ConnectionError("refused")
+        return OK
+
+    assert asyncio.run(pool.request(request)) is OK
+    assert dead.failures == 1 and dead.in_flight == 0
+
+
+def test_success_resets_failures():
+    pool = EndpointPool(["http://a"], failure_threshold=3)
+    endpoint = pool.endpoints[0]
+    results = iter([ERROR, ERROR, OK])
+
+    async def request(_):
+        return next(results)
+
+    async def main():
+        for _ in range(3):
+            await pool.request(request, failed=lambda c: c.error)
+
+    asyncio.run(main())
+    assert endpoint.failures == 0 and endpoint.available
+    assert endpoint.latency is not None
+
+
+def test_exception_counts_as_failure_and_is_raised():
+    pool = EndpointPool(["http://a"], failure_threshold=1)
+
+    async def request(_):
+        raise ConnectionError("refused")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(pool.request(request))
+    assert not pool.endpoints[0].available
+    assert pool.endpoints[0].in_flight == 0
+
+
+def test_hedged_request_skips_failed_response():
+    pool = EndpointPool(["http://slow", "http://fast"], hedge=True, hedge_min_samples=1)
+    slow, fast = pool.endpoints
+    slow.latencies.append(0.01)
+    slow.latency = 0.01
+    fast.latency = 1.0
+
+    async def request(endpoint):
+        if endpoint is slow:
+            await asyncio.sleep(0.1)
+            return OK
+        return ERROR
+
+    async def main():
+        return await pool.request(request, failed=lambda c: c.error)
+
+    # 对冲请求返回的失败结果不作为结果, 使用较慢但成功的结果
+    assert asyncio.run(main()) is OK
+    assert fast.failures == 1
+
+
+def test_stream_with_error_chunk_counts_as_failure():
+    pool = EndpointPool(["http://a"], failure_threshold=1)
+
+    async def request(_):
+        yield ChatCompletionChunk("", finish_reason="Error: 500", error=True)
+
+    async def main():
+        return [chunk async for chunk in pool.stream(request, failed=lambda c: c.error)]
+
+    chunks = asyncio.run(main())
+    assert len(chunks) == 1 and chunks[0].error
+    assert not pool.endpoints[0].available
+
+
+def test_stream_fails_over_before_first_chunk():
+    pool = EndpointPool(["http://a", "http://b", "http://c"])
+    a, b, c = pool.endpoints
+    a.latency, b.latency, c.latency = 0.1, 0.2, 0.3
+
+    async def request(endpoint):
+        if endpoint is a:
+            raise ConnectionError("refused")
+        if endpoint is b:
+            yield ChatCompletionChunk("", finish_reason="Error: 502", error=True)
+            return
+        yield ChatCompletionChunk("hello ")
+        yield ChatCompletionChunk("world", finish_reason="stop")
+
+    async def main():
+        return [chunk.content async for chunk in pool.stream(request, failed=lambda c: c.error)]
+
+    # 失败的地址的内容不会返回给调用方
+    assert asyncio.run(main()) == ["hello ", "world"]
+    assert (a.failures, b.failures, c.failures) == (1, 1, 0)
+    assert all(e.in_flight == 0 for e in pool.endpoints)
+
+
+def test_stream_does_not_retry_after_first_chunk():
+    pool = EndpointPool(["http://a", "http://b"])
+    calls = []
+
+    async def request(endpoint):
+        calls.append(endpoint)
+        yield ChatCompletionChunk("partial")
+        raise ConnectionError("reset")
+
+    async def main():
+        chunks = []
+        with pytest.raises(ConnectionError):
+            async for chunk in pool.stream(request):
+                chunks.append(chunk.content)
+        return chunks
+
+    assert asyncio.run(main()) == ["partial"]
+    assert len(calls) == 1
@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+from mautrix.types import MessageEvent, EventType, TextMessageEventContent, MessageType, RelatesTo, RelationType, \
+    InReplyTo
+
+from maubot_llmplus.aibot import AiBotPlugin
+from maubot_llmplus.inflight import InFlightTracker
+
+
+def make_event(event_id: str, body: str, sender: str = "@a:x") -> MessageEvent:
+    content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+    return MessageEvent(type=EventType.ROOM_MESSAGE, room_id="!r:x", event_id=event_id, sender=sender,
+                        timestamp=1000, content=content)
+
+
+def test_register_and_lookup():
+    async def main():
+        tracker = InFlightTracker()
+        request = tracker.register(("!r:x", "@a:x", None), make_event("$1", "hi"))
+        assert request.task is asyncio.current_task()
+        assert tracker.get(("!r:x", "@a:x", None)) is request
+        assert tracker.get_by_event("!r:x", "$1") is request
+        tracker.unregister(request)
+        assert tracker.get(("!r:x", "@a:x", None)) is None
+        assert tracker.get_by_event("!r:x", "$1") is None
+
+    asyncio.run(main())
+
+
+def test_unregister_keeps_newer_request():
+    async def main():
+        tracker = InFlightTracker()
+        key = ("!r:x", "@a:x", None)
+        old = tracker.register(key, make_event("$1", "first"))
+        new = tracker.register(key, make_event("$2", "second"))
+        # 旧的请求结束时不会移除同一个会话中较新的请求
+        tracker.unregister(old)
+        assert tracker.get(key) is new
+        assert tracker.get_by_event("!r:x", "$2") is new
+
+    asyncio.run(main())
+
+
+def test_cancel_cancels_task_and_keeps_first_reason():
+    async def handle(tracker, requests):
+        requests.append(tracker.register(("!r:x", "@a:x", None), make_event("$1", "hi")))
+        await asyncio.sleep(10)
+
+    async def main():
+        tracker = InFlightTracker()
+        requests = []
+        task = asyncio.create_task(handle(tracker, requests))
+        await asyncio.sleep(0)
+        request = requests[0]
+        tracker.cancel(request, "edited")
+        tracker.cancel(request, "redacted")
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        assert request.reason == "edited"
+        assert tracker.get_by_event("!r:x", "$1") is None
+
+    asyncio.run(main())
+
+
+def test_edited_rerun_does_not_mutate_original():
+    original = make_event("$1", "what is 1+1")
+    original.content.relates_to = RelatesTo(in_reply_to=InReplyTo(event_id="$0"))
+    edit = make_event("$2", "what is 2+2")
+    edit.content.relates_to = RelatesTo(rel_type=RelationType.REPLACE, event_id="$1")
+    plugin = SimpleNamespace(counted_client=SimpleNamespace(disable_replies=False))
+    rerun = AiBotPlugin.make_edited_event(plugin, original, edit)
+    assert original.content.body == "what is 1+1"
+    assert (rerun.event_id, rerun.timestamp, rerun.content.body) == ("$1", 1000, "what is 2+2")
+    # 保留原消息的回复关系
+    assert rerun.content.get_reply_to() == "$0"
@@ -0,0 +1,56 @@
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+from maubot_llmplus.metrics import CountingClient, RequestMetrics, current_request
+from plugin_harness import running_plugin, send
+
+
+class Client:
+    mxid = "@bot:example.org"
+
+    async def get_event(self, room_id, event_id):
+        return event_id
+
+
+def test_counting_client_counts_calls_of_the_current_request():
+    client = CountingClient(Client())
+
+    async def main():
+        request = RequestMetrics()
+        current_request.set(request)
+        assert await client.get_event("!r:x", "$e") == "$e"
+        await client.get_event("!r:x", "$f")
+        assert client.mxid == "@bot:example.org"
+        return request
+
+    assert asyncio.run(main()).homeserver_calls == 2
+
+
+def test_plugin_client_is_not_wrapped(tmp_path):
+    async def main():
+        async with running_plugin(tmp_path) as (plugin, client, backend):
+            assert plugin.client is client
+            room = client.create_room("!r:x", ["@a:x", "@b:x"], 4)
+            await send(plugin, client, room, "ai bot, hello")
+            assert plugin.metrics.requests["ok"] == 1
+            assert plugin.metrics.homeserver_calls.sum > 0
+
+    asyncio.run(main())
+
+
+def test_metrics_endpoint_token(tmp_path):
+    async def main():
+        async with running_plugin(tmp_path) as (plugin, client, backend):
+            response = await plugin.metrics_endpoint(make_mocked_request("GET", "/metrics"))
+            assert response.status == 200
+            plugin.config['metrics']['token'] = "secret"
+            for headers in ({}, {"Authorization": "Bearer wrong"}):
+                response = await plugin.metrics_endpoint(make_mocked_request("GET", "/metrics", headers=headers))
+                assert response.status == 401
+            response = await plugin.metrics_endpoint(
+                make_mocked_request("GET", "/metrics", headers={"Authorization": "Bearer secret"}))
+            assert response.status == 200
+            assert "requests" in response.text
+
+    asyncio.run(main())
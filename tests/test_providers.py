@@ -0,0 +1,29 @@
+import pytest
+
+from maubot_llmplus import providers
+from maubot_llmplus.providers import get_provider, is_valid_platform, resolve_platform
+
+PLATFORMS = {
+    'local_ai': {'type': 'ollama'},
+    'openai': {},
+    'vllm': {'provider': 'openai'},
+    'evil': {'provider': 'os:system'},
+}
+
+
+def test_resolve_registered_providers():
+    assert resolve_platform(PLATFORMS, 'local_ai#ollama') == ('local_ai', get_provider('ollama'))
+    assert resolve_platform(PLATFORMS, 'vllm') == ('vllm', get_provider('openai'))
+    assert not is_valid_platform(PLATFORMS, 'local_ai')
+    assert not is_valid_platform(PLATFORMS, 'local_ai#openai')
+
+
+def test_unregistered_module_is_not_imported():
+    assert get_provider('os:system') is None
+    with pytest.raises(ValueError):
+        resolve_platform(PLATFORMS, 'evil')
+
+
+def test_providers_do_not_import_platforms():
+    # Platform只用于类型注解, 运行时不导入platforms
+    assert not hasattr(providers, 'Platform')
@@ -0,0 +1,69 @@
+import logging
+
+import pytest
+
+from maubot_llmplus.quota import TokenBucket, RateLimiter
+
+
+def make_limiter(**limits) -> RateLimiter:
+    limiter = RateLimiter(None, logging.getLogger("test"))
+    config = {'enable': True, 'period': 3600, 'exempt_users': ['@admin:x'], 'persist_interval': 0,
+              'user': {'requests': 0, 'tokens': 0}, 'room': {'requests': 0, 'tokens': 0},
+              'global': {'requests': 0, 'tokens': 0}}
+    for scope, scope_limits in limits.items():
+        config[scope] = scope_limits
+    limiter.configure(config)
+    return limiter
+
+
+def test_token_bucket_refill_is_capped():
+    bucket = TokenBucket(10, 2, tokens=0, updated=100)
+    bucket.refill(103)
+    assert bucket.tokens == 6
+    bucket.refill(200)
+    assert bucket.tokens == 10
+    assert bucket.is_full()
+
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(10, 2, tokens=-3, updated=0)
+    assert bucket.wait_time(1) == 2
+    assert TokenBucket(10, 2, updated=0).wait_time(1) == 0
+    assert TokenBucket(10, 0, tokens=0, updated=0).wait_time(1) == 0
+
+
+def test_check_limits_requests():
+    limiter = make_limiter(user={'requests': 2, 'tokens': 0})
+    assert limiter.check("@a:x", "!r:x") is None
+    assert limiter.check("@a:x", "!r:x") is None
+    throttle = limiter.check("@a:x", "!r:x")
+    assert (throttle.scope, throttle.kind) == ("user", "requests")
+    assert throttle.retry_after > 0
+    # 其他用户不受影响
+    assert limiter.check("@b:x", "!r:x") is None
+
+
+def test_check_does_not_charge_when_throttled():
+    limiter = make_limiter(user={'requests': 5, 'tokens': 0}, room={'requests': 1, 'tokens': 0})
+    assert limiter.check("@a:x", "!r:x") is None
+    throttle = limiter.check("@a:x", "!r:x")
+    assert throttle.scope == "room"
+    # 被聊天室限制的请求不扣除用户的请求数
+    assert limiter.buckets[("user", "@a:x", "requests")].tokens == pytest.approx(4)
+
+
+def test_check_limits_tokens_after_charge():
+    limiter = make_limiter(user={'requests': 0, 'tokens': 100})
+    assert limiter.check("@a:x", "!r:x") is None
+    limiter.charge("@a:x", "!r:x", 150)
+    throttle = limiter.check("@a:x", "!r:x")
+    assert (throttle.scope, throttle.kind) == ("user", "tokens")
+
+
+def test_exempt_users_and_disabled_limiter():
+    limiter = make_limiter(user={'requests': 1, 'tokens': 0})
+    for _ in range(3):
+        assert limiter.check("@admin:x", "!r:x") is None
+    limiter.enable = False
+    for _ in range(3):
+        assert limiter.check("@a:x", "!r:x") is None
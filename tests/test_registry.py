@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+from maubot_llmplus.registry import PlatformRegistry
+
+POOL = {'limit': 100, 'limit_per_host': 20, 'keepalive_timeout': 60, 'dns_cache_ttl': 300,
+        'connect_timeout': 10, 'read_timeout': 60}
+
+
+def test_sessions_are_keyed_by_full_platform_name():
+    config = {
+        'connection_pool': POOL,
+        'platforms': {'local_ai': {'type': 'ollama', 'connection_pool': {'limit_per_host': 4}}, 'openai': {}},
+    }
+
+    async def main():
+        registry = PlatformRegistry(config, lambda name, session: None, logging.getLogger("test"))
+        try:
+            ollama = registry.get_session('local_ai#ollama')
+            lmstudio = registry.get_session('local_ai#lmstudio')
+            assert ollama is not lmstudio
+            assert registry.get_session('local_ai#ollama') is ollama
+            # 平台配置中的connection_pool对这个平台的所有提供者生效
+            assert ollama.connector.limit_per_host == lmstudio.connector.limit_per_host == 4
+            assert registry.get_session('openai').connector.limit_per_host == 20
+            assert set(registry.sessions) == {'local_ai#ollama', 'local_ai#lmstudio', 'openai'}
+        finally:
+            await registry.close()
+        assert ollama.closed and lmstudio.closed
+
+    asyncio.run(main())
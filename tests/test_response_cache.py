@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from maubot_llmplus.platforms import ChatCompletion
+from maubot_llmplus.response_cache import ResponseCache
+
+
+def make_completion(content: str) -> ChatCompletion:
+    return ChatCompletion(message={'role': 'assistant', 'content': content}, finish_reason='stop', model='m')
+
+
+def make_cache(**kwargs) -> ResponseCache:
+    return ResponseCache(**{'enable': True, 'max_entries': 10, 'ttl': 60, 'disk_path': None,
+                            'normalize_timestamps': True, **kwargs})
+
+
+def test_make_key_ignores_stream_and_timestamps():
+    cache = make_cache()
+    body = {'model': 'm', 'messages': [{'role': 'system', 'content': 'now 2024-01-01 10:00'}]}
+    later = {'model': 'm', 'messages': [{'role': 'system', 'content': 'now 2024-01-02 11:30'}], 'stream': True}
+    assert cache.make_key("/v1/chat", body) == cache.make_key("/v1/chat", later)
+    assert cache.make_key("/v1/chat", body) != cache.make_key("/v1/other", body)
+    assert make_cache(enable=False).make_key("/v1/chat", body) is None
+
+
+def test_concurrent_requests_share_one_call():
+    cache = make_cache()
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return make_completion("answer")
+
+    async def main():
+        results = await asyncio.gather(*(cache.get_or_create("key", factory) for _ in range(5)))
+        assert all(r.message['content'] == "answer" for r in results)
+        # 完成后命中缓存
+        await cache.get_or_create("key", factory)
+
+    asyncio.run(main())
+    assert calls == 1
+    assert not cache.in_flight
+
+
+def test_failed_result_is_not_cached():
+    cache = make_cache()
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        return ChatCompletion(message={}, finish_reason='Error', model=None)
+
+    async def main():
+        await cache.get_or_create("key", factory)
+        await cache.get_or_create("key", factory)
+
+    asyncio.run(main())
+    assert calls == 2
+
+
+def test_exception_is_shared_with_waiters():
+    cache = make_cache()
+
+    async def factory():
+        await asyncio.sleep(0.05)
+        raise ValueError("backend down")
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_create("key", factory) for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert not cache.in_flight
+
+
+def test_waiter_takes_over_when_leader_is_cancelled():
+    cache = make_cache()
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return make_completion(f"answer {calls}")
+
+    async def main():
+        leader = asyncio.create_task(cache.get_or_create("key", factory))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(cache.get_or_create("key", factory)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*waiters)
+
+    results = asyncio.run(main())
+    # 只有一个等待者接替发起请求, 其他等待者共享它的结果
+    assert calls == 2
+    assert {r.message['content'] for r in results} == {"answer 2"}
+
+
+def test_disabled_cache_always_calls_factory():
+    cache = make_cache(enable=False)
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        return make_completion("answer")
+
+    async def main():
+        for _ in range(2):
+            await cache.get_or_create(cache.make_key("/v1/chat", {}), factory)
+
+    asyncio.run(main())
+    assert calls == 2
+
+
+def test_disk_tier(tmp_path):
+    async def main():
+        await make_cache(disk_path=str(tmp_path)).set("key", make_completion("stored"))
+        # 新的实例从磁盘读取
+        return await make_cache(disk_path=str(tmp_path)).get_or_create("key", None)
+
+    assert asyncio.run(main()).message['content'] == "stored"
@@ -0,0 +1,64 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from maubot_llmplus.retrieval import RoomIndex  # noqa: E402
+
+
+def make_index(count: int) -> RoomIndex:
+    index = RoomIndex()
+    for i in range(count):
+        # 第i条消息与[1, 0]的夹角随i增大
+        index.add(f"$e{i}", "@a:x", f"text {i}", 1000 + i, [1.0, i / 10])
+    return index
+
+
+def test_search_returns_most_similar_in_time_order():
+    index = make_index(10)
+    results = index.search([1.0, 0.0], 3, before=10 ** 6, exclude=set(), min_score=0)
+    assert [m.event_id for m in results] == ["$e0", "$e1", "$e2"]
+    assert results[0].score == pytest.approx(1.0)
+
+
+def test_search_filters_by_time_exclude_and_score():
+    index = make_index(10)
+    results = index.search([1.0, 0.0], 3, before=1002, exclude={"$e0"}, min_score=0)
+    assert [m.event_id for m in results] == ["$e1"]
+    assert index.search([0.0, 1.0], 3, before=10 ** 6, exclude=set(), min_score=0.99) == []
+
+
+def test_search_with_other_dimension_returns_nothing():
+    assert make_index(3).search([1.0, 0.0, 0.0], 3, before=10 ** 6, exclude=set(), min_score=0) == []
+
+
+def test_add_replaces_edited_message():
+    index = make_index(3)
+    index.add("$e1", "@a:x", "edited", 5000, [0.0, 1.0])
+    assert len(index) == 3
+    result = index.search([0.0, 1.0], 1, before=10 ** 6, exclude=set(), min_score=0)[0]
+    # 编辑保留原消息的时间
+    assert (result.event_id, result.text, result.timestamp) == ("$e1", "edited", 1001)
+
+
+def test_trim_keeps_newest_entries():
+    index = make_index(100)
+    # 不超过上限的十分之一时不整理
+    index.trim(95)
+    assert len(index) == 100
+    index.trim(50)
+    assert len(index) == 50
+    assert index.event_ids == [f"$e{i}" for i in range(50, 100)]
+    assert index.positions["$e50"] == 0
+    results = index.search([1.0, 0.0], 1, before=10 ** 6, exclude=set(), min_score=0)
+    assert results[0].event_id == "$e50"
+
+
+def test_remove_and_save_load(tmp_path):
+    index = make_index(5)
+    assert index.remove("$e2")
+    assert not index.remove("$e2")
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = RoomIndex.load(path)
+    assert loaded.event_ids == ["$e0", "$e1", "$e3", "$e4"]
+    assert np.allclose(loaded.vectors[:len(loaded)], index.vectors[:len(index)])
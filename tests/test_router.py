@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+
+from ruamel.yaml import YAML
+
+from maubot_llmplus.router import ModelRouter, Route
+
+BASE_CONFIG = os.path.join(os.path.dirname(__file__), "..", "base-config.yaml")
+
+
+def make_router(answer: str = "SIMPLE", **overrides) -> ModelRouter:
+    with open(BASE_CONFIG, encoding="utf-8") as f:
+        config = dict(YAML().load(f)['routing'])
+    config.update(overrides)
+
+    async def classify(prompt: str) -> str:
+        if answer == "timeout":
+            await asyncio.sleep(10)
+        return answer
+
+    router = ModelRouter(classify, lambda: "local_ai#ollama", logging.getLogger("test"))
+    router.configure(config)
+    return router
+
+
+def route(router: ModelRouter, text: str, room_id: str = "!r:x") -> Route:
+    return asyncio.run(router.route(room_id, text))
+
+
+def decide(router: ModelRouter, text: str, room_id: str = "!r:x") -> tuple:
+    result = route(router, text, room_id)
+    return result.tier, result.reason
+
+
+def test_rules_in_order():
+    router = make_router(rooms={"!big:x": "large"}, fast_max_words=5)
+    assert decide(router, "hi", "!big:x") == ("large", "room")
+    # 大模型关键词优先于快速模型关键词
+    assert decide(router, "hello, please explain this") == ("large", "keyword")
+    assert decide(router, "thanks!") == ("fast", "keyword")
+    assert decide(router, "one two three four five six") == ("large", "length")
+    assert decide(router, "how are you") == ("fast", "default")
+
+
+def test_classifier():
+    config = {'enable': True, 'platform': '', 'model': '', 'timeout': 0.05}
+    assert decide(make_router("SIMPLE", classifier=config, default="large"), "how are you") == ("fast", "classifier")
+    assert decide(make_router("COMPLEX", classifier=config), "how are you") == ("large", "classifier")
+    # 超时或者无法识别的回答使用default
+    assert decide(make_router("timeout", classifier=config, default="large"), "how are you") == ("large", "default")
+    assert decide(make_router("maybe", classifier=config), "how are you") == ("fast", "default")
+
+
+def test_empty_tier_uses_current_platform_and_model():
+    result = route(make_router(), "thanks")
+    assert (result.platform, result.model) == ("local_ai#ollama", "")
+
+
+def test_needs_fallback():
+    router = make_router(fast={'platform': '', 'model': 'small'})
+    fast = router.get_route("fast", "keyword")
+    assert router.needs_fallback(fast, "", "stop")
+    assert router.needs_fallback(fast, "cut off", "length")
+    assert not router.needs_fallback(fast, "complete", "stop")
+    assert not router.needs_fallback(router.get_route("large", "keyword"), "", "stop")
+    # 两个层级是同一个模型时重新生成没有意义
+    assert not make_router().needs_fallback(make_router().get_route("fast", "keyword"), "", "stop")
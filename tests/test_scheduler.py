@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from maubot_llmplus.conversation import make_status_notice, is_status_notice
+from maubot_llmplus.scheduler import BackendQueue, InferenceScheduler, QueueFullError
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_two_keys_alternate_on_one_slot():
+    async def main():
+        queue = BackendQueue(1)
+        running = queue.acquire("busy", 10)
+        tickets = [queue.acquire("a", 10) for _ in range(3)] + [queue.acquire("b", 10) for _ in range(3)]
+        order = []
+        queue.release(running)
+        while queue.active:
+            granted = next(t for t in tickets if t.granted and t not in order)
+            order.append(granted)
+            queue.release(granted)
+        return [t.key for t in order]
+
+    # 一个key排了多个请求时不会占满后端, 两个key轮流执行
+    assert run(main()) == ["a", "b", "a", "b", "a", "b"]
+
+
+def test_position_follows_round_robin():
+    async def main():
+        queue = BackendQueue(1)
+        queue.acquire("busy", 10)
+        a1, a2, a3 = (queue.acquire("a", 10) for _ in range(3))
+        b1 = queue.acquire("b", 10)
+        return [queue.position(t) for t in (a1, b1, a2, a3)]
+
+    assert run(main()) == [1, 2, 3, 4]
+
+
+def test_queue_full_and_cancelled_waiter():
+    async def main():
+        queue = BackendQueue(1)
+        running = queue.acquire("a", 2)
+        waiting = queue.acquire("b", 2)
+        queue.acquire("c", 2)
+        with pytest.raises(QueueFullError):
+            queue.acquire("d", 2)
+        # 等待中被取消的请求离开队列, 不占用位置
+        queue.release(waiting)
+        assert queue.depth == 1
+        queue.acquire("d", 2)
+        queue.release(running)
+        return queue
+
+    queue = run(main())
+    assert queue.active == 1 and queue.depth == 1
+
+
+def test_slot_limits_concurrency_and_reports_position():
+    scheduler = InferenceScheduler()
+    active = 0
+    peak = 0
+    positions = []
+
+    async def request(key):
+        nonlocal active, peak
+
+        async def on_queued(position):
+            positions.append(position)
+
+        async with scheduler.slot("local_ai#ollama", key, 2, 10, on_queued=on_queued):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def main():
+        await asyncio.gather(*(request(i) for i in range(5)))
+
+    run(main())
+    assert peak == 2
+    assert positions == [1, 2, 3]
+    stats = scheduler.stats()["local_ai#ollama"]
+    assert stats["active"] == 0 and stats["queue_depth"] == 0
+
+
+def test_cancelled_slot_waiter_frees_its_place():
+    scheduler = InferenceScheduler()
+
+    async def hold(event):
+        async with scheduler.slot("b", "a", 1, 10):
+            await event.wait()
+
+    async def main():
+        event = asyncio.Event()
+        holder = asyncio.create_task(hold(event))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(event))
+        await asyncio.sleep(0)
+        assert scheduler.queues["b"].depth == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queues["b"].depth == 0
+        event.set()
+        await holder
+
+    run(main())
+    assert scheduler.queues["b"].active == 0
+
+
+def test_status_notice_is_marked():
+    content = make_status_notice("The AI platform is busy")
+    assert content.serialize()["cn.tayxie.llmplus.status"] is True
+    # 从homeserver收到的消息同样带有标记
+    assert is_status_notice(SimpleNamespace(content=type(content).deserialize(content.serialize())))
+    assert not is_status_notice(SimpleNamespace(content=type(content).deserialize({"msgtype": "m.notice",
+                                                                                   "body": "answer"})))
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+
+from mautrix.util.async_db import Database
+
+from maubot_llmplus.db import upgrade_table
+from maubot_llmplus.store import ConversationStore, ConversationTurn
+
+ROOM = "!room:example.org"
+
+
+def make_turn(n: int, thread_id: str = '', room_id: str = ROOM) -> ConversationTurn:
+    return ConversationTurn(room_id, f"$event{n}", thread_id, "@alice:example.org", 'user', f"message {n}", None,
+                            1000 + n)
+
+
+async def open_store(tmp_path, **options) -> ConversationStore:
+    db = Database.create(f"sqlite:{tmp_path}/test.db", upgrade_table=upgrade_table, log=logging.getLogger("test.db"))
+    await db.start()
+    config = dict(retention_days=0, max_turns_per_room=0, prune_interval=0, sync_interval=3600)
+    config.update(options)
+    store = ConversationStore(db, logging.getLogger("test"), **config)
+    store.start()
+    await store.wait_loaded()
+    return store
+
+
+async def sync_rows(store: ConversationStore) -> dict:
+    rows = await store.db.fetch("SELECT room_id, event_id, timestamp FROM conversation_sync")
+    return {row['room_id']: (row['event_id'], row['timestamp']) for row in rows}
+
+
+def test_turns_are_read_back_by_thread(tmp_path):
+    async def main():
+        store = await open_store(tmp_path)
+        try:
+            await store.add_turns([make_turn(1), make_turn(2), make_turn(3, thread_id="$event2"),
+                                   make_turn(4)])
+            turns = await store.get_turns_before(ROOM, None, 2000, 10)
+            assert [t.event_id for t in turns] == ["$event4", "$event2", "$event1"]
+            # thread包含根消息
+            turns = await store.get_turns_before(ROOM, "$event2", 2000, 10)
+            assert [t.event_id for t in turns] == ["$event3", "$event2"]
+            await store.update_text(ROOM, "$event1", "edited", 1)
+            await store.delete_turn(ROOM, "$event4")
+            turns = await store.get_turns_before(ROOM, None, 1004, 1)
+            assert [(t.event_id, t.text) for t in turns] == [("$event2", "message 2")]
+            assert (await store.get_turns_before(ROOM, None, 1002, 1))[0].text == "edited"
+        finally:
+            await store.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_backfill_is_remembered(tmp_path):
+    async def main():
+        store = await open_store(tmp_path)
+        try:
+            assert not await store.is_backfilled(ROOM, None)
+            await store.backfill(ROOM, None, [make_turn(1)])
+            store.backfilled.clear()
+            assert await store.is_backfilled(ROOM, None)
+            assert not await store.is_backfilled(ROOM, "$event1")
+        finally:
+            await store.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_prune_keeps_newest_turns_per_room(tmp_path):
+    async def main():
+        store = await open_store(tmp_path, max_turns_per_room=2)
+        try:
+            await store.add_turns([make_turn(n) for n in range(5)] + [make_turn(9, room_id="!other:example.org")])
+            await store.prune()
+            turns = await store.get_turns_before(ROOM, None, 2000, 10)
+            assert [t.event_id for t in turns] == ["$event4", "$event3"]
+            assert len(await store.get_turns_before("!other:example.org", None, 2000, 10)) == 1
+        finally:
+            await store.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_sync_positions_are_batched_and_flushed_on_close(tmp_path):
+    async def main():
+        store = await open_store(tmp_path)
+        try:
+            for n in range(3):
+                await store.add_turn(make_turn(n))
+            # 批量写入之前不写数据库
+            assert await sync_rows(store) == {}
+            assert store.pending_sync == {ROOM: ("$event2", 1002)}
+        finally:
+            await store.close()
+        assert store.load_task is None and store.sync_task is None
+        assert await sync_rows(store) == {ROOM: ("$event2", 1002)}
+        await store.db.stop()
+
+        # 重新启动后从最后保存的消息补全
+        store = await open_store(tmp_path)
+        try:
+            assert store.resume_from == {ROOM: ("$event2", 1002)}
+            fetched = []
+
+            async def fetch(event_id, timestamp):
+                fetched.append((event_id, timestamp))
+                return [make_turn(3)]
+
+            await asyncio.gather(store.catch_up(ROOM, fetch), store.catch_up(ROOM, fetch))
+            assert fetched == [("$event2", 1002)]
+            assert store.resume_from == {}
+        finally:
+            await store.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_sync_interval_zero_writes_every_message(tmp_path):
+    async def main():
+        store = await open_store(tmp_path, sync_interval=0)
+        try:
+            await store.add_turn(make_turn(1))
+            assert await sync_rows(store) == {ROOM: ("$event1", 1001)}
+            # 较旧的消息不覆盖最后保存的消息
+            await store.add_turn(make_turn(0))
+            assert await sync_rows(store) == {ROOM: ("$event1", 1001)}
+        finally:
+            await store.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_reload_carries_pending_positions(tmp_path):
+    async def main():
+        store = await open_store(tmp_path)
+        await store.add_turn(make_turn(1))
+        store.stop()
+        reloaded = ConversationStore(store.db, store.log, 0, 0, 0, 3600)
+        reloaded.start(store.pending_sync)
+        try:
+            await reloaded.wait_loaded()
+            # 从这次运行中最后实时收到的消息开始补全
+            assert reloaded.resume_from == {ROOM: ("$event1", 1001)}
+            assert await sync_rows(reloaded) == {ROOM: ("$event1", 1001)}
+        finally:
+            await reloaded.close()
+            await store.db.stop()
+
+    asyncio.run(main())
+
+
+def test_stop_cancels_load(tmp_path):
+    async def main():
+        store = await open_store(tmp_path)
+        store.start()
+        load_task = store.load_task
+        store.stop()
+        await asyncio.wait([load_task])
+        assert load_task.cancelled()
+        # 等待读取的调用在读取被取消后继续
+        await store.catch_up(ROOM, None)
+        await store.db.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import threading
+
+from mautrix.types import MessageEvent, TextMessageEventContent, MessageType, EventType
+
+from maubot_llmplus.tokenizer import ApproximateTokenCounter, ExactTokenCounter, get_token_counter
+
+
+def make_event(event_id: str, body: str) -> MessageEvent:
+    return MessageEvent(type=EventType.ROOM_MESSAGE, room_id="!r:x", event_id=event_id, sender="@a:x", timestamp=0,
+                        content=TextMessageEventContent(msgtype=MessageType.TEXT, body=body))
+
+
+class WordCounter(ExactTokenCounter):
+
+    def __init__(self, fail: bool = False) -> None:
+        self.loaded = threading.Event()
+        self.release = threading.Event()
+        self.fail = fail
+        self.exact_calls = 0
+        super().__init__("words")
+
+    def _load(self) -> None:
+        self.release.wait(5)
+        super()._load()
+        self.loaded.set()
+
+    def load(self) -> None:
+        if self.fail:
+            raise OSError("missing")
+
+    def count_exact(self, text: str) -> int:
+        self.exact_calls += 1
+        return len(text.split())
+
+
+def test_approximate_count():
+    counter = ApproximateTokenCounter()
+    assert counter.count("") == 0
+    assert counter.count("abcdefgh") == 2
+    assert counter.count("abcde") == 2
+    # 中日韩字符每个算一个token
+    assert counter.count("你好世界") == 4
+    assert counter.count("你好 abcd") == 2 + 2
+
+
+def test_event_counts_are_memoized_until_edited():
+    counter = ApproximateTokenCounter()
+    calls = []
+    count = counter.count
+    counter.count = lambda text: calls.append(text) or count(text)
+    evt = make_event("$1", "abcdefgh")
+    assert counter.count_event(evt) == 2
+    assert counter.count_event(evt) == 2
+    assert calls == ["abcdefgh"]
+    evt.content.body = "abcdefghijkl"
+    assert counter.count_event(evt) == 3
+    assert len(calls) == 2
+
+
+def test_memo_is_bounded():
+    counter = ApproximateTokenCounter(max_cached=2)
+    for n in range(3):
+        counter.count_event(make_event(f"${n}", "text"))
+    counter.remember("$9", "stored", 7)
+    assert list(counter.cached) == ["$2", "$9"]
+    assert counter.count_event(make_event("$9", "stored")) == 7
+
+
+def test_exact_counter_falls_back_until_loaded():
+    counter = WordCounter()
+    evt = make_event("$1", "one two three four five six seven eight")
+    # 加载完成之前按近似计数, 结果不缓存
+    assert counter.count_event(evt) == 10
+    assert not counter.cached
+    counter.release.set()
+    assert counter.loaded.wait(5)
+    assert counter.count_event(evt) == 8
+    assert counter.count_event(evt) == 8
+    assert counter.exact_calls == 1
+
+
+def test_exact_counter_load_failure_stays_approximate():
+    counter = WordCounter(fail=True)
+    counter.release.set()
+    assert counter.loaded.wait(5)
+    assert not counter.ready
+    assert counter.count("one two three four") == 5
+
+
+def test_counters_are_shared_per_config():
+    counter = get_token_counter({'type': 'approximate'})
+    assert get_token_counter({'type': 'approximate'}) is counter
+    assert isinstance(get_token_counter(None), ApproximateTokenCounter)
+    # 不可用的精确计数器回退到近似计数
+    fallback = get_token_counter({'type': 'huggingface', 'path': '/nonexistent/tokenizer.json'})
+    assert fallback.count("abcdefgh") == 2
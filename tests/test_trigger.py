@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+from mautrix.types import Membership
+
+from maubot_llmplus.trigger import TriggerEngine
+
+ROOM = "!room:example.org"
+
+
+def member_event(prev, membership):
+    return SimpleNamespace(room_id=ROOM, prev_content=SimpleNamespace(membership=prev),
+                           content=SimpleNamespace(membership=membership))
+
+
+def test_mentions_and_strip():
+    trigger = TriggerEngine("aibot", [])
+    assert trigger.mentions_bot("aibot: hello")
+    assert trigger.mentions_bot("hey @AIBOT, are you there?")
+    assert not trigger.mentions_bot("aibots are everywhere")
+    assert trigger.strip_mention("aibot: what is 1+1") == "what is 1+1"
+
+
+def test_allowed_users():
+    assert TriggerEngine("aibot", []).is_allow("@anyone:example.org")
+    trigger = TriggerEngine("aibot", ["@alice:.*", ".*:trusted.org"])
+    assert trigger.is_allow("@alice:example.org")
+    assert trigger.is_allow("@bob:trusted.org")
+    assert not trigger.is_allow("@bob:example.org")
+    # 缓存的结果与规则一致
+    assert not trigger.is_allow("@bob:example.org")
+    assert trigger.is_allow("@alice:example.org")
+
+
+def test_allowed_senders_memo_is_bounded():
+    trigger = TriggerEngine("aibot", ["@alice:.*"], max_senders=2)
+    for n in range(5):
+        trigger.is_allow(f"@user{n}:example.org")
+    assert list(trigger.allowed_senders) == ["@user3:example.org", "@user4:example.org"]
+    # 最近使用的sender最后被淘汰
+    trigger.is_allow("@user3:example.org")
+    trigger.is_allow("@alice:example.org")
+    assert list(trigger.allowed_senders) == ["@user3:example.org", "@alice:example.org"]
+
+
+def test_member_count_follows_member_events():
+    trigger = TriggerEngine("aibot", [])
+    trigger.on_member_event(member_event(None, Membership.JOIN))
+    assert trigger.get_member_count(ROOM) is None
+    trigger.set_member_count(ROOM, 2)
+    trigger.on_member_event(member_event(Membership.INVITE, Membership.JOIN))
+    assert trigger.get_member_count(ROOM) == 3
+    trigger.on_member_event(member_event(Membership.JOIN, Membership.LEAVE))
+    assert trigger.get_member_count(ROOM) == 2
+    # 无法确定变化时使缓存失效
+    trigger.on_member_event(member_event(None, Membership.JOIN))
+    assert trigger.get_member_count(ROOM) is None
+
+
+def test_qualified_threads_are_bounded():
+    trigger = TriggerEngine("aibot", [], max_threads=2)
+    trigger.add_qualified_thread(ROOM, "$a")
+    trigger.add_qualified_thread(ROOM, "$b")
+    assert trigger.is_qualified_thread(ROOM, "$a")
+    trigger.add_qualified_thread(ROOM, "$c")
+    assert trigger.is_qualified_thread(ROOM, "$a")
+    assert not trigger.is_qualified_thread(ROOM, "$b")
+    assert trigger.is_qualified_thread(ROOM, "$c")